@@ -0,0 +1,159 @@
+import io
+import os
+import sys
+import time
+import tempfile
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, redirect_stdout
+
+import http_fixtures
+import istat_supabase as istat
+
+# =============================================================================
+# BENCHMARK PARSER DI STRUTTURA (XML vs SDMX-JSON)
+# =============================================================================
+#
+# Uso:
+#   python benchmark_istat.py structure <messaggio.xml> <messaggio.json> <tipo>
+# dove <tipo> è dataflow, datastructure, categories o codelist e i due file sono
+# lo stesso messaggio scaricato nei due formati (es. dalla cache HTTP).
+#
+#   python benchmark_istat.py replay <archivio fixture> [latenza s] [tasso errori]
+# riesegue senza rete gli scambi HTTP registrati con HTTP_FIXTURES_MODE=record
+# (vedi http_fixtures.py) e misura parsing di struttura e fetch concorrente dei codelist.
+
+
+def measure(func, repeat=3):
+    """
+    Esegue `func` `repeat` volte e restituisce (tempo migliore in secondi, picco di memoria in MB).
+    Il picco è misurato con tracemalloc su un'esecuzione separata.
+    """
+    best = None
+    with redirect_stdout(io.StringIO()):
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return best, peak / (1024 * 1024)
+
+
+def consume(iterator):
+    """
+    Consuma un generatore di record senza trattenerli in memoria.
+    """
+    count = 0
+    for _ in iterator:
+        count += 1
+    return count
+
+
+def benchmark_structure_parsers(xml_path, json_path, kind, repeat=3):
+    """
+    Confronta tempo di parsing e picco di memoria dei backend XML (albero completo e,
+    dove disponibile, streaming) e SDMX-JSON sullo stesso messaggio di struttura.
+    """
+    cases = [
+        ('xml', lambda: istat.get_structure_parser('xml', kind)(
+            istat.load_structure_document(xml_path, 'xml'))),
+        (f"json ({'orjson' if istat.orjson else 'json'})", lambda: istat.get_structure_parser('json', kind)(
+            istat.load_structure_document(json_path, 'json'))),
+    ]
+    if kind == 'dataflow':
+        cases.append(('xml streaming', lambda: consume(istat.iter_dataflow_records(open(xml_path, 'rb')))))
+    elif kind == 'datastructure':
+        cases.append(('xml streaming', lambda: consume(istat.iter_datastructure_records(open(xml_path, 'rb')))))
+
+    print(f"\nParsing messaggio '{kind}' (migliore su {repeat} esecuzioni)")
+    print(f"{'backend':<20}{'tempo (s)':>12}{'picco (MB)':>14}")
+    results = {}
+    for name, func in cases:
+        elapsed, peak = measure(func, repeat)
+        results[name] = (elapsed, peak)
+        print(f"{name:<20}{elapsed:>12.3f}{peak:>14.1f}")
+    return results
+
+
+@contextmanager
+def empty_download_dir():
+    """
+    Punta DOWNLOAD_DIR e la cache HTTP di istat_supabase a una cartella temporanea vuota,
+    così ogni misura passa davvero dal (finto) trasferimento HTTP.
+    """
+    saved = istat.DOWNLOAD_DIR, istat.HTTP_CACHE_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        istat.DOWNLOAD_DIR = tmp
+        istat.HTTP_CACHE_DIR = os.path.join(tmp, '.http_cache')
+        try:
+            yield tmp
+        finally:
+            istat.DOWNLOAD_DIR, istat.HTTP_CACHE_DIR = saved
+
+
+def benchmark_replay(fixtures_dir, latency=0.0, error_rate=0.0, workers_list=None):
+    """
+    Riproduce dall'archivio `fixtures_dir` i messaggi ALL di dataflow e datastructure
+    (parsing in streaming, record/s) e tutti i codelist registrati (fetch concorrente
+    con diversi numeri di thread). Latenza ed errori iniettati sono deterministici.
+    """
+    workers_list = workers_list or sorted({1, 4, istat.CODELIST_FETCH_WORKERS})
+    fixtures = http_fixtures.list_fixtures(fixtures_dir)
+    structure_urls = [f['url'] for f in fixtures
+                      if '/dataflow/IT1/ALL' in f['url'] or '/datastructure/IT1/ALL' in f['url']]
+    enum_ids = sorted({f['url'].rstrip('/').rsplit('/', 1)[-1]
+                       for f in fixtures if '/codelist/IT1/' in f['url']})
+    print(f"\nReplay di {len(fixtures)} fixture da {fixtures_dir} "
+          f"(latenza {latency}s, errori {error_rate:.0%})")
+
+    results = {}
+    print(f"{'misura':<40}{'tempo (s)':>12}{'unità/s':>12}")
+    for url in structure_urls:
+        iterator = istat.iter_dataflow_records if '/dataflow/' in url else istat.iter_datastructure_records
+        with empty_download_dir(), redirect_stdout(io.StringIO()):
+            http_fixtures.install('replay', fixtures_dir, latency=latency, error_rate=error_rate, seed=0)
+            start = time.perf_counter()
+            count = consume(iterator(istat.open_xml_stream(url)))
+            elapsed = time.perf_counter() - start
+        name = f"struttura {url.split('/rest/')[-1]}"
+        results[name] = (elapsed, count)
+        print(f"{name[:39]:<40}{elapsed:>12.3f}{count / elapsed:>12.1f}")
+
+    for workers in workers_list if enum_ids else []:
+        with empty_download_dir(), redirect_stdout(io.StringIO()):
+            http_fixtures.install('replay', fixtures_dir, latency=latency, error_rate=error_rate, seed=0)
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                loaded = sum(artifact is not None
+                             for _, artifact in executor.map(istat.fetch_codelist, enum_ids))
+            elapsed = time.perf_counter() - start
+        name = f"codelist x{len(enum_ids)} ({workers} thread, {loaded} ok)"
+        results[name] = (elapsed, loaded)
+        print(f"{name:<40}{elapsed:>12.3f}{loaded / elapsed:>12.1f}")
+
+    http_fixtures.uninstall()
+    return results
+
+
+def main():
+    if len(sys.argv) == 5 and sys.argv[1] == 'structure':
+        benchmark_structure_parsers(sys.argv[2], sys.argv[3], sys.argv[4])
+        return
+    if 3 <= len(sys.argv) <= 5 and sys.argv[1] == 'replay':
+        latency = float(sys.argv[3]) if len(sys.argv) > 3 else 0.0
+        error_rate = float(sys.argv[4]) if len(sys.argv) > 4 else 0.0
+        benchmark_replay(sys.argv[2], latency, error_rate)
+        return
+    print("Uso: python benchmark_istat.py structure <messaggio.xml> <messaggio.json> "
+          "<dataflow|datastructure|categories|codelist>")
+    print("     python benchmark_istat.py replay <archivio fixture> [latenza s] [tasso errori]")
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -15,6 +15,8 @@ from sqlalchemy import create_engine
 from sqlalchemy.sql import text
 from datetime import datetime
 
+import http_fixtures
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
@@ -37,6 +39,16 @@ NAMESPACE = {'nt': 'urn:eu.europa.ec.eurostat.navtree'}
 # Nome dello schema dedicato in cui creeremo tabelle e viste
 EUROSTAT_SCHEMA = "eurostat"
 
+# Viste dei dataset: 'view' (vista normale) oppure 'materialized' (vista materializzata
+# con indice univoco sui parametri del dataset, aggiornata con REFRESH ... CONCURRENTLY;
+# l'ultimo refresh è registrato in view_catalog.last_refreshed_at)
+VIEW_MODE = 'view'
+
+# Dopo la creazione della vista: PRIMARY KEY su code dei codelist, B-tree sui parametri
+# della tabella del dataset (o della vista materializzata) e ANALYZE, con tempo impiegato
+# e piano della vista filtrata prima/dopo nel log
+AUTO_INDEXES = True
+
 
 # ------------------------------------------------------------------------------
 # FUNZIONI DI SUPPORTO
@@ -139,6 +151,36 @@ def dataframe_to_postgres(dataframe, table_name, engine):
     logger.info(f"Tabella '{qualified_table_name}' creata/populata con successo.")
 
 
+def replace_table_data(dataframe, table_name, engine):
+    """
+    Sostituisce i dati di "table_name" con il DataFrame. Se la tabella esiste con le stesse
+    colonne, TRUNCATE + INSERT in un'unica transazione: la tabella non viene eliminata,
+    quindi viste materializzate, indici e PRIMARY KEY che ne dipendono restano in piedi
+    (la vista viene poi aggiornata con REFRESH). Altrimenti (tabella assente, colonne
+    cambiate o dati non compatibili) la tabella viene eliminata e ricreata.
+    """
+    qualified_table = f'{EUROSTAT_SCHEMA}."{table_name}"'
+    with engine.connect() as connection:
+        existing_columns = [row[0] for row in connection.execute(text("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = :schema AND table_name = :table
+            ORDER BY ordinal_position
+        """), {'schema': EUROSTAT_SCHEMA, 'table': table_name})]
+
+    if existing_columns and existing_columns == list(dataframe.columns):
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(f'TRUNCATE {qualified_table}'))
+                dataframe.to_sql(table_name, connection, schema=EUROSTAT_SCHEMA, if_exists='append', index=False)
+            logger.info(f"Tabella '{qualified_table}' aggiornata sul posto ({len(dataframe)} righe).")
+            return
+        except Exception as e:
+            logger.warning(f"Aggiornamento sul posto di {qualified_table} non riuscito, la tabella viene ricreata: {e}")
+
+    drop_table_if_exists(table_name, engine)
+    dataframe_to_postgres(dataframe, table_name, engine)
+
+
 # ------------------------------------------------------------------------------
 # DOWNLOAD & PARSING XML
 # ------------------------------------------------------------------------------
@@ -307,8 +349,7 @@ def fetch_and_save_codelists(dataset_code, engine):
                     dic_df.rename(columns={'descr': 'description'}, inplace=True)
 
                 codelist_table_name = f"{dataset_code.lower().replace('.', '_')}_{par.lower()}_codelist"
-                drop_table_if_exists(codelist_table_name, engine)
-                dataframe_to_postgres(dic_df, codelist_table_name, engine)
+                replace_table_data(dic_df, codelist_table_name, engine)
                 logger.info(f"Codelist per '{par}' salvata in '{codelist_table_name}'.")
             else:
                 logger.warning(f"Nessuna codelist trovata per '{par}' in '{dataset_code}'.")
@@ -340,41 +381,173 @@ def create_view_catalog_table(conn):
     - dataset_code
     - dataset_title
     - created_at
+    - last_refreshed_at (solo viste materializzate)
     """
     create_table_sql = f"""
     CREATE TABLE IF NOT EXISTS {EUROSTAT_SCHEMA}.view_catalog (
         view_name TEXT PRIMARY KEY,
         dataset_code TEXT,
         dataset_title TEXT,
-        created_at TIMESTAMP DEFAULT now()
+        created_at TIMESTAMP DEFAULT now(),
+        last_refreshed_at TIMESTAMP
     );
+    ALTER TABLE {EUROSTAT_SCHEMA}.view_catalog ADD COLUMN IF NOT EXISTS last_refreshed_at TIMESTAMP;
     """
     with conn.cursor() as cur:
         cur.execute(create_table_sql)
     conn.commit()
 
 
-def log_view_created(conn, view_name, dataset_code, dataset_title):
+def log_view_created(conn, view_name, dataset_code, dataset_title, refreshed=False):
     """
-    Inserisce o aggiorna (se la PK è la stessa) un record in eurostat.view_catalog
+    Inserisce o aggiorna (se la PK è la stessa) un record in eurostat.view_catalog.
+    Con refreshed (vista materializzata appena popolata) last_refreshed_at = now().
     """
     insert_sql = f"""
-        INSERT INTO {EUROSTAT_SCHEMA}.view_catalog (view_name, dataset_code, dataset_title)
-        VALUES (%s, %s, %s)
+        INSERT INTO {EUROSTAT_SCHEMA}.view_catalog (view_name, dataset_code, dataset_title, last_refreshed_at)
+        VALUES (%s, %s, %s, CASE WHEN %s THEN now() END)
         ON CONFLICT (view_name)
         DO UPDATE
         SET dataset_code = EXCLUDED.dataset_code,
             dataset_title = EXCLUDED.dataset_title,
-            created_at = now();
+            created_at = now(),
+            last_refreshed_at = EXCLUDED.last_refreshed_at;
     """
     with conn.cursor() as cur:
-        cur.execute(insert_sql, (view_name, dataset_code, dataset_title))
+        cur.execute(insert_sql, (view_name, dataset_code, dataset_title, refreshed))
     conn.commit()
 
 
+def get_relation_kind(conn, view_name):
+    """
+    Tipo della relazione nello schema eurostat ('r', 'v', 'm'), None se non esiste.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE n.nspname = %s AND c.relname = %s
+        """, (EUROSTAT_SCHEMA, view_name))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def refresh_materialized_view(conn, qualified_view):
+    """
+    REFRESH della vista materializzata: CONCURRENTLY (senza bloccare le query della
+    dashboard) se ha un indice univoco, altrimenti normale.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT FROM pg_index
+                WHERE indrelid = %s::regclass AND indisunique
+                  AND indexprs IS NULL AND indpred IS NULL
+            )
+        """, (qualified_view,))
+        concurrently = cur.fetchone()[0]
+        cur.execute(f"REFRESH MATERIALIZED VIEW {'CONCURRENTLY ' if concurrently else ''}{qualified_view}")
+    conn.commit()
+    logger.info(f"Vista materializzata {qualified_view} aggiornata{' (concurrently)' if concurrently else ''}.")
+
+
+def create_materialized_view_key(conn, qualified_view, index_name, key_columns):
+    """
+    Indice univoco sulla vista materializzata (chiave della serie), necessario per
+    REFRESH ... CONCURRENTLY. Se la chiave non è univoca l'indice non viene creato.
+    """
+    if not key_columns:
+        return
+    columns = ', '.join(f'"{c}"' for c in key_columns)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f'CREATE UNIQUE INDEX "{index_name}" ON {qualified_view} ({columns})')
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logger.warning(f"Indice univoco non creato su {qualified_view}, refresh non concorrente: {e}")
+
+
+def explain_view_filter(conn, qualified_view, column):
+    """
+    Costo totale e nodi del piano di una query sulla vista filtrata per un codice di
+    `column` (il primo valore presente), None se la vista è vuota.
+    """
+    with conn.cursor() as cur:
+        cur.execute(f'SELECT "{column}" FROM {qualified_view} WHERE "{column}" IS NOT NULL LIMIT 1')
+        row = cur.fetchone()
+        if row is None:
+            return None
+        cur.execute(f'EXPLAIN (FORMAT JSON) SELECT * FROM {qualified_view} WHERE "{column}" = %s', (row[0],))
+        plan = cur.fetchone()[0][0]['Plan']
+    nodes, stack = [], [plan]
+    while stack:
+        node = stack.pop()
+        nodes.append(node['Node Type'] + (f" using {node['Index Name']}" if node.get('Index Name') else ''))
+        stack.extend(reversed(node.get('Plans', [])))
+    return plan['Total Cost'], nodes
+
+
+def index_eurostat_dataset(conn, view_name, base_table_name, parameters, codelist_tables):
+    """
+    Indicizzazione dopo il caricamento: PRIMARY KEY su code di ogni codelist (saltata se
+    i codici non sono univoci), B-tree sui parametri usati in join e filtri della tabella
+    del dataset o della vista materializzata, poi ANALYZE.
+    """
+    qualified_view = f'"{EUROSTAT_SCHEMA}"."{view_name}"'
+    materialized = get_relation_kind(conn, view_name) == 'm'
+    target, prefix = (view_name, f"{base_table_name}_mv") if materialized else (base_table_name, base_table_name)
+    with conn.cursor() as cur:
+        # pg_attribute: information_schema.columns non elenca le viste materializzate
+        cur.execute("""
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+        """, (f'"{EUROSTAT_SCHEMA}"."{target}"',))
+        columns = {row[0] for row in cur.fetchall()}
+        # Prima colonna degli indici esistenti (es. la chiave univoca della vista materializzata)
+        cur.execute("""
+            SELECT a.attname FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = %s::regclass
+        """, (f'"{EUROSTAT_SCHEMA}"."{target}"',))
+        indexed = {row[0] for row in cur.fetchall()}
+    key_columns = [par for par in parameters if par in columns]
+    before = explain_view_filter(conn, qualified_view, key_columns[0]) if key_columns else None
+    conn.commit()
+
+    start = datetime.now()
+    for codelist_table in codelist_tables:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(f'ALTER TABLE "{EUROSTAT_SCHEMA}"."{codelist_table}" ADD PRIMARY KEY (code)')
+            conn.commit()
+        except psycopg2.errors.InvalidTableDefinition:
+            conn.rollback()  # PRIMARY KEY già presente
+        except Exception as e:
+            conn.rollback()
+            logger.warning(f"PRIMARY KEY non creata su {codelist_table}: {e}")
+    with conn.cursor() as cur:
+        for par in (p for p in key_columns if p not in indexed):
+            cur.execute(f'CREATE INDEX IF NOT EXISTS "{prefix}_{par}_idx" '
+                        f'ON "{EUROSTAT_SCHEMA}"."{target}" ("{par}")')
+        for relation in [target] + codelist_tables:
+            cur.execute(f'ANALYZE "{EUROSTAT_SCHEMA}"."{relation}"')
+    conn.commit()
+    elapsed = (datetime.now() - start).total_seconds()
+
+    logger.info(f"Indici su {target}: {len(set(key_columns) - indexed)} parametri, {len(codelist_tables)} codelist "
+                f"in {elapsed:.1f}s")
+    after = explain_view_filter(conn, qualified_view, key_columns[0]) if key_columns else None
+    conn.commit()
+    if before and after:
+        logger.info(f"Piano di {qualified_view} filtrata su {key_columns[0]}: costo "
+                    f"{before[0]:,.0f} -> {after[0]:,.0f}; prima: {' > '.join(before[1])}; "
+                    f"dopo: {' > '.join(after[1])}")
+
+
 def create_eurostat_dataset_view(conn, dataset_code, dataset_title, base_table_name):
     """
-    Crea una vista nello schema eurostat con un JOIN a ogni codelist esistente.
+    Crea una vista nello schema eurostat con un JOIN a ogni codelist esistente
+    (materializzata con VIEW_MODE = 'materialized').
     Esempio:
         dataset_title = "Social protection expenditure on disability by benefits - % of GDP"
         dataset_code  = "dsb_sprex01"
@@ -401,6 +574,7 @@ def create_eurostat_dataset_view(conn, dataset_code, dataset_title, base_table_n
     # 6) Costruiamo i JOIN
     join_clauses = []
     select_clauses = [f"t.*"]
+    codelist_tables = []
     for par in parameters:
         codelist_table = f"{dataset_code.lower().replace('.', '_')}_{par.lower()}_codelist"
         codelist_exists = False
@@ -420,6 +594,7 @@ LEFT JOIN "{EUROSTAT_SCHEMA}"."{codelist_table}" AS c_{par}
     ON t."{par}" = c_{par}.code
 """
             join_clauses.append(join_clause)
+            codelist_tables.append(codelist_table)
             select_clauses.append(f'c_{par}.description AS {par}_desc')
         else:
             logger.warning(f"Tabella codelist {codelist_table} non trovata, param '{par}' rimarrà come codice.")
@@ -429,8 +604,23 @@ LEFT JOIN "{EUROSTAT_SCHEMA}"."{codelist_table}" AS c_{par}
 
     dataset_link = f"https://ec.europa.eu/eurostat/dataset/{dataset_code}"
 
+    materialized = VIEW_MODE == 'materialized'
+    existing_kind = get_relation_kind(conn, view_name)
+    if materialized and existing_kind == 'm':
+        # Vista materializzata già presente (dati sostituiti sul posto da replace_table_data): basta il refresh
+        try:
+            refresh_materialized_view(conn, qualified_view)
+            create_view_catalog_table(conn)
+            log_view_created(conn, view_name, dataset_code, dataset_title, refreshed=True)
+            if AUTO_INDEXES:
+                index_eurostat_dataset(conn, view_name, base_table_name, parameters, codelist_tables)
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Errore refresh vista {qualified_view}: {e}")
+        return
+
     create_view_sql = f"""
-CREATE OR REPLACE VIEW {qualified_view} AS
+{'CREATE MATERIALIZED VIEW' if materialized else 'CREATE OR REPLACE VIEW'} {qualified_view} AS
 SELECT
        {select_part},
        '{dataset_link}' AS dataset_link
@@ -443,13 +633,31 @@ FROM {qualified_table} t
 
     try:
         with conn.cursor() as cur:
+            # Cambio di VIEW_MODE: la relazione esistente è dell'altro tipo
+            if existing_kind == 'm':
+                cur.execute(f"DROP MATERIALIZED VIEW {qualified_view}")
+            elif materialized and existing_kind == 'v':
+                cur.execute(f"DROP VIEW {qualified_view}")
             cur.execute(create_view_sql)
         conn.commit()
         logger.info(f"Vista '{qualified_view}' creata con successo.")
 
+        if materialized:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT column_name FROM information_schema.columns
+                    WHERE table_schema = %s AND table_name = %s
+                """, (EUROSTAT_SCHEMA, base_table_name))
+                table_columns = {row[0] for row in cur.fetchall()}
+            key_columns = [par for par in parameters if par in table_columns]
+            create_materialized_view_key(conn, qualified_view, f"{base_table_name}_mv_key", key_columns)
+
         # 7) Logghiamo la vista
         create_view_catalog_table(conn)
-        log_view_created(conn, view_name, dataset_code, dataset_title)
+        log_view_created(conn, view_name, dataset_code, dataset_title, refreshed=materialized)
+
+        if AUTO_INDEXES:
+            index_eurostat_dataset(conn, view_name, base_table_name, parameters, codelist_tables)
 
     except Exception as e:
         conn.rollback()
@@ -482,9 +690,8 @@ def download_and_save_dataset(node, engine):
         elif 'geo\\TIME PERIOD' in df.columns:
             df.rename(columns={'geo\\TIME PERIOD': 'geo'}, inplace=True)
 
-        # Drop e ricrea tabella
-        drop_table_if_exists(table_name, engine)
-        dataframe_to_postgres(df, table_name, engine)
+        # Sostituisce i dati (la tabella è ricreata solo se le colonne sono cambiate)
+        replace_table_data(df, table_name, engine)
 
         # Scarica codelist
         fetch_and_save_codelists(dataset_code, engine)
@@ -594,5 +801,6 @@ def main():
 
 
 if __name__ == '__main__':
+    http_fixtures.install_from_env()  # HTTP_FIXTURES_MODE=record|replay
     main()
 
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import random
+import hashlib
+import tempfile
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.response import HTTPResponse
+
+# =============================================================================
+# ARCHIVIO DI FIXTURE HTTP (record / replay)
+# =============================================================================
+#
+# Intercetta tutte le richieste fatte con `requests` (anche quelle della libreria
+# eurostat) a livello di Session.send:
+# - record: inoltra la richiesta e salva risposta (stato, header e corpo così come
+#   trasferito) nell'archivio;
+# - replay: serve le risposte dall'archivio senza rete, con latenza ed errori
+#   iniettabili in modo deterministico (seed).
+# Si attiva da ambiente, ad es.:
+#   HTTP_FIXTURES_MODE=record HTTP_FIXTURES_DIR=fixtures python istat_supabase.py
+#   HTTP_FIXTURES_MODE=replay HTTP_FIXTURES_LATENCY=0.05 HTTP_FIXTURES_ERROR_RATE=0.1 ...
+
+FIXTURES_MODE = os.environ.get('HTTP_FIXTURES_MODE', 'off')
+FIXTURES_DIR = os.environ.get('HTTP_FIXTURES_DIR', os.path.join(os.getcwd(), 'http_fixtures'))
+
+# Latenza aggiunta a ogni risposta in replay (secondi) e frazione di richieste che falliscono
+REPLAY_LATENCY = float(os.environ.get('HTTP_FIXTURES_LATENCY', 0))
+REPLAY_ERROR_RATE = float(os.environ.get('HTTP_FIXTURES_ERROR_RATE', 0))
+REPLAY_SEED = int(os.environ.get('HTTP_FIXTURES_SEED', 0))
+
+# Header di richiesta che distinguono due risposte allo stesso URL
+KEY_HEADERS = ('Accept',)
+
+# In record le richieste condizionali diventano complete, così l'archivio ha sempre il corpo;
+# in replay ETag / Last-Modified registrati servono per rispondere 304
+CONDITIONAL_HEADERS = ('If-None-Match', 'If-Modified-Since')
+
+CHUNK_SIZE = 1024 * 1024
+
+_original_send = requests.Session.send
+_state = {}
+_lock = threading.Lock()
+
+
+def fixture_key(method, url, headers):
+    """
+    Chiave della fixture: hash di metodo, URL e header in KEY_HEADERS.
+    """
+    parts = [method.upper(), url] + [f"{h}:{headers.get(h, '')}" for h in KEY_HEADERS]
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def fixture_paths(directory, key):
+    """
+    Restituisce (file dei metadati, file del corpo) per la chiave `key`.
+    """
+    return os.path.join(directory, f"{key}.json"), os.path.join(directory, f"{key}.body")
+
+
+def list_fixtures(directory=None):
+    """
+    Restituisce i metadati di tutte le fixture registrate in `directory`.
+    """
+    directory = directory or FIXTURES_DIR
+    if not os.path.isdir(directory):
+        return []
+    fixtures = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.json'):
+            with open(os.path.join(directory, name), 'r', encoding='utf-8') as f:
+                fixtures.append(json.load(f))
+    return fixtures
+
+
+def build_response(session, request, status, reason, headers, body):
+    """
+    Costruisce una requests.Response a partire da stato, header e un file binario con il
+    corpo così come trasferito (eventuale gzip compreso: la decodifica resta a urllib3).
+    """
+    raw = HTTPResponse(
+        body=body,
+        headers=headers,
+        status=status,
+        reason=reason,
+        preload_content=False,
+        decode_content=True,
+    )
+    adapter = session.get_adapter(request.url) if session is not None else HTTPAdapter()
+    return adapter.build_response(request, raw)
+
+
+def record_send(session, request, **kwargs):
+    """
+    Inoltra la richiesta e salva la risposta nell'archivio; il chiamante riceve
+    la risposta riletta dall'archivio, in streaming come l'originale.
+    """
+    for header in CONDITIONAL_HEADERS:
+        request.headers.pop(header, None)
+    kwargs['stream'] = True
+    response = _original_send(session, request, **kwargs)
+
+    directory = _state['directory']
+    os.makedirs(directory, exist_ok=True)
+    key = fixture_key(request.method, request.url, request.headers)
+    meta_path, body_path = fixture_paths(directory, key)
+
+    fd, tmp_body = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        for chunk in response.raw.stream(CHUNK_SIZE, decode_content=False):
+            f.write(chunk)
+    response.close()
+    os.replace(tmp_body, body_path)
+
+    meta = {
+        'method': request.method,
+        'url': request.url,
+        'request_headers': {h: request.headers[h] for h in KEY_HEADERS if h in request.headers},
+        'status': response.status_code,
+        'reason': response.reason,
+        # Il corpo è già de-chunked: il Transfer-Encoding originale non va riprodotto
+        'headers': {h: v for h, v in response.headers.items() if h.lower() != 'transfer-encoding'},
+        'body': os.path.basename(body_path),
+        'recorded_at': time.time(),
+    }
+    fd, tmp_meta = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_meta, meta_path)
+
+    return build_response(session, request, meta['status'], meta['reason'], meta['headers'],
+                          open(body_path, 'rb'))
+
+
+def is_not_modified(request, meta):
+    """
+    True se la richiesta condizionale corrisponde a ETag o Last-Modified della fixture.
+    """
+    headers = CaseInsensitiveDict(meta['headers'])
+    etag = headers.get('ETag')
+    last_modified = headers.get('Last-Modified')
+    if etag and request.headers.get('If-None-Match') == etag:
+        return True
+    return bool(last_modified and request.headers.get('If-Modified-Since') == last_modified)
+
+
+def replay_send(session, request, **kwargs):
+    """
+    Serve la risposta dall'archivio, applicando latenza ed errori iniettati.
+    Una richiesta senza fixture fallisce come una connessione non disponibile.
+    """
+    with _lock:
+        fail = _state['rng'].random() < _state['error_rate']
+    if _state['latency']:
+        time.sleep(_state['latency'])
+    if fail:
+        raise requests.exceptions.ConnectionError(f"Errore iniettato (replay): {request.url}")
+
+    key = fixture_key(request.method, request.url, request.headers)
+    meta_path, body_path = fixture_paths(_state['directory'], key)
+    if not os.path.exists(meta_path):
+        raise requests.exceptions.ConnectionError(f"Fixture mancante (replay): {request.url}")
+    with open(meta_path, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+
+    if meta['status'] == 200 and is_not_modified(request, meta):
+        headers = {h: v for h, v in meta['headers'].items()
+                   if h.lower() not in ('content-length', 'content-encoding', 'transfer-encoding')}
+        return build_response(session, request, 304, 'Not Modified', headers, open(os.devnull, 'rb'))
+    return build_response(session, request, meta['status'], meta['reason'], meta['headers'],
+                          open(body_path, 'rb'))
+
+
+def install(mode, directory=None, latency=None, error_rate=None, seed=None):
+    """
+    Attiva la modalità `mode` ('record', 'replay' o 'off') per tutte le Session di requests.
+    """
+    if mode not in ('record', 'replay', 'off'):
+        raise ValueError(f"Modalità fixture HTTP non valida: {mode}")
+    if mode == 'off':
+        uninstall()
+        return
+
+    _state.update(
+        mode=mode,
+        directory=directory or FIXTURES_DIR,
+        latency=REPLAY_LATENCY if latency is None else latency,
+        error_rate=REPLAY_ERROR_RATE if error_rate is None else error_rate,
+        rng=random.Random(REPLAY_SEED if seed is None else seed),
+    )
+    handler = record_send if mode == 'record' else replay_send
+
+    def send(session, request, **kwargs):
+        return handler(session, request, **kwargs)
+
+    requests.Session.send = send
+    print(f"Fixture HTTP in modalità {mode} ({_state['directory']})")
+
+
+def uninstall():
+    """
+    Ripristina l'invio reale delle richieste.
+    """
+    requests.Session.send = _original_send
+    _state.clear()
+
+
+def install_from_env():
+    """
+    Attiva le fixture secondo HTTP_FIXTURES_MODE (nessun effetto se 'off' o non impostata).
+    """
+    if FIXTURES_MODE != 'off':
+        install(FIXTURES_MODE)
@@ -1,7 +1,25 @@
+import io
 import os
 import re
+import csv
 import sys
+import gzip
+import base64
+import json
+import time
+import queue
+import hashlib
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
+from urllib.parse import urlencode
 import requests
+import urllib3
 import pandas as pd
 import psycopg2
 from io import StringIO
@@ -10,6 +28,13 @@ from tqdm import tqdm
 from psycopg2 import sql
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 
+import http_fixtures
+
+try:
+    import orjson  # decoder JSON veloce (opzionale) per il backend SDMX-JSON
+except ImportError:
+    orjson = None
+
 # =============================================================================
 # CONFIGURAZIONI
 # =============================================================================
@@ -17,11 +42,19 @@ from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
 # Schema dedicato per le tabelle ISTAT
 ISTAT_SCHEMA = "istat"
 
+# Lunghezza massima (byte) degli identificatori Postgres (NAMEDATALEN - 1)
+MAX_IDENTIFIER_LENGTH = 63
+
 # Base URL per le API ISTAT (nuovo endpoint IstatData)
 ISTAT_BASE_URL = "https://esploradati.istat.it/SDMXWS"
 ISTAT_REST_V1 = f"{ISTAT_BASE_URL}/rest"
 ISTAT_REST_V2 = f"{ISTAT_BASE_URL}/rest/v2"
 
+# Messaggi di struttura completi (Parte 1 e categorie)
+DATAFLOW_ALL_URL = f"{ISTAT_REST_V1}/dataflow/IT1/ALL/latest"
+DATASTRUCTURE_ALL_URL = f"{ISTAT_REST_V1}/datastructure/IT1/ALL/latest"
+CATEGORYSCHEME_ALL_URL = f"{ISTAT_REST_V1}/categoryscheme/IT1/ALL/latest"
+
 # Namespaces per il parsing XML
 NAMESPACES = {
     'mes': 'http://www.sdmx.org/resources/sdmxml/schemas/v2_1/message',
@@ -30,6 +63,9 @@ NAMESPACES = {
     'xml': 'http://www.w3.org/XML/1998/namespace'
 }
 
+# Componenti di una DSD (figli diretti di structure:DataStructure)
+DSD_COMPONENTS_PATH = 'structure:DataStructureComponents'
+
 # Parametri di connessione al database
 DB_NAME = 'postgres'
 DB_USER = 'postgres.djjawimszfspglkygynu'
@@ -47,6 +83,148 @@ EXCLUDE_FIELDS = {
     'unit_meas', 'unit_mult', 'metadata_en', 'metadata_it'
 }
 
+# Cache HTTP su disco (content-addressed) per le risposte degli endpoint SDMX:
+# memorizza ETag/Last-Modified per URL e invia richieste condizionali
+HTTP_CACHE_ENABLED = True
+HTTP_CACHE_DIR = os.path.join(DOWNLOAD_DIR, ".http_cache")
+
+# Max-age (secondi) per URL che contengono il pattern: entro questo intervallo
+# la risposta in cache viene usata senza contattare ISTAT
+HTTP_CACHE_MAX_AGE = {
+    '/categoryscheme/': 24 * 3600,
+}
+
+# Compressione: negoziata su ogni richiesta (Accept-Encoding) e usata anche a riposo per i
+# file grezzi in DOWNLOAD_DIR e per gli oggetti della cache HTTP (.gz, letti in modo
+# trasparente da open_raw_file); se il server risponde in gzip i byte sono salvati così come
+# arrivano, altrimenti vengono ricompressi (livello basso: conta la velocità)
+HTTP_ACCEPT_ENCODING = 'gzip, deflate'
+RAW_COMPRESSION = True
+RAW_COMPRESSION_LEVEL = 1
+
+# Download riprendibili dei CSV dei dataflow: i byte ricevuti restano in <file>.part e un
+# trasferimento interrotto riparte da dove si era fermato (Range / If-Range, se il server li
+# supporta), con attese esponenziali tra i tentativi. La pipeline della Parte 2 scarica
+# sempre su file in questo modo; nel percorso sequenziale True prevale su STREAMING_CSV_LOAD
+# (il CSV viene scritto per intero su disco e poi caricato), con False il body HTTP va
+# direttamente a COPY senza ripresa possibile
+RESUMABLE_DOWNLOADS = False
+DOWNLOAD_MAX_RETRIES = 5
+DOWNLOAD_BACKOFF_BASE = 2
+DOWNLOAD_BACKOFF_MAX = 60
+DOWNLOAD_TIMEOUT = 60
+
+# Buffer per lettura/scrittura dei file grezzi e dei body HTTP
+RAW_IO_BUFFER_SIZE = 1024 * 1024
+
+# Numero di codelist scaricate e parsate in parallelo nella Parte 2
+CODELIST_FETCH_WORKERS = 8
+
+# Secondi entro cui un codelist già caricato (tabella presente, riga nel manifest) non viene
+# nemmeno richiesto; None = a ogni esecuzione una richiesta condizionale (ETag), così le
+# modifiche di ISTAT ai codelist sono viste subito
+CODELIST_RECHECK_INTERVAL = None
+
+# Ricostruzione offline (python istat_supabase.py --rebuild-offline): struttura, codelist,
+# tabelle dei dataflow e viste ricostruite solo dai file in DOWNLOAD_DIR e dalla cache HTTP,
+# con REBUILD_LOAD_WORKERS caricamenti in parallelo. Durante la ricostruzione OFFLINE_MODE
+# impedisce qualsiasi richiesta HTTP
+OFFLINE_REBUILD_FLAG = '--rebuild-offline'
+REBUILD_LOAD_WORKERS = 4
+OFFLINE_MODE = False
+
+# Vincoli di contenuto (availableconstraint): memorizza per ogni dataflow i codici
+# effettivamente usati, per viste con codelist ridotte e per saltare dataflow senza dati
+USE_CONTENT_CONSTRAINTS = False
+
+# Viste della Parte 3: 'view' (viste normali, join e cast a ogni query) oppure
+# 'materialized' (viste materializzate con indice univoco su chiave di serie + time_period,
+# aggiornate con REFRESH ... CONCURRENTLY dopo ogni caricamento incrementale; dopo un
+# caricamento completo sono già ricostruite dallo swap). Registrate in view_catalog
+VIEW_MODE = 'view'
+
+# Indici automatici dopo la Parte 3: B-tree sulle dimensioni usate in join e filtri e
+# indice sul tempo (TIME_INDEX_METHOD 'brin' o 'btree') sulla tabella dei fatti (o sulla
+# vista materializzata), poi ANALYZE; tempi e piani delle viste prima/dopo vengono stampati
+AUTO_INDEXES = True
+TIME_INDEX_METHOD = 'brin'
+
+# Formato dei messaggi di struttura: 'xml' (SDMX-ML 2.1) oppure 'json' (SDMX-JSON)
+STRUCTURE_FORMAT = 'xml'
+STRUCTURE_ACCEPT = {
+    'xml': None,  # formato di default del web service
+    'json': 'application/vnd.sdmx.structure+json;version=1.0',
+}
+
+# Dataflow e DSD non più presenti nel messaggio ALL: vengono marcati (withdrawn_at) e
+# tornano attivi se ripubblicati; con True sono invece eliminati con i loro componenti
+DELETE_REMOVED_STRUCTURES = False
+
+# Parte 1 in streaming: il body HTTP viene parsato incrementalmente (iterparse)
+# invece di costruire l'intero albero XML in memoria
+STREAMING_PART1 = True
+
+# Numero di DataStructure accumulate prima di ogni scrittura su DB (modalità streaming)
+STREAMING_BATCH_SIZE = 200
+
+# Righe per ogni batch COPY + merge della scrittura bulk
+BULK_BATCH_SIZE = 50000
+
+# Tentativi per batch della scrittura bulk (con attesa e riconnessione se la connessione è persa)
+BULK_MAX_RETRIES = 3
+BULK_RETRY_DELAY = 5  # secondi
+
+# Parte 2: il CSV dei dataflow passa dal body HTTP a COPY FROM STDIN senza essere
+# materializzato (False => vecchio percorso file + pandas)
+STREAMING_CSV_LOAD = True
+
+# Conserva comunque una copia del CSV grezzo in DOWNLOAD_DIR durante il caricamento in streaming
+CSV_TEE_TO_DISK = True
+
+# Dimensione dei blocchi letti dalla rete e inviati a COPY
+CSV_COPY_BUFFER_SIZE = 1024 * 1024
+
+# COPY parallela per i dataflow più grandi: i blocchi del CSV vengono distribuiti su
+# COPY_PARALLELISM connessioni che scrivono in una shadow UNLOGGED (indici e SET LOGGED
+# a caricamento concluso, poi swap); sotto PARALLEL_COPY_MIN_BYTES si usa una sola COPY
+COPY_PARALLELISM = 4
+PARALLEL_COPY_MIN_BYTES = 64 * 1024 * 1024
+
+# Tipi delle colonne derivati da datastructure_details (misura DOUBLE PRECISION, tempo TEXT
+# più time_period_date) invece di tutte TEXT; dimensioni e attributi restano TEXT, così
+# nessun valore diverso da obs_value viene mai scartato. Disattivato di default: cambia il
+# tipo delle colonne delle tabelle pubblicate (e delle viste/dataset che le usano)
+TYPED_TABLES = False
+
+# Layout delle tabelle dei dataflow: 'wide' (una colonna per campo del CSV) oppure
+# 'dictionary': colonne costanti in fact_table_metadata, colonne testuali con al più
+# DICTIONARY_MAX_CARDINALITY valori codificate come SMALLINT nel dizionario condiviso
+# dimension_dictionary, fatti in <df>__facts e vista <df> con la forma originale
+# (con questo layout i dataflow sono sempre ricaricati per intero)
+STORAGE_LAYOUT = 'wide'
+DICTIONARY_MAX_CARDINALITY = 10000
+
+# Refresh incrementale dei dataflow già caricati: si scaricano solo le osservazioni
+# aggiornate ('updatedAfter') o gli ultimi periodi ('startPeriod') e le si fondono per
+# chiave di serie + TIME_PERIOD; ogni FULL_RECONCILE_DAYS giorni si ricarica tutto.
+# Modalità opzionale: di default ogni run ricarica per intero i dataflow scelti
+INCREMENTAL_REFRESH = False
+INCREMENTAL_STRATEGY = 'updatedAfter'
+INCREMENTAL_LOOKBACK_YEARS = 1
+FULL_RECONCILE_DAYS = 30
+
+# Manifest degli import (pipeline_manifest): ogni file caricato viene registrato con URL,
+# sha256 del contenuto, dimensione, righe e durata; un file identico all'ultimo import
+# riuscito della stessa tabella non viene ricaricato
+MANIFEST_SKIP_UNCHANGED = True
+
+# Parte 2 a pipeline: downloader e loader separati, collegati da una coda limitata
+# (i loader usano connessioni proprie: attenzione al limite del pooler)
+PIPELINED_PART2 = True
+DOWNLOAD_WORKERS = 4
+LOAD_WORKERS = 2
+PIPELINE_QUEUE_SIZE = 4
+
 
 # =============================================================================
 # FUNZIONE PLACEHOLDER PER CREAZIONE DB (SE SERVISSE)
@@ -147,900 +325,3637 @@ def sanitize_column_name(name):
     return name
 
 
-def rename_file_after_import(file_name):
+def raw_file_name(file_name):
     """
-    Rinomina il file scaricato in *_import.[ext] per marcare l’avvenuta importazione.
+    Nome con cui viene salvato un file grezzo: con RAW_COMPRESSION si aggiunge .gz.
     """
-    file_path = os.path.join(DOWNLOAD_DIR, file_name)
-    import_file_path = os.path.join(
-        DOWNLOAD_DIR,
-        f"{os.path.splitext(file_name)[0]}_import{os.path.splitext(file_name)[1]}"
-    )
-    if os.path.exists(file_path) and not os.path.exists(import_file_path):
-        os.rename(file_path, import_file_path)
-        print(f"File {file_path} rinominato in {import_file_path}")
+    if RAW_COMPRESSION and not file_name.endswith('.gz'):
+        return f"{file_name}.gz"
+    return file_name
 
 
-# =============================================================================
-# PARTE 1: Scarica Dataflow e Datastructure
-# =============================================================================
-
-def download_and_parse_xml(url, max_retries=3, timeout=30):
+def import_file_name(file_name):
     """
-    Scarica il file XML dall'URL e restituisce l'elemento root di ElementTree.
-    Implementa retry in caso di errori temporanei.
+    Nome *_import con cui le versioni precedenti marcavano i file importati
+    (l'eventuale .gz resta in coda: X.csv.gz => X_import.csv.gz).
     """
-    import time
-
-    for attempt in range(max_retries):
-        try:
-            response = requests.get(url, timeout=timeout)
-            if response.status_code == 200:
-                return ET.fromstring(response.content)
-            elif response.status_code >= 500:
-                if attempt < max_retries - 1:
-                    wait_time = 2 ** attempt  
-                    print(f"Errore del server (HTTP {response.status_code}). Ritento in {wait_time} secondi...")
-                    time.sleep(wait_time)
-                    continue
-            print(f"Errore nel download: HTTP {response.status_code}")
-            if response.text:
-                print(f"Dettagli errore: {response.text[:200]}...")
-            sys.exit(1)
-        except requests.exceptions.Timeout:
-            if attempt < max_retries - 1:
-                print(f"Timeout. Riprovo {attempt + 2}/{max_retries}...")
-                continue
-            print(f"Timeout dopo {max_retries} tentativi.")
-            sys.exit(1)
-        except requests.exceptions.RequestException as e:
-            print(f"Errore download: {str(e)}")
-            sys.exit(1)
-        except ET.ParseError as e:
-            print(f"Errore parsing XML: {str(e)}")
-            sys.exit(1)
+    base, compression = (file_name[:-3], '.gz') if file_name.endswith('.gz') else (file_name, '')
+    stem, ext = os.path.splitext(base)
+    return f"{stem}_import{ext}{compression}"
 
 
-def extract_data_from_dataflow(root):
+def find_raw_file(file_name):
     """
-    Estrae i Dataflow dal file XML.
+    Percorso in DOWNLOAD_DIR del file grezzo `file_name`, compresso (.gz) o non compresso
+    (file scaricati da versioni precedenti). None se non esiste.
     """
-    data = []
-    for element in root.findall('.//structure:Dataflow', namespaces=NAMESPACES):
-        id_value = element.attrib.get('id')
-        agencyID_value = element.attrib.get('agencyID')
-        version_value = element.attrib.get('version')
-
-        ref_element = element.find('.//structure:Structure/Ref', namespaces=NAMESPACES)
-        if ref_element is not None:
-            ref_id_value = ref_element.attrib.get('id')
-            package_value = ref_element.attrib.get('package')
-        else:
-            ref_id_value = None
-            package_value = None
+    for name in (f"{file_name}.gz", file_name):
+        path = os.path.join(DOWNLOAD_DIR, name)
+        if os.path.exists(path):
+            return path
+    return None
 
-        name_it_element = element.find('.//common:Name[@xml:lang="it"]', namespaces=NAMESPACES)
-        name_it_value = name_it_element.text if name_it_element is not None else None
 
-        name_en_element = element.find('.//common:Name[@xml:lang="en"]', namespaces=NAMESPACES)
-        name_en_value = name_en_element.text if name_en_element is not None else None
+def open_raw_file(path, mode='rb'):
+    """
+    Apre un file grezzo in modalità binaria: i .gz sono compressi/decompressi in modo
+    trasparente, gli altri file usano un buffer da RAW_IO_BUFFER_SIZE.
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, mode, compresslevel=RAW_COMPRESSION_LEVEL)
+    return open(path, mode, buffering=RAW_IO_BUFFER_SIZE)
 
-        row = {
-            'ID': id_value,
-            'Nome_it': name_it_value,
-            'Nome_en': name_en_value,
-            'ref_id': ref_id_value,
-            'version': version_value,
-            'agencyID': agencyID_value,
-            'package': package_value
-        }
-        data.append(row)
-    return data
 
+def http_get(url, headers=None, **kwargs):
+    """
+    requests.get con la compressione del trasferimento negoziata (HTTP_ACCEPT_ENCODING).
+    In OFFLINE_MODE nessuna richiesta parte: l'errore di connessione segue i percorsi di
+    fallback su file locali e cache.
+    """
+    if OFFLINE_MODE:
+        raise requests.exceptions.ConnectionError(f"Modalità offline, nessuna richiesta per {url}")
+    return requests.get(url, headers={'Accept-Encoding': HTTP_ACCEPT_ENCODING, **(headers or {})}, **kwargs)
 
-def extract_data_from_datastructure(root):
+
+def save_raw_body(raw, file_path, desc=None):
     """
-    Estrae i DataStructure, i Details e i Groups dal file XML.
+    Salva il body urllib3 `raw` in `file_path` (prima in un file .part) a blocchi da
+    RAW_IO_BUFFER_SIZE. Per un .gz, se il server ha risposto in gzip i byte compressi sono
+    scritti così come arrivano; altrimenti la compressione segue l'estensione del file.
+    Restituisce il percorso del file.
     """
-    data = []
-    details = []
-    groups = []
-    for element in root.findall('.//structure:DataStructure', namespaces=NAMESPACES):
-        id_value = element.attrib.get('id')
-        agencyID_value = element.attrib.get('agencyID')
-        version_value = element.attrib.get('version')
+    compress = file_path.endswith('.gz')
+    passthrough = compress and raw.headers.get('Content-Encoding', '').lower() == 'gzip'
+    part_path = f"{file_path}.part"
+    with open(part_path, 'wb', buffering=RAW_IO_BUFFER_SIZE) as f, \
+            tqdm(total=int(raw.headers.get('Content-Length') or 0), unit='iB', unit_scale=True,
+                 desc=desc or f"Downloading {os.path.basename(file_path)}") as t:
+        out = f
+        if compress and not passthrough:
+            out = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=RAW_COMPRESSION_LEVEL)
+        for chunk in raw.stream(RAW_IO_BUFFER_SIZE, decode_content=not passthrough):
+            out.write(chunk)
+            t.update(raw.tell() - t.n)
+        if out is not f:
+            out.close()
+    os.replace(part_path, file_path)
+    return file_path
+
+
+def batched(iterable, size):
+    """
+    Suddivide un iterabile (anche un generatore) in liste di al più `size` elementi.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
-        name_it_element = element.find('.//common:Name[@xml:lang="it"]', namespaces=NAMESPACES)
-        name_it_value = name_it_element is not None and name_it_element.text or None
 
-        name_en_element = element.find('.//common:Name[@xml:lang="en"]', namespaces=NAMESPACES)
-        name_en_value = name_en_element is not None and name_en_element.text or None
+# =============================================================================
+# SCRITTURA BULK (COPY in staging + merge set-based)
+# =============================================================================
 
-        row = {
-            'ID': id_value,
-            'Nome_it': name_it_value,
-            'Nome_en': name_en_value,
-            'version': version_value,
-            'agencyID': agencyID_value
-        }
-        data.append(row)
+@contextmanager
+def transaction(conn):
+    """
+    Esegue il blocco in un'unica transazione anche se la connessione è in autocommit.
+    Se la connessione è già in una transazione (uso annidato) il blocco vi partecipa
+    e il commit resta a carico del chiamante esterno.
+    """
+    if not conn.autocommit:
+        yield conn
+        return
 
-        # Estrai i dettagli (Dimension, Attribute, Measure)
-        for detail in (element.findall('.//structure:Dimension', namespaces=NAMESPACES) +
-                       element.findall('.//structure:Attribute', namespaces=NAMESPACES) +
-                       element.findall('.//structure:Measure', namespaces=NAMESPACES)):
-            detail_id = detail.attrib.get('id')
-
-            concept_ref = detail.find('.//structure:ConceptIdentity/Ref', namespaces=NAMESPACES)
-            concept_id = concept_ref.attrib.get('id') if concept_ref is not None else None
-            concept_agency = concept_ref.attrib.get('agencyID') if concept_ref is not None else None
-            maintainableParentID = concept_ref.attrib.get('maintainableParentID') if concept_ref is not None else None
-            maintainableParentVersion = concept_ref.attrib.get('maintainableParentVersion') if concept_ref is not None else None
-            concept_class = concept_ref.attrib.get('class') if concept_ref is not None else None
-
-            local_representation = detail.find('.//structure:LocalRepresentation/structure:Enumeration/Ref', namespaces=NAMESPACES)
-            if local_representation is not None:
-                enum_id = local_representation.attrib.get('id')
-                enum_version = local_representation.attrib.get('version')
-                enum_agencyID = local_representation.attrib.get('agencyID')
-                enum_package = local_representation.attrib.get('package')
-                enum_class = local_representation.attrib.get('class')
-            else:
-                enum_id = None
-                enum_version = None
-                enum_agencyID = None
-                enum_package = None
-                enum_class = None
+    conn.autocommit = False
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
 
-            detail_row = {
-                'datastructure_id': id_value,
-                'type': detail.tag.split('}')[-1],  # es. "Dimension"/"Attribute"/"Measure"
-                'detail_id': detail_id,
-                'concept_id': concept_id,
-                'concept_agency': concept_agency,
-                'maintainableParentID': maintainableParentID,
-                'maintainableParentVersion': maintainableParentVersion,
-                'concept_class': concept_class,
-                'position': detail.attrib.get('position') if 'position' in detail.attrib else None,
-                'codelist': (detail.find('.//structure:LocalRepresentation/Ref', namespaces=NAMESPACES).attrib.get('id')
-                             if detail.find('.//structure:LocalRepresentation/Ref', namespaces=NAMESPACES) is not None else None),
-                'enum_id': enum_id,
-                'enum_version': enum_version,
-                'enum_agencyID': enum_agencyID,
-                'enum_package': enum_package,
-                'enum_class': enum_class
-            }
-            details.append(detail_row)
 
-        # Estrai i gruppi
-        for group in element.findall('.//structure:Group', namespaces=NAMESPACES):
-            group_id = group.attrib.get('id')
-            group_row = {
-                'datastructure_id': id_value,
-                'group_id': group_id,
-            }
-            groups.append(group_row)
+def copy_text_value(value):
+    """
+    Serializza un valore per COPY in formato text (NULL => \\N, escape dei separatori).
+    """
+    if value is None:
+        return '\\N'
+    return (str(value).replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').replace('\r', '\\r'))
 
-    return data, details, groups
 
+def copy_rows(cur, table_name, columns, rows):
+    """
+    Copia `rows` (tuple o dict nell'ordine di `columns`) in `table_name` con un solo COPY.
+    Restituisce il numero di righe copiate.
+    """
+    buffer = StringIO()
+    count = 0
+    for row in rows:
+        values = row.values() if isinstance(row, dict) else row
+        buffer.write('\t'.join(copy_text_value(v) for v in values))
+        buffer.write('\n')
+        count += 1
+    buffer.seek(0)
+
+    copy_sql = sql.SQL("COPY {} ({}) FROM STDIN").format(
+        sql.Identifier(table_name),
+        sql.SQL(', ').join(map(sql.Identifier, columns))
+    )
+    cur.copy_expert(copy_sql.as_string(cur), buffer)
+    return count
 
-def save_to_postgresql(data, table_name, conn):
+
+def build_merge_query(table_name, staging_name, columns, key_columns, update_columns):
     """
-    Salva (in upsert) i DataFlow o DataStructure in Postgres.
+    Costruisce l'INSERT ... SELECT ... ON CONFLICT che fonde la staging nella tabella
+    di destinazione. La query restituisce una riga (righe_distinte, inserite, scritte):
+    le righe identiche a quelle già presenti non vengono riscritte.
     """
-    print(f"Salvataggio dati in {table_name}")
-    if table_name == 'dataflow':
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS dataflow (
-            ID VARCHAR PRIMARY KEY,
-            Nome_it VARCHAR,
-            Nome_en VARCHAR,
-            ref_id VARCHAR,
-            version VARCHAR,
-            agencyID VARCHAR,
-            package VARCHAR
+    target = sql.Identifier(table_name)
+    staging = sql.Identifier(staging_name)
+    cols = sql.SQL(', ').join(map(sql.Identifier, columns))
+
+    if not key_columns:
+        return sql.SQL("""
+        WITH merged AS (
+            INSERT INTO {target} ({cols})
+            SELECT {cols} FROM {staging}
+            RETURNING 1
         )
-        """
-        insert_update_query = """
-        INSERT INTO dataflow (ID, Nome_it, Nome_en, ref_id, version, agencyID, package)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (ID) DO UPDATE SET
-            Nome_it = EXCLUDED.Nome_it,
-            Nome_en = EXCLUDED.Nome_en,
-            ref_id = EXCLUDED.ref_id,
-            version = EXCLUDED.version,
-            agencyID = EXCLUDED.agencyID,
-            package = EXCLUDED.package
-        """
-    elif table_name == 'datastructure':
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS datastructure (
-            ID VARCHAR PRIMARY KEY,
-            Nome_it VARCHAR,
-            Nome_en VARCHAR,
-            version VARCHAR,
-            agencyID VARCHAR
+        SELECT count(*), count(*), count(*) FROM merged
+        """).format(target=target, cols=cols, staging=staging)
+
+    keys = sql.SQL(', ').join(map(sql.Identifier, key_columns))
+    if update_columns:
+        set_clause = sql.SQL(', ').join(
+            sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c)) for c in update_columns
         )
-        """
-        insert_update_query = """
-        INSERT INTO datastructure (ID, Nome_it, Nome_en, version, agencyID)
-        VALUES (%s, %s, %s, %s, %s)
-        ON CONFLICT (ID) DO UPDATE SET
-            Nome_it = EXCLUDED.Nome_it,
-            Nome_en = EXCLUDED.Nome_en,
-            version = EXCLUDED.version,
-            agencyID = EXCLUDED.agencyID
-        """
+        current = sql.SQL(', ').join(
+            sql.SQL("t.{}").format(sql.Identifier(c)) for c in update_columns
+        )
+        incoming = sql.SQL(', ').join(
+            sql.SQL("EXCLUDED.{}").format(sql.Identifier(c)) for c in update_columns
+        )
+        conflict_action = sql.SQL(
+            "DO UPDATE SET {set_clause} WHERE ROW({current}) IS DISTINCT FROM ROW({incoming})"
+        ).format(set_clause=set_clause, current=current, incoming=incoming)
+    else:
+        conflict_action = sql.SQL("DO NOTHING")
+
+    return sql.SQL("""
+    WITH src AS (
+        SELECT DISTINCT ON ({keys}) {cols} FROM {staging} ORDER BY {keys}
+    ), merged AS (
+        INSERT INTO {target} AS t ({cols})
+        SELECT {cols} FROM src
+        ON CONFLICT ({keys}) {conflict_action}
+        RETURNING (xmax = 0) AS inserted
+    )
+    SELECT (SELECT count(*) FROM src),
+           count(*) FILTER (WHERE inserted),
+           count(*)
+    FROM merged
+    """).format(keys=keys, cols=cols, staging=staging, target=target,
+                conflict_action=conflict_action)
+
+
+def bulk_upsert(conn, table_name, columns, rows, key_columns=None, update_columns=None,
+                batch_size=None):
+    """
+    Scrittura set-based di `rows` (tuple o dict nell'ordine di `columns`, anche da generatore).
+    Ogni batch viene copiato con COPY in una tabella temporanea di staging e fuso nella
+    tabella di destinazione con un solo INSERT ... SELECT ... ON CONFLICT, in un'unica
+    transazione.
+    - key_columns: chiave di conflitto (None => semplice INSERT)
+    - update_columns: colonne aggiornate sul conflitto
+      (None => tutte le colonne non chiave, vuoto => DO NOTHING)
+    Un batch fallito viene ritentato (fino a BULK_MAX_RETRIES volte, dopo BULK_RETRY_DELAY
+    secondi) solo se la connessione è in autocommit: dentro una transaction() esterna il
+    batch fa parte di una transazione ormai annullata e l'errore va al chiamante. Anche una
+    connessione persa fa rilanciare l'errore (la riconnessione spetta al chiamante).
+    Restituisce un dizionario con le righe inserted/updated/unchanged.
+    """
+    batch_size = batch_size or BULK_BATCH_SIZE
+    if key_columns and update_columns is None:
+        update_columns = [c for c in columns if c not in key_columns]
+
+    staging_name = f"_stg_{table_name}"
+    merge_query = build_merge_query(table_name, staging_name, columns, key_columns, update_columns)
+    stats = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+    retry = conn.autocommit
+
+    for batch_idx, batch in enumerate(batched(rows, batch_size)):
+        retry_count = 0
+        while True:
+            try:
+                with transaction(conn), conn.cursor() as cur:
+                    cur.execute(sql.SQL(
+                        "CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                        "SELECT {cols} FROM {target} WITH NO DATA"
+                    ).format(
+                        staging=sql.Identifier(staging_name),
+                        cols=sql.SQL(', ').join(map(sql.Identifier, columns)),
+                        target=sql.Identifier(table_name)
+                    ))
+                    copy_rows(cur, staging_name, columns, batch)
+                    cur.execute(merge_query)
+                    distinct_rows, inserted, written = cur.fetchone()
+                break
+            except Exception as e:
+                retry_count += 1
+                if not retry or retry_count == BULK_MAX_RETRIES:
+                    print(f"\nErrore fatale nel batch {batch_idx + 1} di {table_name}: {e}")
+                    raise
+                print(f"\nErrore scrittura batch {batch_idx + 1} di {table_name}, "
+                      f"tentativo {retry_count}/{BULK_MAX_RETRIES}: {e}")
+                print(f"Attendo {BULK_RETRY_DELAY} secondi e riprovo...")
+                time.sleep(BULK_RETRY_DELAY)
+                try:
+                    with conn.cursor() as cur:
+                        cur.execute("SELECT 1")
+                except psycopg2.Error:
+                    print("Connessione persa, impossibile ritentare il batch.")
+                    raise e
+
+        stats['inserted'] += inserted
+        stats['updated'] += written - inserted
+        stats['unchanged'] += distinct_rows - written
 
+    print(f"{table_name}: {stats['inserted']} inserite, {stats['updated']} aggiornate, "
+          f"{stats['unchanged']} invariate")
+    return stats
+
+
+def ensure_primary_key(conn, table_name, key_columns):
+    """
+    Porta `table_name` ad avere `key_columns` come chiave primaria.
+    Per le tabelle create da versioni precedenti (id SERIAL e righe duplicate a ogni run)
+    elimina i duplicati tenendo l'ultima copia, rimuove la colonna id e aggiunge la chiave.
+    """
     with conn.cursor() as cur:
-        # Crea tabella se non esiste
-        cur.execute(create_table_query)
-        conn.commit()
+        cur.execute("""
+            SELECT array_agg(a.attname::text ORDER BY array_position(i.indkey::int2[], a.attnum))
+            FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey::int2[])
+            WHERE i.indrelid = to_regclass(quote_ident(%s)) AND i.indisprimary
+        """, (table_name,))
+        current_key = cur.fetchone()[0]
+    if current_key == list(key_columns):
+        return
 
-        # Inserisci/aggiorna
-        from tqdm import tqdm
-        with tqdm(total=len(data), desc=f"Inserimento dati in {table_name}") as pbar:
-            for row in data:
-                cur.execute(insert_update_query, tuple(row.values()))
-                pbar.update(1)
-        conn.commit()
+    print(f"Migrazione di {table_name} alla chiave ({', '.join(key_columns)})...")
+    target = sql.Identifier(table_name)
+    keys = sql.SQL(', ').join(map(sql.Identifier, key_columns))
+    with transaction(conn), conn.cursor() as cur:
+        cur.execute(sql.SQL("DELETE FROM {} WHERE {}").format(
+            target,
+            sql.SQL(' OR ').join(sql.SQL("{} IS NULL").format(sql.Identifier(c)) for c in key_columns)
+        ))
+        cur.execute(sql.SQL("""
+            DELETE FROM {target} a USING {target} b
+            WHERE a.ctid < b.ctid AND {same_key}
+        """).format(
+            target=target,
+            same_key=sql.SQL(' AND ').join(
+                sql.SQL("a.{0} = b.{0}").format(sql.Identifier(c)) for c in key_columns
+            )
+        ))
+        print(f"  {cur.rowcount} righe duplicate rimosse.")
+        cur.execute(sql.SQL("ALTER TABLE {} DROP COLUMN IF EXISTS id").format(target))
+        if current_key and 'id' not in current_key:
+            cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+                target, sql.Identifier(f"{table_name}_pkey")
+            ))
+        cur.execute(sql.SQL("ALTER TABLE {} ADD PRIMARY KEY ({})").format(target, keys))
 
 
-def save_details_to_postgresql(details, conn):
+def delete_missing_rows(conn, table_name, scope_column, scope_values, key_columns, rows):
     """
-    Salva i details in tabella dedicata (datastructure_details).
+    Elimina da `table_name` le righe che appartengono agli scope `scope_values`
+    (es. le DSD appena sincronizzate) ma la cui chiave non compare più in `rows`.
+    `rows` sono tuple nell'ordine di `key_columns`. Restituisce il numero di righe eliminate.
     """
-    print("Salvataggio dettagli in datastructure_details")
-    create_table_query = """
-    CREATE TABLE IF NOT EXISTS datastructure_details (
-        id SERIAL PRIMARY KEY,
-        datastructure_id VARCHAR,
-        type VARCHAR,
-        detail_id VARCHAR,
-        concept_id VARCHAR,
-        concept_agency VARCHAR,
-        maintainableParentID VARCHAR,
-        maintainableParentVersion VARCHAR,
-        concept_class VARCHAR,
-        position VARCHAR,
-        codelist VARCHAR,
-        enum_id VARCHAR,
-        enum_version VARCHAR,
-        enum_agencyID VARCHAR,
-        enum_package VARCHAR,
-        enum_class VARCHAR,
-        FOREIGN KEY (datastructure_id) REFERENCES datastructure(ID)
+    scope_values = list(scope_values)
+    if not scope_values:
+        return 0
+
+    key_arrays = [list(values) for values in zip(*rows)] or [[] for _ in key_columns]
+    query = sql.SQL("""
+        DELETE FROM {target} t
+        WHERE t.{scope} = ANY(%s)
+          AND ({target_keys}) NOT IN (SELECT * FROM unnest({arrays}))
+    """).format(
+        target=sql.Identifier(table_name),
+        scope=sql.Identifier(scope_column),
+        target_keys=sql.SQL(', ').join(sql.SQL("t.{}").format(sql.Identifier(c)) for c in key_columns),
+        arrays=sql.SQL(', ').join(sql.SQL("%s::text[]") for _ in key_columns)
     )
+    with conn.cursor() as cur:
+        cur.execute(query, [scope_values] + key_arrays)
+        deleted = cur.rowcount
+    conn.commit()
+    if deleted:
+        print(f"{table_name}: {deleted} righe non più presenti upstream eliminate")
+    return deleted
+
+
+# =============================================================================
+# SOSTITUZIONE ATOMICA DELLE TABELLE (caricamento in shadow + swap)
+# =============================================================================
+
+INDEXDEF_RE = re.compile(r'^CREATE (UNIQUE )?INDEX (\S+) ON (?:ONLY )?(\S+) (USING .*)$')
+
+
+def shadow_table_name(table_name):
     """
-    insert_query = """
-    INSERT INTO datastructure_details (
-        datastructure_id, type, detail_id, concept_id, concept_agency,
-        maintainableParentID, maintainableParentVersion, concept_class,
-        position, codelist, enum_id, enum_version, enum_agencyID,
-        enum_package, enum_class
-    )
-    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    Nome della tabella di appoggio in cui viene caricato `table_name` prima dello swap.
     """
+    return f"{table_name}__shadow"
 
-    # Crea tabella se non esiste
-    with conn.cursor() as cur:
-        cur.execute(create_table_query)
-        conn.commit()
 
-    # Inserisci i dettagli in batch
-    batch_size = 500
-    total = len(details)
-    total_batches = (total + batch_size - 1) // batch_size
-
-    from tqdm import tqdm
-    with tqdm(total=total, desc="Inserimento dettagli") as pbar:
-        for batch_idx in range(total_batches):
-            start_idx = batch_idx * batch_size
-            end_idx = min(start_idx + batch_size, total)
-            batch = details[start_idx:end_idx]
-
-            retry_count = 0
-            max_retries = 3
-            while retry_count < max_retries:
-                try:
-                    with conn.cursor() as cur:
-                        for detail in batch:
-                            cur.execute(insert_query, tuple(detail.values()))
-                            pbar.update(1)
-                        conn.commit()
-                    break
-                except Exception as e:
-                    retry_count += 1
-                    if retry_count == max_retries:
-                        print(f"\nErrore fatale nel batch {batch_idx + 1}/{total_batches}: {str(e)}")
-                        raise
-                    print(f"\nErrore inserimento batch {batch_idx + 1}/{total_batches}, tentativo {retry_count}/{max_retries}: {e}")
-                    print("Attendo 5 secondi e riprovo...")
-                    import time
-                    time.sleep(5)
-                    try:
-                        conn.rollback()
-                        with conn.cursor() as cur:
-                            cur.execute("SELECT 1")
-                    except Exception:
-                        print("Connessione persa. Riconnessione in corso...")
-                        conn = connect_to_database()
-
-    print("\nSalvataggio dettagli completato.")
-    return True
-
-
-def save_groups_to_postgresql(groups, conn):
-    """
-    Salva i group in tabella dedicata (datastructure_groups).
+def get_dependent_views(cur, table_name):
     """
-    print("Salvataggio gruppi in datastructure_groups")
-    create_table_query = """
-    CREATE TABLE IF NOT EXISTS datastructure_groups (
-        id SERIAL PRIMARY KEY,
-        datastructure_id VARCHAR,
-        group_id VARCHAR,
-        FOREIGN KEY (datastructure_id) REFERENCES datastructure(ID)
-    )
+    Viste e viste materializzate che dipendono (anche indirettamente) da `table_name`,
+    in ordine di ricreazione. Per ognuna: schema, nome, tipo ('v' o 'm'), definizione,
+    indici (solo per le materializzate) e privilegi.
+    """
+    cur.execute("""
+        WITH RECURSIVE deps AS (
+            SELECT DISTINCT r.ev_class AS oid, 1 AS depth
+            FROM pg_depend d
+            JOIN pg_rewrite r ON r.oid = d.objid
+            WHERE d.classid = 'pg_rewrite'::regclass
+              AND d.refobjid = to_regclass(quote_ident(%s))
+              AND r.ev_class <> d.refobjid
+            UNION
+            SELECT DISTINCT r.ev_class, deps.depth + 1
+            FROM deps
+            JOIN pg_depend d ON d.refobjid = deps.oid AND d.classid = 'pg_rewrite'::regclass
+            JOIN pg_rewrite r ON r.oid = d.objid
+            WHERE r.ev_class <> deps.oid
+        )
+        SELECT c.oid, n.nspname, c.relname, c.relkind, pg_get_viewdef(c.oid, true),
+               ARRAY(SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i WHERE i.indrelid = c.oid)
+        FROM deps
+        JOIN pg_class c ON c.oid = deps.oid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        GROUP BY c.oid, n.nspname, c.relname, c.relkind
+        ORDER BY max(deps.depth), c.relname
+    """, (table_name,))
+    views = []
+    for oid, schema, name, kind, definition, indexes in cur.fetchall():
+        views.append({
+            'schema': schema, 'name': name, 'kind': kind, 'definition': definition,
+            'indexes': indexes, 'grants': get_grant_statements(cur, oid, schema, name)
+        })
+    return views
+
+
+def get_grant_statements(cur, oid, schema, name):
+    """
+    Istruzioni GRANT che riproducono i privilegi della relazione `oid`.
+    """
+    cur.execute("""
+        SELECT CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(r.rolname) END, a.privilege_type
+        FROM pg_class c, aclexplode(c.relacl) a
+        LEFT JOIN pg_roles r ON r.oid = a.grantee
+        WHERE c.oid = %s AND a.grantee <> c.relowner
+    """, (oid,))
+    return [
+        sql.SQL("GRANT {} ON {} TO {}").format(
+            sql.SQL(privilege), sql.Identifier(schema, name), sql.SQL(grantee)
+        )
+        for grantee, privilege in cur.fetchall()
+    ]
+
+
+def build_shadow_indexes(conn, table_name, shadow_name):
     """
-    insert_query = """
-    INSERT INTO datastructure_groups (datastructure_id, group_id)
-    VALUES (%s, %s)
+    Ricrea sulla tabella shadow gli indici (non legati a vincoli) della tabella attuale
+    e la analizza. Restituisce [(nome indice shadow, nome definitivo)] da rinominare dopo lo swap.
+    Gli indici non più applicabili (es. colonna scomparsa) vengono segnalati e saltati.
     """
+    renames = []
     with conn.cursor() as cur:
-        cur.execute(create_table_query)
-        conn.commit()
+        cur.execute("""
+            SELECT c.relname, pg_get_indexdef(i.indexrelid)
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE i.indrelid = to_regclass(quote_ident(%s))
+              AND NOT EXISTS (SELECT 1 FROM pg_constraint k WHERE k.conindid = i.indexrelid)
+            ORDER BY c.relname
+        """, (table_name,))
+        indexes = cur.fetchall()
+
+    for position, (index_name, index_def) in enumerate(indexes):
+        match = INDEXDEF_RE.match(index_def)
+        if not match:
+            continue
+        shadow_index = f"{shadow_name}_idx{position}"
+        query = sql.SQL("CREATE {}INDEX {} ON {} {}").format(
+            sql.SQL(match.group(1) or ''), sql.Identifier(shadow_index),
+            sql.Identifier(shadow_name), sql.SQL(match.group(4))
+        )
+        try:
+            with transaction(conn), conn.cursor() as cur:
+                cur.execute(query)
+            renames.append((shadow_index, index_name))
+        except psycopg2.Error as e:
+            print(f"Indice {index_name} non ricreato su {shadow_name}: {e}")
 
-        from tqdm import tqdm
-        with tqdm(total=len(groups), desc="Inserimento gruppi") as pbar:
-            for group in groups:
-                cur.execute(insert_query, tuple(group.values()))
-                pbar.update(1)
-        conn.commit()
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(shadow_name)))
+    return renames
 
 
-def execute_part1(conn):
+def recreate_views(cur, views):
     """
-    Esecuzione Parte 1: Scaricamento e inserimento dei Dataflow e Datastructure
+    Ricrea le viste catturate con get_dependent_views (nello stesso ordine), con i loro
+    indici e privilegi. Le viste materializzate sono ricreate WITH NO DATA: calcolarle qui
+    terrebbe il lock esclusivo dello swap per tutta la query, swap_shadow_table le popola
+    subito dopo il commit.
+    Una vista non più valida sulla nuova tabella viene saltata (savepoint) e segnalata.
+    Restituisce i nomi delle viste ricreate.
     """
-    print("\nEsecuzione Parte 1: Scaricamento e inserimento dei Dataflow e Datastructure")
-    dataflow_url = 'https://esploradati.istat.it/SDMXWS/rest/dataflow/IT1/ALL/latest'
-    datastructure_url = 'https://esploradati.istat.it/SDMXWS/rest/datastructure/IT1/ALL/latest'
-
-    print("Scaricamento Dataflow...")
-    dataflow_root = download_and_parse_xml(dataflow_url)
-    print("Scaricamento Datastructure...")
-    datastructure_root = download_and_parse_xml(datastructure_url)
+    recreated = []
+    for view in views:
+        target = sql.Identifier(view['schema'], view['name'])
+        create = ("CREATE MATERIALIZED VIEW {} AS {} WITH NO DATA" if view['kind'] == 'm'
+                  else "CREATE VIEW {} AS {}")
+        cur.execute("SAVEPOINT recreate_view")
+        try:
+            cur.execute(sql.SQL(create).format(target, sql.SQL(view['definition'].rstrip().rstrip(';'))))
+            for index_def in view['indexes']:
+                cur.execute(index_def)
+            for grant in view['grants']:
+                cur.execute(grant)
+            cur.execute("RELEASE SAVEPOINT recreate_view")
+            recreated.append(view['name'])
+        except psycopg2.Error as e:
+            cur.execute("ROLLBACK TO SAVEPOINT recreate_view")
+            print(f"Vista {view['name']} non ricreata dopo lo swap: {e}")
+    return recreated
+
+
+def swap_shadow_table(conn, table_name, shadow_name, index_renames=()):
+    """
+    Sostituisce `table_name` con `shadow_name` in un'unica transazione breve:
+    cattura le viste dipendenti, elimina la vecchia tabella, rinomina shadow e indici e
+    ricrea le viste. I lettori vedono la vecchia tabella fino al commit, poi la nuova.
+    Le viste materializzate dipendenti, ricreate vuote, sono aggiornate subito dopo il
+    commit (in ordine di dipendenza): il REFRESH ne blocca la lettura, senza errori.
+    Sia la relazione attuale sia la shadow possono essere anche viste (layout a dizionario).
+    """
+    start = time.perf_counter()
+    with transaction(conn), conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.oid, n.nspname, c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE c.oid = to_regclass(quote_ident(%s))
+        """, (table_name,))
+        current = cur.fetchone()
+        views, grants = [], []
+        if current:
+            views = get_dependent_views(cur, table_name)
+            grants = get_grant_statements(cur, current[0], current[1], table_name)
+            drop = {'v': "DROP VIEW {} CASCADE", 'm': "DROP MATERIALIZED VIEW {} CASCADE"}
+            cur.execute(sql.SQL(drop.get(current[2], "DROP TABLE {} CASCADE")).format(
+                sql.Identifier(table_name)))
+        cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+            sql.Identifier(shadow_name), sql.Identifier(table_name)
+        ))
+        for shadow_index, index_name in index_renames:
+            cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                sql.Identifier(shadow_index), sql.Identifier(index_name)
+            ))
+        for grant in grants:
+            cur.execute(grant)
+        recreated = recreate_views(cur, views)
 
-    print("Estrazione dati da Dataflow...")
-    dataflow_data = extract_data_from_dataflow(dataflow_root)
+    elapsed = time.perf_counter() - start
+    detail = f", viste ricreate: {', '.join(recreated)}" if recreated else ""
+    print(f"Swap di {table_name} completato in {elapsed * 1000:.0f} ms{detail}")
 
-    print("Estrazione dati da Datastructure...")
-    datastructure_data, datastructure_details, datastructure_groups = extract_data_from_datastructure(datastructure_root)
+    for view in views:
+        if view['kind'] == 'm' and view['name'] in recreated:
+            try:
+                refresh_materialized_view(conn, view['name'])
+            except psycopg2.Error as e:
+                print(f"Vista materializzata {view['name']} non aggiornata dopo lo swap: {e}")
 
-    # Salva i dati
-    save_to_postgresql(dataflow_data, 'dataflow', conn)
-    save_to_postgresql(datastructure_data, 'datastructure', conn)
-    save_details_to_postgresql(datastructure_details, conn)
-    save_groups_to_postgresql(datastructure_groups, conn)
-    print("Parte 1 completata.\n")
 
 # =============================================================================
-# PARTE 1-BIS: Popola le categorie e crea la mappatura Dataflow-Categorie
+# CACHE HTTP (richieste condizionali ETag / Last-Modified)
 # =============================================================================
 
-def extract_categories(root):
+def get_cache_max_age(url):
     """
-    Estrae le categorie (id, name_it, name_en) dal CategoryScheme XML.
+    Restituisce il max-age configurato in HTTP_CACHE_MAX_AGE per `url` (None se assente).
     """
-    categories = {}
-    total_categories_found = 0
-    for category_scheme in root.findall('.//structure:CategoryScheme', namespaces=NAMESPACES):
-        for category in category_scheme.findall('.//structure:Category', namespaces=NAMESPACES):
-            total_categories_found += 1
-            cat_id = category.attrib.get('id')
-            name_it_elem = category.find('.//common:Name[@xml:lang="it"]', namespaces=NAMESPACES)
-            name_en_elem = category.find('.//common:Name[@xml:lang="en"]', namespaces=NAMESPACES)
+    for pattern, max_age in HTTP_CACHE_MAX_AGE.items():
+        if pattern in url:
+            return max_age
+    return None
 
-            categories[cat_id] = {
-                'name_it': name_it_elem.text if name_it_elem is not None else None,
-                'name_en': name_en_elem.text if name_en_elem is not None else None
-            }
-    print(f"Numero totale categorie trovate: {total_categories_found}")
-    return categories
+
+def cache_entry_path(url, headers=None):
+    """
+    Percorso del file indice che descrive la risposta in cache per `url`
+    (la chiave include gli header che cambiano la rappresentazione, es. Accept).
+    """
+    key = url + ''.join(f"\n{k}: {v}" for k, v in sorted((headers or {}).items()))
+    return os.path.join(HTTP_CACHE_DIR, 'index', hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
 
 
-def populate_categories(conn):
+def cache_object_path(digest):
     """
-    Scarica lo schema categorie e popola la tabella 'categories'.
+    Percorso del body in cache, indirizzato per contenuto (sha256 del body decompresso);
+    con RAW_COMPRESSION l'oggetto è salvato in gzip.
     """
-    url = 'https://esploradati.istat.it/SDMXWS/rest/categoryscheme/IT1/ALL/latest'
-    print("Scaricamento categorie da ISTAT...")
+    path = os.path.join(HTTP_CACHE_DIR, 'objects', digest[:2], digest)
+    return f"{path}.gz" if RAW_COMPRESSION else path
 
-    root = download_and_parse_xml(url)
-    categories = extract_categories(root)
 
-    print(f"Salvataggio di {len(categories)} categorie nel database.")
+def write_json_atomic(path, data):
+    """
+    Scrive `data` in JSON su `path` tramite file temporaneo + rename.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(fd, 'w', encoding='utf-8') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
 
-    with conn.cursor() as cur:
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS categories (
-            category_id VARCHAR PRIMARY KEY,
-            name_it VARCHAR,
-            name_en VARCHAR
-        )
-        """
-        cur.execute(create_table_query)
-        conn.commit()
 
-        insert_query = """
-        INSERT INTO categories (category_id, name_it, name_en)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (category_id) DO NOTHING
-        """
-        for cat_id, cat_data in categories.items():
-            cur.execute(insert_query, (cat_id, cat_data['name_it'], cat_data['name_en']))
-        conn.commit()
+def store_cache_object(response):
+    """
+    Salva il body di `response` nella cache calcolandone lo sha256 durante lo streaming
+    (compresso con RAW_COMPRESSION). Restituisce (digest, byte del body decompresso).
+    """
+    objects_dir = os.path.join(HTTP_CACHE_DIR, 'objects')
+    os.makedirs(objects_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=objects_dir, suffix='.part.gz' if RAW_COMPRESSION else '.part')
+    os.close(fd)
+    try:
+        with open_raw_file(tmp_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=RAW_IO_BUFFER_SIZE):
+                digest.update(chunk)
+                f.write(chunk)
+                size += len(chunk)
+        object_path = cache_object_path(digest.hexdigest())
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        os.replace(tmp_path, object_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return digest.hexdigest(), size
+
 
-    print(f"{len(categories)} categorie inserite correttamente.")
+def load_cache_entry(url, headers=None):
+    """
+    Voce della cache HTTP per `url` (con gli header indicati), None se assente o se
+    il body non è più in cache.
+    """
+    entry_path = cache_entry_path(url, headers)
+    if not os.path.exists(entry_path):
+        return None
+    with open(entry_path, 'r', encoding='utf-8') as f:
+        entry = json.load(f)
+    return entry if os.path.exists(cache_object_path(entry['digest'])) else None
 
 
-def execute_category_mapping(conn):
+def fetch_cached(url, headers=None, max_age=None, max_retries=3, timeout=30):
     """
-    Crea la mappatura dataflow->categoria nella tabella dataflow_categories,
-    usando prefissi (prima dell'underscore).
+    Scarica `url` passando dalla cache HTTP su disco e restituisce il percorso del body.
+    - entro il max-age (parametro o HTTP_CACHE_MAX_AGE) la copia locale è usata senza richiesta;
+    - altrimenti invia If-None-Match / If-Modified-Since e su 304 usa la copia locale;
+    - su 200 salva il nuovo body (content-addressed) e aggiorna ETag/Last-Modified.
+    Se ISTAT non risponde ma esiste una copia locale, la usa segnalandolo; in OFFLINE_MODE
+    la copia locale è usata sempre.
+    Restituisce None se il download fallisce e non c'è nulla in cache.
     """
-    print("Esecuzione mappatura categorie...")
+    entry_path = cache_entry_path(url, headers)
+    entry = load_cache_entry(url, headers)
+    if OFFLINE_MODE:
+        if entry is None:
+            print(f"Modalità offline: nessuna copia in cache per {url}")
+            return None
+        return cache_object_path(entry['digest'])
+
+    if max_age is None:
+        max_age = get_cache_max_age(url)
+    if entry and max_age is not None and time.time() - entry['fetched_at'] < max_age:
+        print(f"Cache HTTP valida (max-age {max_age}s), nessuna richiesta per {url}")
+        return cache_object_path(entry['digest'])
+
+    request_headers = dict(headers or {})
+    if entry and entry.get('etag'):
+        request_headers['If-None-Match'] = entry['etag']
+    if entry and entry.get('last_modified'):
+        request_headers['If-Modified-Since'] = entry['last_modified']
+
+    for attempt in range(max_retries):
+        try:
+            response = http_get(url, headers=request_headers, stream=True, timeout=timeout)
+            if response.status_code == 304 and entry:
+                print(f"Risorsa non modificata (304), uso la cache per {url}")
+                entry['fetched_at'] = time.time()
+                write_json_atomic(entry_path, entry)
+                return cache_object_path(entry['digest'])
+
+            if response.status_code == 200:
+                digest, size = store_cache_object(response)
+                write_json_atomic(entry_path, {
+                    'url': url,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'digest': digest,
+                    'size': size,
+                    'fetched_at': time.time()
+                })
+                return cache_object_path(digest)
+
+            if response.status_code >= 500 and attempt < max_retries - 1:
+                wait_time = 2 ** attempt
+                print(f"Errore del server (HTTP {response.status_code}). Ritento in {wait_time} secondi...")
+                time.sleep(wait_time)
+                continue
+
+            print(f"Errore nel download: HTTP {response.status_code}")
+            if response.text:
+                print(f"Dettagli errore: {response.text[:200]}...")
+            break
+        except requests.exceptions.Timeout:
+            if attempt < max_retries - 1:
+                print(f"Timeout. Riprovo {attempt + 2}/{max_retries}...")
+                continue
+            print(f"Timeout dopo {max_retries} tentativi.")
+        except requests.exceptions.RequestException as e:
+            print(f"Errore download: {str(e)}")
+            break
+
+    if entry:
+        print(f"Uso la copia in cache (non aggiornata) per {url}")
+        return cache_object_path(entry['digest'])
+    return None
+
+
+# =============================================================================
+# DOWNLOAD RIPRENDIBILI (file .part + Range / If-Range)
+# =============================================================================
+
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+|\*)$')
+
+
+def download_backoff(attempt):
+    """
+    Attesa (secondi) prima del tentativo successivo al numero `attempt` (da 0):
+    DOWNLOAD_BACKOFF_BASE * 2^attempt, al più DOWNLOAD_BACKOFF_MAX.
+    """
+    return min(DOWNLOAD_BACKOFF_MAX, DOWNLOAD_BACKOFF_BASE * 2 ** attempt)
+
+
+def parse_digest_header(headers):
+    """
+    sha256 (esadecimale) dichiarato dal server negli header Repr-Digest o Digest, None se assente.
+    """
+    for name in ('Repr-Digest', 'Digest'):
+        for item in (headers.get(name) or '').split(','):
+            algorithm, _, value = item.strip().partition('=')
+            if algorithm.lower() == 'sha-256' and value:
+                try:
+                    return base64.b64decode(value.strip(':')).hex()
+                except ValueError:
+                    return None
+    return None
+
+
+def file_sha256(path):
+    """
+    sha256 (esadecimale) dei byte del file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb', buffering=0) as f:
+        for chunk in iter(lambda: f.read(RAW_IO_BUFFER_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_part_state(part_path, url):
+    """
+    Stato del download parziale di `url` (file <part>.json) se il .part può essere ripreso:
+    stesso URL e un validatore forte (ETag non debole o Last-Modified) per If-Range.
+    Altrimenti elimina il .part e restituisce None.
+    """
+    state_path = f"{part_path}.json"
+    state = None
+    if os.path.exists(part_path) and os.path.exists(state_path):
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        if state.get('url') != url or not state.get('validator'):
+            state = None
+    if state is None:
+        for path in (part_path, state_path):
+            if os.path.exists(path):
+                os.remove(path)
+    return state
+
+
+def finalize_part_file(part_path, file_path, content_encoding):
+    """
+    Sposta il .part completo (byte così come trasferiti) in `file_path`: se la codifica del
+    trasferimento coincide con quella del file (gzip per i .gz) basta un rename, altrimenti
+    il body viene decodificato da urllib3 e riscritto con open_raw_file.
+    """
+    content_encoding = (content_encoding or 'identity').lower()
+    compressed = file_path.endswith('.gz')
+    if (content_encoding == 'gzip' and compressed) or (content_encoding == 'identity' and not compressed):
+        os.replace(part_path, file_path)
+        return
+
+    tmp_path = os.path.join(os.path.dirname(file_path), f".{os.path.basename(file_path)}")
+    with open(part_path, 'rb') as body, open_raw_file(tmp_path, 'wb') as out:
+        raw = urllib3.HTTPResponse(body=body, headers={'Content-Encoding': content_encoding},
+                                   preload_content=False, decode_content=True)
+        for chunk in raw.stream(RAW_IO_BUFFER_SIZE):
+            out.write(chunk)
+    os.replace(tmp_path, file_path)
+    os.remove(part_path)
+
+
+def download_resumable(url, file_path, give_up_statuses=(500,), max_retries=None, desc=None):
+    """
+    Scarica `url` in `file_path` in modo riprendibile. I byte ricevuti (così come trasferiti,
+    gzip compreso) restano in <file>.part, descritto da <file>.part.json (URL, validatore,
+    lunghezza, codifica). Un trasferimento interrotto — anche in un'esecuzione successiva —
+    riparte con Range / If-Range dall'ultimo byte ricevuto; se il server non supporta i range
+    o la risorsa è cambiata risponde 200 e si riparte da zero.
+    A fine download lunghezza e sha256 (se il server invia Digest / Repr-Digest) sono
+    verificati: un file non valido viene scartato e riscaricato.
+    I tentativi senza progressi sono al più `max_retries` (default DOWNLOAD_MAX_RETRIES),
+    separati da attese esponenziali (download_backoff): è un progresso solo una ripresa 206
+    che porta l'offset oltre quello precedente, non un trasferimento ripartito da zero.
+    Restituisce lo stato HTTP finale: 200 se il file è completo, uno stato di
+    `give_up_statuses` senza altri tentativi, None se i tentativi sono esauriti.
+    """
+    max_retries = max_retries or DOWNLOAD_MAX_RETRIES
+    part_path = f"{file_path}.part"
+    state_path = f"{part_path}.json"
+    failures = 0
+
+    while failures < max_retries:
+        state = load_part_state(part_path, url)
+        offset = os.path.getsize(part_path) if state else 0
+        headers = {'Range': f"bytes={offset}-", 'If-Range': state['validator']} if offset else {}
+        received = 0
+        resumed = False
+        try:
+            response = http_get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT)
+            if response.status_code in give_up_statuses:
+                return response.status_code
+
+            if response.status_code == 416 and state and state.get('length') == offset:
+                print(f"Download di {os.path.basename(file_path)} già completo.")
+            else:
+                match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+                if response.status_code == 206 and match and int(match.group(1)) == offset:
+                    print(f"Ripresa del download di {os.path.basename(file_path)} da {offset} byte")
+                    mode = 'ab'
+                    resumed = True
+                else:
+                    response.raise_for_status()
+                    if response.status_code == 206:
+                        raise requests.exceptions.HTTPError(
+                            f"Content-Range inatteso: {response.headers.get('Content-Range')}")
+                    etag = response.headers.get('ETag')
+                    length = response.headers.get('Content-Length')
+                    state = {
+                        'url': url,
+                        'validator': etag if etag and not etag.startswith('W/') else response.headers.get('Last-Modified'),
+                        'length': int(length) if length else None,
+                        'content_encoding': response.headers.get('Content-Encoding'),
+                        'sha256': parse_digest_header(response.headers),
+                    }
+                    write_json_atomic(state_path, state)
+                    offset = 0
+                    mode = 'wb'
+
+                with open(part_path, mode, buffering=RAW_IO_BUFFER_SIZE) as f, \
+                        tqdm(total=state['length'], initial=offset, unit='iB', unit_scale=True,
+                             desc=desc or f"Downloading {os.path.basename(file_path)}") as t:
+                    for chunk in response.raw.stream(RAW_IO_BUFFER_SIZE, decode_content=False):
+                        f.write(chunk)
+                        received += len(chunk)
+                        t.update(len(chunk))
+
+            # Un file scartato conta come tentativo fallito anche se sono arrivati byte
+            size = os.path.getsize(part_path)
+            if state['length'] is not None and size != state['length']:
+                if size > state['length']:
+                    os.remove(part_path)
+                    received = 0
+                raise requests.exceptions.ConnectionError(
+                    f"download incompleto ({size}/{state['length']} byte)")
+            if state['sha256'] and file_sha256(part_path) != state['sha256']:
+                os.remove(part_path)
+                received = 0
+                raise requests.exceptions.ConnectionError("sha256 diverso dal Digest del server")
+
+            finalize_part_file(part_path, file_path, state['content_encoding'])
+            os.remove(state_path)
+            return 200
+
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            # Un server senza Range che cade a metà riparte sempre da zero: non è un progresso
+            if not (resumed and received):
+                failures += 1
+            print(f"Errore download {os.path.basename(file_path)} ({failures}/{max_retries} "
+                  f"tentativi senza progressi): {str(e)}")
+            if failures < max_retries:
+                wait_time = download_backoff(failures)
+                print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
+                time.sleep(wait_time)
+
+    return None
+
+
+# =============================================================================
+# PARTE 1: Scarica Dataflow e Datastructure
+# =============================================================================
+
+def parse_xml_file(path):
+    """
+    Legge un file XML salvato su disco (anche .gz) e restituisce l'elemento root.
+    """
+    with open_raw_file(path) as f:
+        return ET.parse(f).getroot()
+
+
+def download_and_parse_xml(url, max_retries=3, timeout=30):
+    """
+    Scarica il file XML dall'URL e restituisce l'elemento root di ElementTree.
+    Implementa retry in caso di errori temporanei.
+    Con HTTP_CACHE_ENABLED la risposta passa dalla cache HTTP su disco.
+    """
+    import time
+
+    if HTTP_CACHE_ENABLED:
+        path = fetch_cached(url, max_retries=max_retries, timeout=timeout)
+        if path is None:
+            sys.exit(1)
+        try:
+            return parse_xml_file(path)
+        except ET.ParseError as e:
+            print(f"Errore parsing XML: {str(e)}")
+            sys.exit(1)
+
+    for attempt in range(max_retries):
+        try:
+            response = http_get(url, timeout=timeout)
+            if response.status_code == 200:
+                return ET.fromstring(response.content)
+            elif response.status_code >= 500:
+                if attempt < max_retries - 1:
+                    wait_time = 2 ** attempt  
+                    print(f"Errore del server (HTTP {response.status_code}). Ritento in {wait_time} secondi...")
+                    time.sleep(wait_time)
+                    continue
+            print(f"Errore nel download: HTTP {response.status_code}")
+            if response.text:
+                print(f"Dettagli errore: {response.text[:200]}...")
+            sys.exit(1)
+        except requests.exceptions.Timeout:
+            if attempt < max_retries - 1:
+                print(f"Timeout. Riprovo {attempt + 2}/{max_retries}...")
+                continue
+            print(f"Timeout dopo {max_retries} tentativi.")
+            sys.exit(1)
+        except requests.exceptions.RequestException as e:
+            print(f"Errore download: {str(e)}")
+            sys.exit(1)
+        except ET.ParseError as e:
+            print(f"Errore parsing XML: {str(e)}")
+            sys.exit(1)
+
+
+def open_xml_stream(url, max_retries=3, timeout=30):
+    """
+    Apre la risposta HTTP in streaming e restituisce il body come file-like
+    (già decompresso), da consumare con iterparse senza bufferizzare il messaggio.
+    Implementa retry in caso di errori temporanei.
+    Con HTTP_CACHE_ENABLED il body viene scritto in streaming nella cache HTTP
+    (o servito da essa su 304) e letto dal file.
+    Il chiamante ne diventa proprietario: iterparse_elements lo chiude a fine lettura.
+    """
+    import time
+
+    if HTTP_CACHE_ENABLED:
+        path = fetch_cached(url, max_retries=max_retries, timeout=timeout)
+        if path is None:
+            sys.exit(1)
+        return open_raw_file(path)
+
+    for attempt in range(max_retries):
+        try:
+            response = http_get(url, timeout=timeout, stream=True)
+            if response.status_code == 200:
+                response.raw.decode_content = True
+                return response.raw
+            elif response.status_code >= 500:
+                if attempt < max_retries - 1:
+                    wait_time = 2 ** attempt
+                    print(f"Errore del server (HTTP {response.status_code}). Ritento in {wait_time} secondi...")
+                    time.sleep(wait_time)
+                    continue
+            print(f"Errore nel download: HTTP {response.status_code}")
+            if response.text:
+                print(f"Dettagli errore: {response.text[:200]}...")
+            sys.exit(1)
+        except requests.exceptions.Timeout:
+            if attempt < max_retries - 1:
+                print(f"Timeout. Riprovo {attempt + 2}/{max_retries}...")
+                continue
+            print(f"Timeout dopo {max_retries} tentativi.")
+            sys.exit(1)
+        except requests.exceptions.RequestException as e:
+            print(f"Errore download: {str(e)}")
+            sys.exit(1)
+
+
+def iterparse_elements(source, tags):
+    """
+    Itera (con iterparse) sugli elementi structure:<tag> man mano che vengono chiusi.
+    Ogni elemento restituito è completo; dopo l'uso viene rimosso dal padre,
+    così in memoria resta solo il sotto-albero corrente.
+    Un messaggio malformato solleva ET.ParseError, gestito dal chiamante.
+    `source` (file o body HTTP di open_xml_stream) viene chiuso a fine lettura,
+    anche se il generatore non è consumato del tutto.
+    """
+    wanted = {f"{{{NAMESPACES['structure']}}}{tag}" for tag in tags}
+    parents = []
+    open_matches = 0
+    try:
+        for event, elem in ET.iterparse(source, events=('start', 'end')):
+            if event == 'start':
+                parents.append(elem)
+                if elem.tag in wanted:
+                    open_matches += 1
+                continue
+
+            parents.pop()
+            if elem.tag in wanted:
+                open_matches -= 1
+                if open_matches == 0:
+                    yield elem
+                    elem.clear()
+                    if parents:
+                        parents[-1].remove(elem)
+            elif open_matches == 0 and parents:
+                # Elementi fuori dai tag richiesti (Header, contenitori): non servono
+                parents[-1].remove(elem)
+    except ET.ParseError as e:
+        print(f"Errore parsing XML: {str(e)}")
+        raise
+    finally:
+        source.close()
+
+
+def parse_dataflow_element(element):
+    """
+    Estrae il record di un singolo elemento structure:Dataflow.
+    """
+    id_value = element.attrib.get('id')
+    agencyID_value = element.attrib.get('agencyID')
+    version_value = element.attrib.get('version')
+
+    ref_element = element.find('.//structure:Structure/Ref', namespaces=NAMESPACES)
+    if ref_element is not None:
+        ref_id_value = ref_element.attrib.get('id')
+        package_value = ref_element.attrib.get('package')
+    else:
+        ref_id_value = None
+        package_value = None
+
+    name_it_element = element.find('.//common:Name[@xml:lang="it"]', namespaces=NAMESPACES)
+    name_it_value = name_it_element.text if name_it_element is not None else None
+
+    name_en_element = element.find('.//common:Name[@xml:lang="en"]', namespaces=NAMESPACES)
+    name_en_value = name_en_element.text if name_en_element is not None else None
+
+    return {
+        'ID': id_value,
+        'Nome_it': name_it_value,
+        'Nome_en': name_en_value,
+        'ref_id': ref_id_value,
+        'version': version_value,
+        'agencyID': agencyID_value,
+        'package': package_value
+    }
+
+
+def extract_data_from_dataflow(root):
+    """
+    Estrae i Dataflow dal file XML.
+    """
+    return [parse_dataflow_element(element)
+            for element in root.findall('.//structure:Dataflow', namespaces=NAMESPACES)]
+
+
+def parse_datastructure_element(element):
+    """
+    Estrae da un singolo elemento structure:DataStructure il record della DSD,
+    i suoi Details (Dimension, Attribute, Measure) e i suoi Groups.
+    """
+    id_value = element.attrib.get('id')
+    agencyID_value = element.attrib.get('agencyID')
+    version_value = element.attrib.get('version')
+
+    name_it_element = element.find('.//common:Name[@xml:lang="it"]', namespaces=NAMESPACES)
+    name_it_value = name_it_element is not None and name_it_element.text or None
+
+    name_en_element = element.find('.//common:Name[@xml:lang="en"]', namespaces=NAMESPACES)
+    name_en_value = name_en_element is not None and name_en_element.text or None
+
+    row = {
+        'ID': id_value,
+        'Nome_it': name_it_value,
+        'Nome_en': name_en_value,
+        'version': version_value,
+        'agencyID': agencyID_value
+    }
+
+    # Estrai i dettagli (Dimension, Attribute, Measure): solo i figli diretti delle liste,
+    # non i riferimenti <structure:Dimension><Ref/> dentro AttributeRelationship
+    details = []
+    for detail in (element.findall(DSD_COMPONENTS_PATH + '/structure:DimensionList/structure:Dimension',
+                                   namespaces=NAMESPACES) +
+                   element.findall(DSD_COMPONENTS_PATH + '/structure:AttributeList/structure:Attribute',
+                                   namespaces=NAMESPACES) +
+                   element.findall(DSD_COMPONENTS_PATH + '/structure:MeasureList/structure:Measure',
+                                   namespaces=NAMESPACES)):
+        detail_id = detail.attrib.get('id')
+        if detail_id is None:
+            continue
+
+        concept_ref = detail.find('.//structure:ConceptIdentity/Ref', namespaces=NAMESPACES)
+        concept_id = concept_ref.attrib.get('id') if concept_ref is not None else None
+        concept_agency = concept_ref.attrib.get('agencyID') if concept_ref is not None else None
+        maintainableParentID = concept_ref.attrib.get('maintainableParentID') if concept_ref is not None else None
+        maintainableParentVersion = concept_ref.attrib.get('maintainableParentVersion') if concept_ref is not None else None
+        concept_class = concept_ref.attrib.get('class') if concept_ref is not None else None
+
+        local_representation = detail.find('.//structure:LocalRepresentation/structure:Enumeration/Ref', namespaces=NAMESPACES)
+        if local_representation is not None:
+            enum_id = local_representation.attrib.get('id')
+            enum_version = local_representation.attrib.get('version')
+            enum_agencyID = local_representation.attrib.get('agencyID')
+            enum_package = local_representation.attrib.get('package')
+            enum_class = local_representation.attrib.get('class')
+        else:
+            enum_id = None
+            enum_version = None
+            enum_agencyID = None
+            enum_package = None
+            enum_class = None
+
+        codelist_ref = detail.find('.//structure:LocalRepresentation/Ref', namespaces=NAMESPACES)
+
+        detail_row = {
+            'datastructure_id': id_value,
+            'type': detail.tag.split('}')[-1],  # es. "Dimension"/"Attribute"/"Measure"
+            'detail_id': detail_id,
+            'concept_id': concept_id,
+            'concept_agency': concept_agency,
+            'maintainableParentID': maintainableParentID,
+            'maintainableParentVersion': maintainableParentVersion,
+            'concept_class': concept_class,
+            'position': detail.attrib.get('position') if 'position' in detail.attrib else None,
+            'codelist': codelist_ref.attrib.get('id') if codelist_ref is not None else None,
+            'enum_id': enum_id,
+            'enum_version': enum_version,
+            'enum_agencyID': enum_agencyID,
+            'enum_package': enum_package,
+            'enum_class': enum_class
+        }
+        details.append(detail_row)
+
+    # Estrai i gruppi (come sopra, esclusi i riferimenti <structure:Group><Ref/>)
+    groups = []
+    for group in element.findall(DSD_COMPONENTS_PATH + '/structure:Group', namespaces=NAMESPACES):
+        group_id = group.attrib.get('id')
+        if group_id is None:
+            continue
+        group_row = {
+            'datastructure_id': id_value,
+            'group_id': group_id,
+        }
+        groups.append(group_row)
+
+    return row, details, groups
+
+
+def extract_data_from_datastructure(root):
+    """
+    Estrae i DataStructure, i Details e i Groups dal file XML.
+    """
+    data = []
+    details = []
+    groups = []
+    for element in root.findall('.//structure:DataStructure', namespaces=NAMESPACES):
+        row, element_details, element_groups = parse_datastructure_element(element)
+        data.append(row)
+        details.extend(element_details)
+        groups.extend(element_groups)
+
+    return data, details, groups
+
+
+def iter_dataflow_records(source):
+    """
+    Generatore: restituisce un record per ogni Dataflow letto in streaming da `source`.
+    """
+    for element in iterparse_elements(source, ('Dataflow',)):
+        yield parse_dataflow_element(element)
+
+
+def iter_datastructure_records(source):
+    """
+    Generatore: per ogni DataStructure letta in streaming da `source`
+    restituisce la tupla (record DSD, details, groups).
+    """
+    for element in iterparse_elements(source, ('DataStructure',)):
+        yield parse_datastructure_element(element)
+
+
+def save_to_postgresql(data, table_name, conn):
+    """
+    Salva (in upsert bulk) i DataFlow o DataStructure in Postgres.
+    `data` può essere una lista o un generatore di record.
+    """
+    print(f"Salvataggio dati in {table_name}")
+    if table_name == 'dataflow':
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS dataflow (
+            ID VARCHAR PRIMARY KEY,
+            Nome_it VARCHAR,
+            Nome_en VARCHAR,
+            ref_id VARCHAR,
+            version VARCHAR,
+            agencyID VARCHAR,
+            package VARCHAR,
+            content_hash VARCHAR
+        )
+        """
+        columns = ['id', 'nome_it', 'nome_en', 'ref_id', 'version', 'agencyid', 'package', 'content_hash']
+    elif table_name == 'datastructure':
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS datastructure (
+            ID VARCHAR PRIMARY KEY,
+            Nome_it VARCHAR,
+            Nome_en VARCHAR,
+            version VARCHAR,
+            agencyID VARCHAR,
+            content_hash VARCHAR
+        )
+        """
+        columns = ['id', 'nome_it', 'nome_en', 'version', 'agencyid', 'content_hash']
+
+    with conn.cursor() as cur:
+        # Crea tabella se non esiste (e aggiunge content_hash a quelle già esistenti)
+        cur.execute(create_table_query)
+        cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS content_hash VARCHAR").format(
+            sql.Identifier(table_name)
+        ))
+        conn.commit()
+
+    # Inserisci/aggiorna con COPY + merge
+    return bulk_upsert(conn, table_name, columns, data, key_columns=['id'])
+
+
+def save_details_to_postgresql(details, conn, datastructure_ids=None):
+    """
+    Sincronizza i details nella tabella dedicata (datastructure_details), con chiave
+    (datastructure_id, type, detail_id): scrive solo le righe nuove o cambiate ed elimina
+    i componenti delle DSD `datastructure_ids` non più presenti upstream.
+    Se `datastructure_ids` è None si usano le DSD presenti in `details`.
+    """
+    print("Salvataggio dettagli in datastructure_details")
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS datastructure_details (
+        datastructure_id VARCHAR,
+        type VARCHAR,
+        detail_id VARCHAR,
+        concept_id VARCHAR,
+        concept_agency VARCHAR,
+        maintainableParentID VARCHAR,
+        maintainableParentVersion VARCHAR,
+        concept_class VARCHAR,
+        position VARCHAR,
+        codelist VARCHAR,
+        enum_id VARCHAR,
+        enum_version VARCHAR,
+        enum_agencyID VARCHAR,
+        enum_package VARCHAR,
+        enum_class VARCHAR,
+        PRIMARY KEY (datastructure_id, type, detail_id),
+        FOREIGN KEY (datastructure_id) REFERENCES datastructure(ID)
+    )
+    """
+    columns = [
+        'datastructure_id', 'type', 'detail_id', 'concept_id', 'concept_agency',
+        'maintainableparentid', 'maintainableparentversion', 'concept_class',
+        'position', 'codelist', 'enum_id', 'enum_version', 'enum_agencyid',
+        'enum_package', 'enum_class'
+    ]
+    key_columns = ['datastructure_id', 'type', 'detail_id']
+
+    # Crea tabella se non esiste (o migra quella con id SERIAL)
+    with conn.cursor() as cur:
+        cur.execute(create_table_query)
+        conn.commit()
+    ensure_primary_key(conn, 'datastructure_details', key_columns)
+
+    details = list(details)
+    if datastructure_ids is None:
+        datastructure_ids = {d['datastructure_id'] for d in details}
+
+    stats = bulk_upsert(conn, 'datastructure_details', columns, details, key_columns=key_columns)
+    stats['deleted'] = delete_missing_rows(
+        conn, 'datastructure_details', 'datastructure_id', datastructure_ids, key_columns,
+        [(d['datastructure_id'], d['type'], d['detail_id']) for d in details]
+    )
+    print("Salvataggio dettagli completato.")
+    return stats
+
+
+def save_groups_to_postgresql(groups, conn, datastructure_ids=None):
+    """
+    Sincronizza i group nella tabella dedicata (datastructure_groups), con chiave
+    (datastructure_id, group_id), eliminando i gruppi non più presenti upstream.
+    """
+    print("Salvataggio gruppi in datastructure_groups")
+    create_table_query = """
+    CREATE TABLE IF NOT EXISTS datastructure_groups (
+        datastructure_id VARCHAR,
+        group_id VARCHAR,
+        PRIMARY KEY (datastructure_id, group_id),
+        FOREIGN KEY (datastructure_id) REFERENCES datastructure(ID)
+    )
+    """
+    key_columns = ['datastructure_id', 'group_id']
+    with conn.cursor() as cur:
+        cur.execute(create_table_query)
+        conn.commit()
+    ensure_primary_key(conn, 'datastructure_groups', key_columns)
+
+    groups = list(groups)
+    if datastructure_ids is None:
+        datastructure_ids = {g['datastructure_id'] for g in groups}
+
+    stats = bulk_upsert(conn, 'datastructure_groups', key_columns, groups, key_columns=key_columns)
+    stats['deleted'] = delete_missing_rows(
+        conn, 'datastructure_groups', 'datastructure_id', datastructure_ids, key_columns,
+        [(g['datastructure_id'], g['group_id']) for g in groups]
+    )
+    return stats
+
+
+def delete_components_of_missing_datastructures(conn, datastructure_ids):
+    """
+    Dopo una sincronizzazione completa (messaggio ALL) con DELETE_REMOVED_STRUCTURES
+    elimina details e groups delle DSD che non sono più pubblicate.
+    """
+    datastructure_ids = list(datastructure_ids)
+    if not datastructure_ids:
+        return
+
+    with conn.cursor() as cur:
+        for table_name in ('datastructure_details', 'datastructure_groups'):
+            cur.execute(
+                sql.SQL("DELETE FROM {} WHERE datastructure_id <> ALL(%s)").format(sql.Identifier(table_name)),
+                (datastructure_ids,)
+            )
+            if cur.rowcount:
+                print(f"{table_name}: {cur.rowcount} righe di DSD non più pubblicate eliminate")
+    conn.commit()
+
+
+def compute_structure_hash(row, details=(), groups=()):
+    """
+    Hash SHA-256 del contenuto estratto di un Dataflow o di una DSD (record, details e groups).
+    Calcolato sui record e non sul testo del messaggio, quindi è lo stesso per XML e SDMX-JSON.
+    """
+    payload = json.dumps([row, list(details), list(groups)], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def load_structure_state(conn, table_name):
+    """
+    Restituisce { id: (version, content_hash) } per la tabella dataflow o datastructure
+    ({} se la tabella non esiste ancora).
+    """
+    if not table_exists(conn, table_name):
+        return {}
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s AND column_name = 'content_hash'
+        """, (ISTAT_SCHEMA, table_name))
+        hash_column = sql.SQL("content_hash") if cur.fetchone() else sql.SQL("NULL")
+        cur.execute(sql.SQL("SELECT id, version, {} FROM {}").format(
+            hash_column, sql.Identifier(table_name)
+        ))
+        return {row[0]: (row[1], row[2]) for row in cur.fetchall()}
+
+
+def classify_structure_change(stored, row):
+    """
+    Confronta il record in arrivo (con content_hash già calcolato) con lo stato salvato.
+    Restituisce (change, da_scrivere) dove change è 'added', 'changed' o None.
+    Le righe salvate senza hash (versioni precedenti) vengono riscritte senza finire nel changelog.
+    """
+    if stored is None:
+        return 'added', True
+    stored_version, stored_hash = stored
+    if stored_version != row['version']:
+        return 'changed', True
+    if stored_hash is None:
+        return None, True
+    if stored_hash != row['content_hash']:
+        return 'changed', True
+    return None, False
+
+
+def sync_structure_entries(conn, object_type, entries, changelog, full_sync=True, force=False):
+    """
+    Sincronizza i Dataflow o le DSD di `entries` (tuple (record, details, groups)) a blocchi
+    di STREAMING_BATCH_SIZE: confronta (id, version, content_hash) con quanto salvato e scrive
+    record, details e groups solo per gli oggetti nuovi o cambiati (tutti se `force`).
+    Le variazioni sono aggiunte a `changelog`; con `full_sync` (messaggio ALL) gli oggetti
+    salvati ma non più pubblicati sono registrati come 'removed' e marcati in withdrawn_at
+    (eliminati solo con DELETE_REMOVED_STRUCTURES). Un messaggio ALL vuoto non ritira nulla.
+    Restituisce l'insieme degli id ricevuti.
+    """
+    state = load_structure_state(conn, object_type)
+    seen_ids = set()
+    written = 0
+
+    for batch in batched(entries, STREAMING_BATCH_SIZE):
+        to_write = []
+        for row, details, groups in batch:
+            seen_ids.add(row['ID'])
+            row['content_hash'] = compute_structure_hash(row, details, groups)
+            stored = state.get(row['ID'])
+            change, needs_write = classify_structure_change(stored, row)
+            if change:
+                changelog.append((object_type, row['ID'], change,
+                                  stored[0] if stored else None, row['version']))
+            if needs_write or force:
+                to_write.append((row, details, groups))
+
+        if not to_write:
+            continue
+        written += len(to_write)
+        save_to_postgresql([row for row, _, _ in to_write], object_type, conn)
+        if object_type == 'datastructure':
+            # Prima le DSD, poi details e groups (vincolo di foreign key)
+            batch_ids = {row['ID'] for row, _, _ in to_write}
+            save_details_to_postgresql([d for _, details, _ in to_write for d in details], conn, batch_ids)
+            save_groups_to_postgresql([g for _, _, groups in to_write for g in groups], conn, batch_ids)
+
+    withdrawn = load_withdrawn_ids(conn, object_type)
+    removed_ids = []
+    if full_sync and seen_ids:
+        removed_ids = sorted(set(state) - seen_ids - withdrawn)
+        for removed_id in removed_ids:
+            changelog.append((object_type, removed_id, 'removed', state[removed_id][0], None))
+        if DELETE_REMOVED_STRUCTURES:
+            if object_type == 'datastructure':
+                delete_components_of_missing_datastructures(conn, seen_ids)
+            delete_removed_structures(conn, object_type, sorted(set(state) - seen_ids))
+            removed_ids = []
+    mark_withdrawn_structures(conn, object_type, removed_ids, sorted(withdrawn & seen_ids))
+
+    print(f"{object_type}: {len(seen_ids)} ricevuti, {written} riscritti, "
+          f"{len(seen_ids) - written} invariati")
+    return seen_ids
+
+
+def load_withdrawn_ids(conn, table_name):
+    """
+    Id dei Dataflow o delle DSD marcati come non più pubblicati (withdrawn_at valorizzato).
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s AND column_name = 'withdrawn_at'
+        """, (ISTAT_SCHEMA, table_name))
+        if not cur.fetchone():
+            return set()
+        cur.execute(sql.SQL("SELECT id FROM {} WHERE withdrawn_at IS NOT NULL").format(
+            sql.Identifier(table_name)
+        ))
+        return {row[0] for row in cur.fetchall()}
+
+
+def mark_withdrawn_structures(conn, object_type, removed_ids, restored_ids):
+    """
+    Marca in withdrawn_at i Dataflow o le DSD non più pubblicati (tabelle dei dati, viste,
+    vincoli e componenti restano al loro posto) e azzera il flag di quelli ripubblicati.
+    """
+    if not removed_ids and not restored_ids:
+        return
+    with transaction(conn), conn.cursor() as cur:
+        cur.execute(sql.SQL("ALTER TABLE {} ADD COLUMN IF NOT EXISTS withdrawn_at TIMESTAMPTZ").format(
+            sql.Identifier(object_type)
+        ))
+        cur.execute(sql.SQL("UPDATE {} SET withdrawn_at = now() WHERE id = ANY(%s)").format(
+            sql.Identifier(object_type)
+        ), (removed_ids,))
+        if cur.rowcount:
+            print(f"{object_type}: {cur.rowcount} oggetti non più pubblicati marcati come ritirati")
+        cur.execute(sql.SQL("UPDATE {} SET withdrawn_at = NULL WHERE id = ANY(%s)").format(
+            sql.Identifier(object_type)
+        ), (restored_ids,))
+        if cur.rowcount:
+            print(f"{object_type}: {cur.rowcount} oggetti di nuovo pubblicati")
+
+
+def delete_removed_structures(conn, object_type, removed_ids):
+    """
+    Con DELETE_REMOVED_STRUCTURES elimina i Dataflow (con la loro mappatura in
+    dataflow_categories) o le DSD non più pubblicate.
+    """
+    if not removed_ids:
+        return
+    with transaction(conn), conn.cursor() as cur:
+        if object_type == 'dataflow' and table_exists(conn, 'dataflow_categories'):
+            cur.execute("DELETE FROM dataflow_categories WHERE dataflow_id = ANY(%s)", (removed_ids,))
+        cur.execute(sql.SQL("DELETE FROM {} WHERE id = ANY(%s)").format(sql.Identifier(object_type)),
+                    (removed_ids,))
+        print(f"{object_type}: {cur.rowcount} oggetti non più pubblicati eliminati")
+
+
+def save_structure_changelog(conn, changelog):
+    """
+    Registra le variazioni di struttura della run nella tabella structure_changelog
+    e ne stampa un riepilogo.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS structure_changelog (
+            run_at TIMESTAMPTZ,
+            object_type VARCHAR,
+            object_id VARCHAR,
+            change VARCHAR,
+            old_version VARCHAR,
+            new_version VARCHAR,
+            PRIMARY KEY (run_at, object_type, object_id)
+        )
+        """)
+        conn.commit()
+
+    counts = defaultdict(int)
+    for object_type, _, change, _, _ in changelog:
+        counts[(object_type, change)] += 1
+    print("Changelog struttura:")
+    for object_type in ('dataflow', 'datastructure'):
+        print(f"  {object_type}: {counts[(object_type, 'added')]} aggiunti, "
+              f"{counts[(object_type, 'changed')]} modificati, {counts[(object_type, 'removed')]} rimossi")
+    for object_type, object_id, change, old_version, new_version in changelog:
+        if change == 'changed':
+            print(f"  {object_type} {object_id}: {old_version} -> {new_version}")
+
+    if changelog:
+        run_at = datetime.now(timezone.utc).isoformat()
+        bulk_upsert(conn, 'structure_changelog',
+                    ['run_at', 'object_type', 'object_id', 'change', 'old_version', 'new_version'],
+                    [(run_at,) + entry for entry in changelog],
+                    key_columns=['run_at', 'object_type', 'object_id'], update_columns=())
+
+
+def execute_part1(conn, streaming=STREAMING_PART1, structure_format=None, force=False):
+    """
+    Esecuzione Parte 1: Scaricamento e inserimento dei Dataflow e Datastructure.
+    In modalità streaming i messaggi XML sono parsati man mano che arrivano e i record
+    passano direttamente alle funzioni di salvataggio, a blocchi di STREAMING_BATCH_SIZE DSD.
+    Con structure_format='json' (default STRUCTURE_FORMAT) i messaggi sono richiesti
+    in SDMX-JSON; lo streaming vale solo per il backend XML.
+    La sincronizzazione è incrementale: vengono riscritti solo i Dataflow e le DSD nuovi o
+    cambiati (versione o hash del contenuto), salvo `force`, e le variazioni finiscono
+    in structure_changelog.
+    """
+    print("\nEsecuzione Parte 1: Scaricamento e inserimento dei Dataflow e Datastructure")
+    dataflow_url = DATAFLOW_ALL_URL
+    datastructure_url = DATASTRUCTURE_ALL_URL
+    structure_format = structure_format or STRUCTURE_FORMAT
+    changelog = []
+
+    if streaming and structure_format == 'xml':
+        print("Scaricamento e salvataggio Dataflow (streaming)...")
+        dataflow_entries = ((row, (), ()) for row in iter_dataflow_records(open_xml_stream(dataflow_url)))
+        sync_structure_entries(conn, 'dataflow', dataflow_entries, changelog, force=force)
+
+        print("Scaricamento e salvataggio Datastructure (streaming)...")
+        datastructure_entries = iter_datastructure_records(open_xml_stream(datastructure_url))
+        sync_structure_entries(conn, 'datastructure', datastructure_entries, changelog, force=force)
+        save_structure_changelog(conn, changelog)
+        print("Parte 1 completata.\n")
+        return changelog
+
+    print(f"Scaricamento Dataflow ({structure_format})...")
+    dataflow_root = download_structure_document(dataflow_url, structure_format)
+    print(f"Scaricamento Datastructure ({structure_format})...")
+    datastructure_root = download_structure_document(datastructure_url, structure_format)
+
+    print("Estrazione dati da Dataflow...")
+    dataflow_data = get_structure_parser(structure_format, 'dataflow')(dataflow_root)
+
+    print("Estrazione dati da Datastructure...")
+    datastructure_data, datastructure_details, datastructure_groups = \
+        get_structure_parser(structure_format, 'datastructure')(datastructure_root)
+
+    # Raggruppa details e groups per DSD, come nel percorso in streaming
+    details_by_id = defaultdict(list)
+    for d in datastructure_details:
+        details_by_id[d['datastructure_id']].append(d)
+    groups_by_id = defaultdict(list)
+    for g in datastructure_groups:
+        groups_by_id[g['datastructure_id']].append(g)
+
+    # Salva i dati
+    sync_structure_entries(conn, 'dataflow', [(row, (), ()) for row in dataflow_data],
+                           changelog, force=force)
+    sync_structure_entries(conn, 'datastructure',
+                           [(row, details_by_id[row['ID']], groups_by_id[row['ID']])
+                            for row in datastructure_data],
+                           changelog, force=force)
+    save_structure_changelog(conn, changelog)
+    print("Parte 1 completata.\n")
+    return changelog
+
+def execute_part1_targeted(conn, dataflow_ids, references='descendants'):
+    """
+    Parte 1 mirata: per ogni dataflow in `dataflow_ids` esegue una sola query di struttura
+    (dataflow/IT1/<id>/latest?references=...) che restituisce dataflow, DSD, concept scheme
+    e codelist nello stesso messaggio, e popola dataflow, datastructure, datastructure_details,
+    datastructure_groups e le tabelle dei codelist.
+    Con references='children' si ottiene solo la DSD (senza codelist).
+    Restituisce l'insieme dei codelist caricati.
+    """
+    print(f"\nEsecuzione Parte 1 mirata per {len(dataflow_ids)} dataflow (references={references})")
+    loaded_codelists = set()
+    changelog = []
+
+    for df_id in dataflow_ids:
+        url = f"{ISTAT_REST_V1}/dataflow/IT1/{df_id}/latest?references={references}"
+        print(f"Scaricamento struttura di {df_id}: {url}")
+
+        dataflows, datastructures, details, groups, codelists = [], [], [], [], []
+        for element in iterparse_elements(open_xml_stream(url), ('Dataflow', 'DataStructure', 'Codelist')):
+            tag = element.tag.split('}')[-1]
+            if tag == 'Dataflow':
+                dataflows.append(parse_dataflow_element(element))
+            elif tag == 'DataStructure':
+                row, element_details, element_groups = parse_datastructure_element(element)
+                datastructures.append(row)
+                details.extend(element_details)
+                groups.extend(element_groups)
+            else:
+                codelists.append(parse_codelist_element(element))
+
+        details_by_id = defaultdict(list)
+        for d in details:
+            details_by_id[d['datastructure_id']].append(d)
+        groups_by_id = defaultdict(list)
+        for g in groups:
+            groups_by_id[g['datastructure_id']].append(g)
+        sync_structure_entries(conn, 'dataflow', [(row, (), ()) for row in dataflows],
+                               changelog, full_sync=False)
+        sync_structure_entries(conn, 'datastructure',
+                               [(row, details_by_id[row['ID']], groups_by_id[row['ID']])
+                                for row in datastructures],
+                               changelog, full_sync=False)
+        for codelist_id, codes in codelists:
+            save_codelist_to_postgresql(conn, codelist_id, codes)
+            loaded_codelists.add(codelist_id)
+
+    save_structure_changelog(conn, changelog)
+    print(f"Parte 1 mirata completata ({len(loaded_codelists)} codelist caricati).\n")
+    return loaded_codelists
+
+# =============================================================================
+# PARTE 1-BIS: Popola le categorie e crea la mappatura Dataflow-Categorie
+# =============================================================================
+
+def extract_categories(root):
+    """
+    Estrae le categorie (id, name_it, name_en) dal CategoryScheme XML.
+    """
+    categories = {}
+    total_categories_found = 0
+    for category_scheme in root.findall('.//structure:CategoryScheme', namespaces=NAMESPACES):
+        for category in category_scheme.findall('.//structure:Category', namespaces=NAMESPACES):
+            total_categories_found += 1
+            cat_id = category.attrib.get('id')
+            name_it_elem = category.find('.//common:Name[@xml:lang="it"]', namespaces=NAMESPACES)
+            name_en_elem = category.find('.//common:Name[@xml:lang="en"]', namespaces=NAMESPACES)
+
+            categories[cat_id] = {
+                'name_it': name_it_elem.text if name_it_elem is not None else None,
+                'name_en': name_en_elem.text if name_en_elem is not None else None
+            }
+    print(f"Numero totale categorie trovate: {total_categories_found}")
+    return categories
+
+
+def populate_categories(conn, structure_format=None):
+    """
+    Scarica lo schema categorie e popola la tabella 'categories'.
+    """
+    url = CATEGORYSCHEME_ALL_URL
+    structure_format = structure_format or STRUCTURE_FORMAT
+    print("Scaricamento categorie da ISTAT...")
+
+    root = download_structure_document(url, structure_format)
+    categories = get_structure_parser(structure_format, 'categories')(root)
+
+    print(f"Salvataggio di {len(categories)} categorie nel database.")
+
+    with conn.cursor() as cur:
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS categories (
+            category_id VARCHAR PRIMARY KEY,
+            name_it VARCHAR,
+            name_en VARCHAR
+        )
+        """
+        cur.execute(create_table_query)
+        conn.commit()
+
+    # Le categorie già presenti non vengono modificate (DO NOTHING)
+    bulk_upsert(
+        conn, 'categories', ['category_id', 'name_it', 'name_en'],
+        ((cat_id, cat_data['name_it'], cat_data['name_en']) for cat_id, cat_data in categories.items()),
+        key_columns=['category_id'], update_columns=()
+    )
+
+    print(f"{len(categories)} categorie elaborate correttamente.")
+
+
+def match_category(category_ids, dataflow_id):
+    """
+    Restituisce la categoria più lunga `cat_id` tale che dataflow_id inizi con cat_id + '_'
+    (None se nessuna). `category_ids` è un insieme: si provano solo i prefissi del dataflow
+    che terminano prima di un underscore, dal più lungo, quindi il costo dipende dalla
+    lunghezza dell'id e non dal numero di categorie.
+    """
+    pos = dataflow_id.rfind('_')
+    while pos != -1:
+        candidate = dataflow_id[:pos]
+        if candidate in category_ids:
+            return candidate
+        pos = dataflow_id.rfind('_', 0, pos)
+    return None
+
+
+def build_dataflow_category_lookup(dataflow_ids, category_ids):
+    """
+    Costruisce la mappatura in memoria { dataflow_id: category_id } con il matching
+    sul prefisso più lungo. I dataflow senza categoria non compaiono.
+    """
+    category_ids = set(category_ids)
+    lookup = {}
+    for df_id in dataflow_ids:
+        cat_id = match_category(category_ids, df_id)
+        if cat_id is not None:
+            lookup[df_id] = cat_id
+    return lookup
+
+
+def execute_category_mapping(conn):
+    """
+    Crea la mappatura dataflow->categoria nella tabella dataflow_categories,
+    usando prefissi (prima dell'underscore).
+    """
+    print("Esecuzione mappatura categorie...")
 
     # Carico tutte le categorie
     categories_db = {}
     with conn.cursor() as cur:
-        cur.execute("SELECT category_id, name_it FROM categories")
-        for row in cur.fetchall():
-            category_id, name_it = row
-            categories_db[category_id] = {'name_it': name_it}
+        cur.execute("SELECT category_id, name_it FROM categories")
+        for row in cur.fetchall():
+            category_id, name_it = row
+            categories_db[category_id] = {'name_it': name_it}
+
+    # Carico tutti i dataflow
+    dataflows = []
+    with conn.cursor() as cur:
+        cur.execute("SELECT ID FROM dataflow")
+        dataflows = [r[0] for r in cur.fetchall()]
+
+    # Logica di matching: se dataflow_id inizia con `cat_id + "_"` => mappalo
+    lookup = build_dataflow_category_lookup(dataflows, categories_db)
+    dataflow_category_map = {}
+    for df_id, cat_id in lookup.items():
+        dataflow_category_map.setdefault(cat_id, []).append(df_id)
+
+    # Crea tabella e inserisci
+    with conn.cursor() as cur:
+        create_table_query = """
+        CREATE TABLE IF NOT EXISTS dataflow_categories (
+            dataflow_id VARCHAR,
+            category_id VARCHAR,
+            PRIMARY KEY (dataflow_id, category_id),
+            FOREIGN KEY (dataflow_id) REFERENCES dataflow(ID),
+            FOREIGN KEY (category_id) REFERENCES categories(category_id)
+        )
+        """
+        cur.execute(create_table_query)
+        conn.commit()
+    ensure_primary_key(conn, 'dataflow_categories', ['dataflow_id', 'category_id'])
+
+    # Un'unica scrittura bulk; le mappature cambiate per i dataflow noti vengono rimosse
+    key_columns = ['dataflow_id', 'category_id']
+    rows = sorted(lookup.items())
+    bulk_upsert(conn, 'dataflow_categories', key_columns, rows,
+                key_columns=key_columns, update_columns=())
+    delete_missing_rows(conn, 'dataflow_categories', 'dataflow_id', dataflows, key_columns, rows)
+
+    print("Mappatura categorie completata.\n")
+    return categories_db, dataflow_category_map
+
+
+def create_dataflow_category_view(conn):
+    """
+    Crea/aggiorna la view dataflow_category_view per comodità.
+    """
+    with conn.cursor() as cur:
+        query = """
+        CREATE OR REPLACE VIEW dataflow_category_view AS
+        SELECT
+            dc.dataflow_id,
+            df.nome_it AS dataflow_nome_it,
+            dc.category_id,
+            c.name_it AS category_nome_it
+        FROM dataflow_categories dc
+        JOIN dataflow df ON dc.dataflow_id = df.id
+        JOIN categories c ON dc.category_id = c.category_id
+        """
+        cur.execute(query)
+        conn.commit()
+    print("Vista 'dataflow_category_view' creata/aggiornata correttamente.")
+
+
+# ------------------------------------------------------------------------------
+# FUNZIONE select_category(conn) PER SCEGLIERE UNA CATEGORIA CON OPZIONE B
+# ------------------------------------------------------------------------------
+
+def select_category(conn):
+    """
+    Mostra l'elenco di (category_id, name_it, name_en) e chiede
+    all'utente di digitare *direttamente* l'ID della categoria (oppure 0 per annullare).
+    Restituisce l'ID categoria scelto o None se l'utente annulla.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT category_id, name_it, name_en FROM categories ORDER BY category_id")
+        rows = cur.fetchall()
+
+    if not rows:
+        print("Nessuna categoria trovata nella tabella 'categories'.")
+        return None
+
+    # Prepara un dizionario per rapida ricerca: { category_id: (name_it, name_en) }
+    cat_dict = {}
+    for (cat_id, name_it, name_en) in rows:
+        cat_dict[cat_id] = (name_it, name_en)
+
+    print("\nCategorie disponibili (category_id => Nome):")
+    for cat_id in sorted(cat_dict):
+        name_it, name_en = cat_dict[cat_id]
+        display_name = name_it or name_en or cat_id
+        print(f" - {cat_id} => {display_name}")
+
+    while True:
+        user_input = input("\nDigita l'ID della categoria (0 per annullare): ").strip()
+        if user_input == "0":
+            return None
+        if user_input in cat_dict:
+            print(f"Hai selezionato la categoria con ID: {user_input}")
+            return user_input
+        else:
+            print(f"L'ID '{user_input}' non esiste tra le categorie. Riprova (o digita 0 per annullare).")
+
+
+# =============================================================================
+# PARSER DI STRUTTURA: backend XML (ElementTree) o SDMX-JSON
+# =============================================================================
+
+def parse_sdmx_urn(urn):
+    """
+    Scompone un URN SDMX, es.
+    urn:sdmx:org.sdmx.infomodel.codelist.Codelist=IT1:CL_FREQ(1.0)
+    urn:sdmx:org.sdmx.infomodel.conceptscheme.Concept=IT1:CS_X(1.0).FREQ
+    in un dizionario con package, class, agencyID, id, version e item.
+    """
+    if not urn:
+        return {}
+    match = re.match(r'urn:sdmx:org\.sdmx\.infomodel\.(\w+)\.(\w+)=([^:]+):([^(]+)\(([^)]*)\)(?:\.(.+))?$', urn)
+    if not match:
+        return {}
+    package, cls, agency, maintainable_id, version, item = match.groups()
+    return {'package': package, 'class': cls, 'agencyID': agency,
+            'id': maintainable_id, 'version': version, 'item': item}
+
+
+def json_name(obj, lang):
+    """
+    Restituisce il nome localizzato di un artefatto SDMX-JSON (names.<lang>).
+    """
+    names = obj.get('names') or {}
+    return names.get(lang)
+
+
+def load_json_file(path):
+    """
+    Carica un file JSON usando orjson se installato, altrimenti il modulo json.
+    """
+    with open_raw_file(path) as f:
+        content = f.read()
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+
+def extract_data_from_dataflow_json(doc):
+    """
+    Estrae i Dataflow da un messaggio SDMX-JSON (stessi record di extract_data_from_dataflow).
+    """
+    data = []
+    for dataflow in doc.get('data', {}).get('dataflows', []):
+        ref = parse_sdmx_urn(dataflow.get('structure'))
+        data.append({
+            'ID': dataflow.get('id'),
+            'Nome_it': json_name(dataflow, 'it'),
+            'Nome_en': json_name(dataflow, 'en'),
+            'ref_id': ref.get('id'),
+            'version': dataflow.get('version'),
+            'agencyID': dataflow.get('agencyID'),
+            'package': ref.get('package')
+        })
+    return data
+
+
+def extract_data_from_datastructure_json(doc):
+    """
+    Estrae DataStructure, Details e Groups da un messaggio SDMX-JSON
+    (stessi record di extract_data_from_datastructure).
+    """
+    data = []
+    details = []
+    groups = []
+    for dsd in doc.get('data', {}).get('dataStructures', []):
+        id_value = dsd.get('id')
+        data.append({
+            'ID': id_value,
+            'Nome_it': json_name(dsd, 'it'),
+            'Nome_en': json_name(dsd, 'en'),
+            'version': dsd.get('version'),
+            'agencyID': dsd.get('agencyID')
+        })
+
+        components = dsd.get('dataStructureComponents', {})
+        # Come nel backend XML: Dimension (esclusa la TimeDimension), Attribute, Measure
+        dimensions = [d for d in components.get('dimensionList', {}).get('dimensions', [])
+                      if d.get('type', 'Dimension') == 'Dimension']
+        typed_components = (
+            [('Dimension', d) for d in dimensions] +
+            [('Attribute', a) for a in components.get('attributeList', {}).get('attributes', [])] +
+            [('Measure', m) for m in components.get('measureList', {}).get('measures', [])]
+        )
+        for detail_type, component in typed_components:
+            concept = parse_sdmx_urn(component.get('conceptIdentity'))
+            enumeration = parse_sdmx_urn((component.get('localRepresentation') or {}).get('enumeration'))
+            position = component.get('position')
+            details.append({
+                'datastructure_id': id_value,
+                'type': detail_type,
+                'detail_id': component.get('id'),
+                'concept_id': concept.get('item'),
+                'concept_agency': concept.get('agencyID'),
+                'maintainableParentID': concept.get('id'),
+                'maintainableParentVersion': concept.get('version'),
+                'concept_class': concept.get('class'),
+                'position': str(position) if position is not None else None,
+                'codelist': None,
+                'enum_id': enumeration.get('id'),
+                'enum_version': enumeration.get('version'),
+                'enum_agencyID': enumeration.get('agencyID'),
+                'enum_package': enumeration.get('package'),
+                'enum_class': enumeration.get('class')
+            })
+
+        for group in components.get('groups', []):
+            groups.append({'datastructure_id': id_value, 'group_id': group.get('id')})
+
+    return data, details, groups
+
+
+def extract_categories_json(doc):
+    """
+    Estrae le categorie (anche annidate) da un messaggio SDMX-JSON (come extract_categories).
+    """
+    categories = {}
+
+    def visit(category_list):
+        for category in category_list:
+            categories[category.get('id')] = {
+                'name_it': json_name(category, 'it'),
+                'name_en': json_name(category, 'en')
+            }
+            visit(category.get('categories', []))
+
+    for category_scheme in doc.get('data', {}).get('categorySchemes', []):
+        visit(category_scheme.get('categories', []))
+    print(f"Numero totale categorie trovate: {len(categories)}")
+    return categories
+
+
+def extract_codes_from_codelist_json(doc):
+    """
+    Estrae i Code (code_id, name_it, name_en) dai Codelist di un messaggio SDMX-JSON.
+    """
+    data = []
+    for codelist in doc.get('data', {}).get('codelists', []):
+        print(f"  Trovato codelist: {codelist.get('id')}")
+        for code in codelist.get('codes', []):
+            data.append((code.get('id'), json_name(code, 'it'), json_name(code, 'en')))
+    return data
+
+
+def get_structure_parser(structure_format, kind):
+    """
+    Restituisce il parser del backend `structure_format` ('xml' o 'json') per il tipo
+    di messaggio `kind`: 'dataflow', 'datastructure', 'categories' o 'codelist'.
+    """
+    parsers = {
+        'xml': {
+            'dataflow': extract_data_from_dataflow,
+            'datastructure': extract_data_from_datastructure,
+            'categories': extract_categories,
+            'codelist': extract_codes_from_codelist,
+        },
+        'json': {
+            'dataflow': extract_data_from_dataflow_json,
+            'datastructure': extract_data_from_datastructure_json,
+            'categories': extract_categories_json,
+            'codelist': extract_codes_from_codelist_json,
+        },
+    }
+    return parsers[structure_format][kind]
+
+
+def load_structure_document(path, structure_format):
+    """
+    Legge un messaggio di struttura salvato su disco con il backend scelto:
+    root ElementTree per 'xml', dizionario per 'json'.
+    """
+    if structure_format == 'json':
+        return load_json_file(path)
+    return parse_xml_file(path)
+
+
+def download_structure_document(url, structure_format=None):
+    """
+    Scarica (tramite cache HTTP) un messaggio di struttura negoziando il formato
+    con l'header Accept e lo restituisce già caricato dal backend scelto.
+    """
+    structure_format = structure_format or STRUCTURE_FORMAT
+    if structure_format == 'xml':
+        return download_and_parse_xml(url)
+
+    accept = STRUCTURE_ACCEPT[structure_format]
+    path = fetch_cached(url, headers={'Accept': accept})
+    if path is None:
+        sys.exit(1)
+    try:
+        return load_structure_document(path, structure_format)
+    except ValueError as e:
+        print(f"Errore parsing JSON: {str(e)}")
+        sys.exit(1)
+
+
+# =============================================================================
+# PARTE 2: CSV + Classificazioni
+# =============================================================================
+
+def download_raw_file(url, file_name):
+    """
+    Scarica `url` in DOWNLOAD_DIR come `file_name` (compresso con RAW_COMPRESSION, da leggere
+    con open_raw_file), tramite la cache HTTP quando abilitata (su 304 nessun trasferimento).
+    Se il download non riesce usa la copia locale, anche *_import delle versioni precedenti.
+    Restituisce il percorso del file, None se non disponibile.
+    """
+    file_path = os.path.join(DOWNLOAD_DIR, raw_file_name(file_name))
+    print(f"Downloading: {url}")
+    try:
+        if HTTP_CACHE_ENABLED:
+            cached_path = fetch_cached(url)
+            if cached_path is not None:
+                # Oggetto in cache e file grezzo hanno la stessa compressione: copia diretta
+                shutil.copyfile(cached_path, file_path)
+                return file_path
+        else:
+            response = http_get(url, stream=True)
+            if response.status_code == 200:
+                return save_raw_body(response.raw, file_path, desc=f"Downloading {file_name}")
+            print(f"Errore nel download del file: HTTP {response.status_code}")
+    except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+        print(f"Errore download {file_name}: {e}")
+
+    local_path = find_raw_file(file_name) or find_raw_file(import_file_name(file_name))
+    if local_path:
+        print(f"Download non riuscito, uso la copia locale {local_path}")
+    return local_path
+
+
+def download_content(url, file_name):
+    """
+    Scarica un file generico (CSV/XML) in DOWNLOAD_DIR (vedi download_raw_file).
+    Restituisce (percorso, tipo) oppure (None, None) se il file non è disponibile.
+    """
+    file_path = download_raw_file(url, file_name)
+    if file_path is None:
+        return None, None
+    if file_name.endswith('.csv'):
+        return file_path, 'csv'
+    elif file_name.endswith('.xml'):
+        return file_path, 'xml'
+    else:
+        return file_path, None
+
+
+def extract_data_from_csv(file_path):
+    """
+    Legge un CSV a chunk e rimuove colonne in EXCLUDE_FIELDS.
+    Restituisce un DataFrame concatenato.
+    """
+    print(f"Lettura CSV: {file_path}")
+    try:
+        chunks = pd.read_csv(file_path, chunksize=10000, delimiter=',')
+        data_parts = []
+        for chunk in tqdm(chunks, desc="Lettura del CSV", unit='chunk'):
+            keep_cols = [c for c in chunk.columns if c.lower() not in EXCLUDE_FIELDS]
+            data_parts.append(chunk[keep_cols])
+        data_combined = pd.concat(data_parts, ignore_index=True)
+        if not data_combined.empty:
+            print(f"Prime righe:\n{data_combined.head()}")
+        else:
+            print("Il CSV non contiene dati.")
+        return data_combined
+    except Exception as e:
+        print(f"Errore estrazione CSV: {e}")
+        return pd.DataFrame()
+
+
+def create_table_from_data(table_name, data, conn):
+    """
+    Crea una tabella (nome = `table_name`) con tutte le colonne come TEXT,
+    e copia i dati del DataFrame in blocchi da 10k righe. Il caricamento avviene nella
+    tabella shadow, che sostituisce quella pubblicata con uno swap atomico.
+    Oltre PARALLEL_COPY_MIN_BYTES (stima dalla memoria del DataFrame) la shadow è UNLOGGED
+    e i blocchi sono copiati in parallelo con copy_chunks_parallel.
+    """
+    if data.empty:
+        print(f"Nessun dato trovato per la tabella {table_name}")
+        return False
+
+    published_name = table_name
+    table_name = shadow_table_name(published_name)
+    try:
+        with conn.cursor() as cur:
+            # Carichiamo in una tabella shadow, sostituita alla fine con uno swap atomico
+            drop_table_query = f'DROP TABLE IF EXISTS "{table_name}"'
+            print(f"Eliminazione tabella con query: {drop_table_query}")
+            cur.execute(drop_table_query)
+
+            # Sanitizza colonne
+            columns = [sanitize_column_name(col) for col in data.columns]
+            if len(columns) != len(set(columns)):
+                print("Errore: nomi di colonne duplicati dopo sanitizzazione.")
+                return False
+
+            print(f"Nomi colonne CSV: {columns}")
+            columns_str = ', '.join([f'"{col}" TEXT' for col in columns])
+
+            parallel = use_parallel_copy(int(data.memory_usage(index=False, deep=True).sum()))
+            unlogged = 'UNLOGGED ' if parallel else ''
+            create_table_query = f'CREATE {unlogged}TABLE IF NOT EXISTS "{table_name}" ({columns_str})'
+            print(f"Creazione tabella: {create_table_query}")
+            cur.execute(create_table_query)
+            conn.commit()
+
+            total_rows = len(data)
+            chunk_size = 10000
+            if parallel:
+                # Blocchi CSV senza header/index, distribuiti sulle connessioni dei worker
+                copy_chunks_parallel(table_name, (
+                    (data.iloc[i:i + chunk_size].to_csv(index=False, header=False),
+                     len(data.iloc[i:i + chunk_size]))
+                    for i in range(0, total_rows, chunk_size)
+                ))
+            else:
+                from io import StringIO
+                for i in tqdm(range(0, total_rows, chunk_size),
+                              desc=f"Caricamento dati in {table_name}",
+                              unit='rows'):
+                    buffer = StringIO()
+                    chunk = data.iloc[i:i + chunk_size]
+                    # Scrive CSV senza header/index in buffer
+                    chunk.to_csv(buffer, index=False, header=False)
+                    buffer.seek(0)
+                    copy_sql = f'COPY "{table_name}" FROM STDIN WITH CSV'
+                    cur.copy_expert(copy_sql, buffer)
+                    conn.commit()
+        index_renames = build_shadow_indexes(conn, published_name, table_name)
+        if parallel:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("ALTER TABLE {} SET LOGGED").format(sql.Identifier(table_name)))
+        swap_shadow_table(conn, published_name, table_name, index_renames)
+        return True
+    except Exception as e:
+        print(f"Errore creazione tabella {table_name}: {e}")
+        return False
+
+
+# =============================================================================
+# CARICAMENTO CSV IN STREAMING (body HTTP -> proiezione colonne -> COPY)
+# =============================================================================
+
+class TeeStream(io.RawIOBase):
+    """
+    Stream binario in sola lettura che restituisce i byte di `source` (qualunque oggetto
+    con read(size), ad es. il body urllib3) scrivendone una copia in `sink`, se indicato.
+    Con `stream_info` (dizionario) aggiorna stream_info['sha256'] (oggetto hashlib) e
+    stream_info['byte_size'] con i byte letti.
+    Un errore di rete durante la lettura resta in `read_error`: dentro copy_expert libpq
+    lo trasforma in un errore di COPY, e download_dataflow lo rilancia per ripetere la richiesta.
+    """
+
+    def __init__(self, source, sink=None, stream_info=None):
+        self.source = source
+        self.sink = sink
+        self.stream_info = stream_info
+        self.read_error = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        try:
+            data = self.source.read(len(buffer))
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError, OSError) as e:
+            self.read_error = e
+            raise
+        if self.sink is not None:
+            self.sink.write(data)
+        if self.stream_info is not None:
+            self.stream_info['sha256'].update(data)
+            self.stream_info['byte_size'] += len(data)
+        buffer[:len(data)] = data
+        return len(data)
+
+
+class ChunkReader:
+    """
+    Adattatore file-like (read(size)) sopra un generatore di blocchi di testo,
+    usato come sorgente per copy_expert.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.pending = ''
+
+    def read(self, size=-1):
+        parts = [self.pending]
+        length = len(self.pending)
+        while size < 0 or length < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        data = ''.join(parts)
+        if size < 0:
+            self.pending = ''
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+    def readline(self, size=-1):
+        return self.read(size)
+
+
+FLOAT_RE = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+TIME_PERIOD_RE = re.compile(r'^(\d{4})(?:-(?:(\d{2})(?:-(\d{2}))?|([QSHMW])(\d{1,2})))?$')
+
+
+def parse_time_period(value):
+    """
+    Converte un TIME_PERIOD SDMX (2020, 2020-03, 2020-03-15, 2020-Q2, 2020-S2, 2020-H1,
+    2020-M03, 2020-W05) nella data di inizio del periodo. None se il formato non è riconosciuto.
+    """
+    match = TIME_PERIOD_RE.match(value)
+    if not match:
+        return None
+    year, month, day, period, number = match.groups()
+    year = int(year)
+    try:
+        if period == 'W':
+            return date.fromisocalendar(year, int(number), 1)
+        if period:
+            months_per_period = {'Q': 3, 'S': 6, 'H': 6, 'M': 1}[period]
+            return date(year, (int(number) - 1) * months_per_period + 1, 1)
+        return date(year, int(month or 1), int(day or 1))
+    except ValueError:
+        return None
+
+
+def get_dataflow_components(conn, dataflow_id):
+    """
+    Restituisce { detail_id minuscolo: tipo } (Dimension, Attribute, Measure)
+    della DSD del dataflow, {} se la struttura non è nota.
+    """
+    if not table_exists(conn, 'datastructure_details'):
+        return {}
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT detail_id, type FROM datastructure_details
+            WHERE datastructure_id = (SELECT ref_id FROM dataflow WHERE id = %s)
+        """, (dataflow_id,))
+        return {detail_id.lower(): detail_type for detail_id, detail_type in cur.fetchall() if detail_id}
 
-    # Carico tutti i dataflow
-    dataflows = []
+
+def is_measure_column(column, components):
+    """
+    True per la misura del dataflow (obs_value o componente Measure della DSD).
+    """
+    return column == 'obs_value' or components.get(column) == 'Measure'
+
+
+def derive_column_types(columns, components):
+    """
+    Tipo SQL di ogni colonna: la misura è DOUBLE PRECISION, tutte le altre (tempo,
+    dimensioni, attributi e colonne fuori dalla DSD) restano TEXT, così un valore inatteso
+    non viene mai perso.
+    """
+    return ['DOUBLE PRECISION' if is_measure_column(column, components) else 'TEXT' for column in columns]
+
+
+def build_value_checks(columns, types):
+    """
+    Controlli per la misura: lista di (posizione, colonna, funzione) dove la funzione
+    restituisce True se il valore è un numero accettato da Postgres. Solo le colonne
+    DOUBLE PRECISION (la misura) sono controllate e i valori non numerici caricati come NULL.
+    """
+    return [(position, column, FLOAT_RE.match)
+            for position, (column, column_type) in enumerate(zip(columns, types))
+            if column_type == 'DOUBLE PRECISION']
+
+
+def iter_projected_csv(reader, keep_indexes, counter, value_checks=(), time_position=None,
+                       rows_per_chunk=5000):
+    """
+    Generatore: riscrive in CSV solo le colonne `keep_indexes` delle righe di `reader`,
+    a blocchi di `rows_per_chunk` righe. Le righe elaborate sono contate in counter['rows'].
+    I valori che non superano `value_checks` diventano NULL e sono contati in
+    counter['failures']; con `time_position` viene aggiunta la colonna time_period_date.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    failures = counter.setdefault('failures', defaultdict(int))
+    rows = 0
+    for row in reader:
+        values = [row[i] for i in keep_indexes]
+        for position, column, check in value_checks:
+            value = values[position]
+            if value and not check(value):
+                values[position] = ''
+                failures[column] += 1
+        if time_position is not None:
+            period_start = parse_time_period(values[time_position]) if values[time_position] else None
+            if period_start is None and values[time_position]:
+                failures['time_period_date'] += 1
+            values.append(period_start.isoformat() if period_start else '')
+        writer.writerow(values)
+        rows += 1
+        if rows % rows_per_chunk == 0:
+            counter['rows'] = rows
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    counter['rows'] = rows
+    yield buffer.getvalue()
+
+
+def read_csv_projection(source, sink=None, stream_info=None):
+    """
+    Apre lo stream binario `source` come CSV (copiando i byte in `sink`, se indicato, e
+    calcolandone lo sha256 in `stream_info`, vedi TeeStream) e legge
+    intestazione e prima riga. Restituisce (reader, indici delle colonne tenute, nomi colonne
+    sanitizzati, righe già lette) oppure None se il CSV è vuoto o ha colonne duplicate.
+    """
+    raw = io.BufferedReader(TeeStream(source, sink, stream_info), CSV_COPY_BUFFER_SIZE)
+    text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+    reader = csv.reader(text)
+
+    header = next(reader, None)
+    sample_rows = list(islice(reader, 1))
+    if header is None or not sample_rows:
+        return None
+
+    keep_indexes = [i for i, col in enumerate(header) if col.lower() not in EXCLUDE_FIELDS]
+    columns = [sanitize_column_name(header[i]) for i in keep_indexes]
+    if len(columns) != len(set(columns)):
+        print("Errore: nomi di colonne duplicati dopo sanitizzazione.")
+        return None
+    print(f"Nomi colonne CSV: {columns}")
+    return reader, keep_indexes, columns, sample_rows
+
+
+def print_load_summary(table_name, counter, start, action='caricate'):
+    """
+    Stampa righe e velocità di un caricamento e i valori scartati per colonna.
+    """
+    elapsed = time.perf_counter() - start
+    rows = counter['rows']
+    print(f"{table_name}: {rows} righe {action} in {elapsed:.1f}s ({rows / max(elapsed, 1e-9):,.0f} righe/s)")
+    for column, failed in sorted(counter['failures'].items()):
+        print(f"  {column}: {failed} valori non convertibili caricati come NULL")
+
+
+def with_row_counts(chunks, counter):
+    """
+    Associa a ogni blocco di iter_projected_csv il numero di righe che contiene.
+    """
+    previous = 0
+    for chunk in chunks:
+        yield chunk, counter['rows'] - previous
+        previous = counter['rows']
+
+
+def print_copy_throughput(stats, elapsed):
+    """
+    Stampa righe, MB/s e attesa dei blocchi per ogni worker della COPY parallela
+    (un'attesa alta indica che il collo di bottiglia è la lettura del CSV, non il DB).
+    """
+    total_bytes = sum(s['bytes'] for s in stats)
+    print(f"COPY parallela: {len(stats)} connessioni, {total_bytes / 1024 ** 2:.1f} MB in {elapsed:.1f}s "
+          f"({total_bytes / 1024 ** 2 / max(elapsed, 1e-9):.1f} MB/s)")
+    for index, worker_stats in enumerate(stats):
+        megabytes = worker_stats['bytes'] / 1024 ** 2
+        print(f"  worker {index}: {int(worker_stats['rows']):,} righe, {megabytes:.1f} MB, "
+              f"{megabytes / max(worker_stats['time'], 1e-9):.1f} MB/s, "
+              f"in attesa di blocchi {worker_stats['wait']:.1f}s")
+
+
+def copy_chunks_parallel(table_name, chunks, workers=None):
+    """
+    COPY dei blocchi `chunks` ((testo CSV, righe)) in `table_name` su `workers` connessioni
+    (default COPY_PARALLELISM): il thread chiamante distribuisce i blocchi su una coda
+    limitata e ogni worker esegue un'unica COPY nella propria transazione, così ogni
+    connessione paga un solo commit. La tabella deve essere già visibile (commit eseguito).
+    Se un worker fallisce l'errore viene rilanciato dopo la fine degli altri; se è la
+    lettura di `chunks` a fallire, le COPY dei worker sono annullate e l'errore rilanciato.
+    """
+    workers = workers or COPY_PARALLELISM
+    work_queue = queue.Queue(maxsize=workers * 2)
+    stats = [defaultdict(float) for _ in range(workers)]
+    errors = []
+    aborted = threading.Event()
+
+    def worker(index):
+        worker_stats = stats[index]
+
+        def worker_chunks():
+            while True:
+                waiting = time.perf_counter()
+                item = work_queue.get()
+                worker_stats['wait'] += time.perf_counter() - waiting
+                if item is None:
+                    if aborted.is_set():
+                        raise RuntimeError("Distribuzione dei blocchi interrotta, COPY annullata")
+                    return
+                chunk, rows = item
+                worker_stats['rows'] += rows
+                worker_stats['bytes'] += len(chunk)
+                yield chunk
+
+        pending = worker_chunks()
+        start = time.perf_counter()
+        try:
+            worker_conn = connect_to_database()
+            try:
+                with transaction(worker_conn), worker_conn.cursor() as cur:
+                    cur.copy_expert(
+                        sql.SQL("COPY {} FROM STDIN WITH CSV").format(sql.Identifier(table_name)).as_string(cur),
+                        ChunkReader(pending), size=CSV_COPY_BUFFER_SIZE
+                    )
+            finally:
+                worker_conn.close()
+        except Exception as e:
+            errors.append(e)
+            # Continua a svuotare la coda, così il thread che distribuisce i blocchi non resta bloccato
+            for _ in pending:
+                pass
+        worker_stats['time'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(worker, index) for index in range(workers)]
+        try:
+            for item in chunks:
+                if errors:
+                    break
+                work_queue.put(item)
+        except BaseException:
+            # Sorgente illeggibile (csv.Error, UnicodeDecodeError, EOFError, ...): le COPY
+            # dei worker vanno annullate, non confermate con dati parziali
+            aborted.set()
+            raise
+        finally:
+            # Un sentinella per worker in ogni caso, altrimenti restano bloccati sulla coda
+            for _ in futures:
+                work_queue.put(None)
+            for future in futures:
+                future.result()
+    if errors:
+        raise errors[0]
+    print_copy_throughput(stats, time.perf_counter() - start)
+
+
+def use_parallel_copy(size_hint):
+    """
+    True se un CSV di `size_hint` byte va caricato con la COPY parallela.
+    """
+    return COPY_PARALLELISM > 1 and bool(size_hint) and size_hint >= PARALLEL_COPY_MIN_BYTES
+
+
+def stream_csv_to_table(conn, table_name, source, tee_path=None, typed=None, key_columns=None,
+                        size_hint=None, stream_info=None):
+    """
+    Carica in `table_name` (ricreata) il CSV letto dallo stream binario `source`
+    (body HTTP o file aperto in 'rb'), scartando le colonne in EXCLUDE_FIELDS.
+    Con `typed` (default TYPED_TABLES) i tipi delle colonne sono derivati dalla DSD del
+    dataflow (derive_column_types: la misura DOUBLE PRECISION, il resto TEXT), altrimenti
+    tutte le colonne sono TEXT.
+    Il CSV non viene mai materializzato: la memoria resta costante qualunque sia la dimensione.
+    Il CSV viene caricato (in un'unica transazione) in una tabella shadow, indicizzata e
+    analizzata, che poi sostituisce quella pubblicata con swap_shadow_table.
+    Con `key_columns` (chiave di serie + time_period) viene creato anche l'indice univoco
+    usato dai refresh incrementali. Con `tee_path` i byte grezzi vengono salvati anche su disco.
+    Con STORAGE_LAYOUT 'dictionary' la shadow viene poi codificata (encode_dictionary_layout).
+    Se `size_hint` (byte del CSV, se noti) supera PARALLEL_COPY_MIN_BYTES la shadow è UNLOGGED
+    e viene caricata con copy_chunks_parallel, poi resa LOGGED dopo gli indici.
+    Con `stream_info` sha256 e byte del CSV vengono calcolati durante la lettura; se lo sha256
+    coincide con stream_info['unchanged_sha256'] (ultimo import) la shadow viene scartata
+    senza indici né swap e stream_info['unchanged'] diventa True.
+    Restituisce il numero di righe caricate, None se il CSV non contiene dati.
+    """
+    start = time.perf_counter()
+    if stream_info is not None:
+        # Azzerato a ogni tentativo di download_dataflow
+        stream_info.update(sha256=hashlib.sha256(), byte_size=0, unchanged=False)
+    sink = open_raw_file(tee_path, 'wb') if tee_path else None
+    try:
+        projection = read_csv_projection(source, sink, stream_info)
+        if projection is None:
+            print(f"Nessun dato trovato per la tabella {table_name}")
+            return None
+        reader, keep_indexes, columns, sample_rows = projection
+
+        typed = TYPED_TABLES if typed is None else typed
+        if typed:
+            types = derive_column_types(columns, get_dataflow_components(conn, table_name))
+            time_position = columns.index('time_period') if 'time_period' in columns else None
+        else:
+            types = ['TEXT'] * len(columns)
+            time_position = None
+        column_defs = list(zip(columns, types))
+        if time_position is not None:
+            column_defs.append(('time_period_date', 'DATE'))
+        print("Tipi colonne: " + ', '.join(f"{c} {t}" for c, t in column_defs if t != 'TEXT'))
+
+        counter = {'rows': 0}
+        chunks = iter_projected_csv(chain(sample_rows, reader), keep_indexes, counter,
+                                    build_value_checks(columns, types), time_position)
+        # Il caricamento avviene nella shadow: la tabella pubblicata resta leggibile
+        shadow_name = shadow_table_name(table_name)
+        parallel = use_parallel_copy(size_hint)
+        with transaction(conn), conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(shadow_name)))
+            cur.execute(sql.SQL("CREATE {} TABLE {} ({})").format(
+                sql.SQL("UNLOGGED" if parallel else ""),
+                sql.Identifier(shadow_name),
+                sql.SQL(', ').join(sql.SQL("{} {}").format(sql.Identifier(c), sql.SQL(t))
+                                   for c, t in column_defs)
+            ))
+            if not parallel:
+                cur.copy_expert(
+                    sql.SQL("COPY {} FROM STDIN WITH CSV").format(sql.Identifier(shadow_name)).as_string(cur),
+                    ChunkReader(chunks), size=CSV_COPY_BUFFER_SIZE
+                )
+        if parallel:
+            try:
+                copy_chunks_parallel(shadow_name, with_row_counts(chunks, counter))
+            except Exception:
+                with conn.cursor() as cur:
+                    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(shadow_name)))
+                raise
+    finally:
+        if sink:
+            sink.close()
+
+    if stream_info is not None and stream_info.get('unchanged_sha256') == stream_info['sha256'].hexdigest():
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(shadow_name)))
+        stream_info['unchanged'] = True
+        print(f"{table_name}: contenuto invariato dall'ultimo import, tabella pubblicata non sostituita.")
+        return counter['rows']
+
+    if STORAGE_LAYOUT == 'dictionary':
+        # La tabella dei fatti è ricreata (LOGGED) a partire dalla shadow
+        encode_dictionary_layout(conn, table_name, shadow_name, column_defs, key_columns)
+    else:
+        index_renames = build_shadow_indexes(conn, table_name, shadow_name)
+        if key_columns and set(key_columns) <= set(columns):
+            index_renames += build_series_key_index(conn, table_name, shadow_name, key_columns, index_renames)
+        if parallel:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("ALTER TABLE {} SET LOGGED").format(sql.Identifier(shadow_name)))
+        swap_shadow_table(conn, table_name, shadow_name, index_renames)
+        drop_dictionary_layout(conn, table_name)
+
+    print_load_summary(table_name, counter, start)
+    return counter['rows']
+
+
+def get_table_columns(conn, table_name):
+    """
+    Restituisce [(colonna, tipo)] della tabella nell'ordine di definizione.
+    """
     with conn.cursor() as cur:
-        cur.execute("SELECT ID FROM dataflow")
-        dataflows = [r[0] for r in cur.fetchall()]
+        cur.execute("""
+            SELECT column_name, data_type FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s
+            ORDER BY ordinal_position
+        """, (ISTAT_SCHEMA, table_name))
+        return cur.fetchall()
 
-    # Logica di matching: se dataflow_id inizia con `cat_id + "_"` => mappalo
-    dataflow_category_map = {}
-    for df_id in dataflows:
-        matching_category = None
-        max_len = 0
-        for cat_id in categories_db:
-            if df_id.startswith(cat_id + '_'):
-                if len(cat_id) > max_len:
-                    matching_category = cat_id
-                    max_len = len(cat_id)
-        if matching_category:
-            dataflow_category_map.setdefault(matching_category, []).append(df_id)
 
-    # Crea tabella e inserisci
+def stream_csv_delta_to_table(conn, table_name, source, key_columns):
+    """
+    Fonde in `table_name` un CSV parziale (es. risposta a updatedAfter/startPeriod) letto
+    in streaming: COPY in una staging temporanea con gli stessi tipi della tabella e upsert
+    sulla chiave `key_columns` (serie + time_period), riscrivendo solo le righe cambiate.
+    Restituisce il numero di righe ricevute (0 se il CSV è vuoto), None se le colonne
+    non sono compatibili con la tabella e serve un caricamento completo.
+    """
+    start = time.perf_counter()
+    projection = read_csv_projection(source)
+    if projection is None:
+        print(f"{table_name}: nessuna variazione ricevuta")
+        return 0
+    reader, keep_indexes, columns, sample_rows = projection
+
+    table_types = dict(get_table_columns(conn, table_name))
+    if not set(columns) <= set(table_types) or not set(key_columns) <= set(columns):
+        print(f"{table_name}: colonne del delta non compatibili con la tabella, serve un caricamento completo")
+        return None
+
+    types = [table_types[c].upper() for c in columns]
+    time_position = columns.index('time_period') if 'time_period_date' in table_types else None
+    copy_columns = columns + (['time_period_date'] if time_position is not None else [])
+
+    counter = {'rows': 0}
+    chunks = iter_projected_csv(chain(sample_rows, reader), keep_indexes, counter,
+                                build_value_checks(columns, types), time_position)
+    staging_name = f"_stg_{table_name}"
+    with transaction(conn), conn.cursor() as cur:
+        cur.execute(sql.SQL(
+            "CREATE TEMP TABLE {staging} ON COMMIT DROP AS SELECT {cols} FROM {target} WITH NO DATA"
+        ).format(
+            staging=sql.Identifier(staging_name),
+            cols=sql.SQL(', ').join(map(sql.Identifier, copy_columns)),
+            target=sql.Identifier(table_name)
+        ))
+        cur.copy_expert(
+            sql.SQL("COPY {} FROM STDIN WITH CSV").format(sql.Identifier(staging_name)).as_string(cur),
+            ChunkReader(chunks), size=CSV_COPY_BUFFER_SIZE
+        )
+        update_columns = [c for c in copy_columns if c not in key_columns]
+        cur.execute(build_merge_query(table_name, staging_name, copy_columns, key_columns, update_columns))
+        distinct_rows, inserted, written = cur.fetchone()
+
+    print_load_summary(table_name, counter, start, action='ricevute (delta)')
+    print(f"  {inserted} inserite, {written - inserted} aggiornate, {distinct_rows - written} invariate")
+    return counter['rows']
+
+
+# =============================================================================
+# REFRESH INCREMENTALE DEI DATAFLOW
+# =============================================================================
+
+def series_key_index_name(table_name):
+    """
+    Nome dell'indice univoco (chiave di serie + time_period) usato dagli upsert incrementali.
+    """
+    return f"{table_name}_series_key"
+
+
+def get_series_key_columns(conn, dataflow_id):
+    """
+    Chiave delle osservazioni del dataflow: le dimensioni della DSD in ordine di posizione
+    più time_period. None se la DSD non è nota.
+    """
+    if not table_exists(conn, 'datastructure_details'):
+        return None
     with conn.cursor() as cur:
-        create_table_query = """
-        CREATE TABLE IF NOT EXISTS dataflow_categories (
-            dataflow_id VARCHAR,
-            category_id VARCHAR,
-            FOREIGN KEY (dataflow_id) REFERENCES dataflow(ID),
-            FOREIGN KEY (category_id) REFERENCES categories(category_id)
+        cur.execute("""
+            SELECT detail_id FROM datastructure_details
+            WHERE datastructure_id = (SELECT ref_id FROM dataflow WHERE id = %s)
+              AND type = 'Dimension'
+            ORDER BY NULLIF(position, '')::int, detail_id
+        """, (dataflow_id,))
+        dimensions = [row[0].lower() for row in cur.fetchall() if row[0]]
+    return dimensions + ['time_period'] if dimensions else None
+
+
+def build_series_key_index(conn, table_name, shadow_name, key_columns, index_renames):
+    """
+    Crea sulla shadow l'indice univoco sulla chiave di serie, se non è già tra quelli
+    ricostruiti. Restituisce la rinomina da applicare allo swap ([] se non creato, ad es.
+    per osservazioni duplicate: il dataflow resterà a caricamento completo).
+    """
+    index_name = series_key_index_name(table_name)
+    if index_name in {final for _, final in index_renames}:
+        return []
+    shadow_index = f"{shadow_name}_series_key"
+    try:
+        with transaction(conn), conn.cursor() as cur:
+            cur.execute(sql.SQL("CREATE UNIQUE INDEX {} ON {} ({})").format(
+                sql.Identifier(shadow_index), sql.Identifier(shadow_name),
+                sql.SQL(', ').join(map(sql.Identifier, key_columns))
+            ))
+    except psycopg2.Error as e:
+        print(f"Indice {index_name} non creato, refresh incrementale non disponibile: {e}")
+        return []
+    return [(shadow_index, index_name)]
+
+
+def get_dimension_ids(conn, dataflow_id):
+    """
+    Dimensioni della DSD del dataflow (detail_id) ordinate per `position`,
+    cioè nell'ordine in cui compaiono nella chiave SDMX.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT detail_id FROM datastructure_details
+            WHERE datastructure_id = (SELECT ref_id FROM dataflow WHERE id = %s)
+              AND type = 'Dimension'
+            ORDER BY NULLIF(position, '')::int, detail_id
+        """, (dataflow_id,))
+        return [row[0] for row in cur.fetchall() if row[0]]
+
+
+def build_sdmx_key(dimension_ids, filter_spec):
+    """
+    Costruisce la chiave SDMX da un filtro { dimensione: codice o lista di codici }:
+    una parte per dimensione in ordine di posizione, codici uniti da '+', vuota se la
+    dimensione non è filtrata (es. {'FREQ': 'A', 'ITTER107': ['IT', 'ITC']} => 'A.IT+ITC...').
+    Senza filtro restituisce 'ALL'.
+    """
+    if not filter_spec:
+        return 'ALL'
+    by_dimension = {d.upper(): d for d in dimension_ids}
+    unknown = [d for d in filter_spec if d.upper() not in by_dimension]
+    if unknown:
+        raise ValueError(f"Dimensioni non presenti nella DSD: {', '.join(unknown)}")
+
+    codes_by_dimension = {}
+    for dimension, codes in filter_spec.items():
+        codes = [codes] if isinstance(codes, str) else list(codes)
+        for code in codes:
+            if not code or '.' in code or '+' in code:
+                raise ValueError(f"Codice non valido per {dimension}: {code!r}")
+        codes_by_dimension[dimension.upper()] = codes
+    return '.'.join('+'.join(codes_by_dimension.get(d.upper(), [])) for d in dimension_ids)
+
+
+def parse_filter_spec(text):
+    """
+    Converte un filtro scritto come 'FREQ=A;ITTER107=IT+ITC' nel dizionario usato da
+    build_sdmx_key. Restituisce None per un testo vuoto.
+    """
+    text = text.strip()
+    if not text:
+        return None
+    spec = {}
+    for part in text.split(';'):
+        if not part.strip():
+            continue
+        dimension, _, codes = part.partition('=')
+        spec[dimension.strip().upper()] = [c.strip() for c in codes.split('+') if c.strip()]
+    return spec
+
+
+def ensure_refresh_state_table(conn):
+    """
+    Crea (se serve) la tabella con lo stato dei refresh dei dataflow.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS dataflow_refresh_state (
+            dataflow_id VARCHAR PRIMARY KEY,
+            last_refresh TIMESTAMPTZ,
+            last_full_refresh TIMESTAMPTZ,
+            last_mode VARCHAR,
+            last_rows BIGINT,
+            filter_spec JSONB,
+            sdmx_key VARCHAR
         )
-        """
-        cur.execute(create_table_query)
+        """)
+        cur.execute("ALTER TABLE dataflow_refresh_state ADD COLUMN IF NOT EXISTS filter_spec JSONB")
+        cur.execute("ALTER TABLE dataflow_refresh_state ADD COLUMN IF NOT EXISTS sdmx_key VARCHAR")
         conn.commit()
 
-        insert_query = """
-        INSERT INTO dataflow_categories (dataflow_id, category_id)
-        VALUES (%s, %s)
-        ON CONFLICT DO NOTHING
-        """
 
-        total_inserts = sum(len(dflist) for dflist in dataflow_category_map.values())
-        with tqdm(total=total_inserts, desc="Inserimento mappature df-categorie") as pbar:
-            for cat_id, dflist in dataflow_category_map.items():
-                for df_id in dflist:
-                    cur.execute(insert_query, (df_id, cat_id))
-                    pbar.update(1)
-        conn.commit()
+def load_refresh_state(conn, dataflow_ids):
+    """
+    Restituisce { dataflow_id: {colonna: valore} } dello stato dei refresh.
+    """
+    ensure_refresh_state_table(conn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT * FROM dataflow_refresh_state WHERE dataflow_id = ANY(%s)",
+                    (list(dataflow_ids),))
+        names = [d[0] for d in cur.description]
+        return {row[0]: dict(zip(names, row)) for row in cur.fetchall()}
+
+
+def save_refresh_state(conn, dataflow_id, started_at, mode, rows, filter_spec=None, sdmx_key='ALL'):
+    """
+    Registra un refresh riuscito con il filtro usato (riutilizzato dai refresh successivi);
+    last_full_refresh avanza solo con i caricamenti completi.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO dataflow_refresh_state AS s
+                (dataflow_id, last_refresh, last_full_refresh, last_mode, last_rows, filter_spec, sdmx_key)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (dataflow_id) DO UPDATE SET
+                last_refresh = EXCLUDED.last_refresh,
+                last_full_refresh = COALESCE(EXCLUDED.last_full_refresh, s.last_full_refresh),
+                last_mode = EXCLUDED.last_mode,
+                last_rows = EXCLUDED.last_rows,
+                filter_spec = EXCLUDED.filter_spec,
+                sdmx_key = EXCLUDED.sdmx_key
+        """, (dataflow_id, started_at, started_at if mode == 'full' else None, mode, rows,
+              json.dumps(filter_spec) if filter_spec else None, sdmx_key))
+    conn.commit()
+
+
+def plan_dataflow_refresh(conn, dataflow_id, state, started_at, full_refresh=False):
+    """
+    Decide come aggiornare il dataflow: restituisce ('full', {}) oppure
+    ('incremental', parametri SDMX) con updatedAfter o startPeriod secondo INCREMENTAL_STRATEGY.
+    Il caricamento è completo se il dataflow non è mai stato caricato, manca la chiave
+    di serie o è passato più di FULL_RECONCILE_DAYS dall'ultimo caricamento completo.
+    """
+    if full_refresh or not (INCREMENTAL_REFRESH and STREAMING_CSV_LOAD) or not state:
+        return 'full', {}
+    if not state.get('last_full_refresh') or \
+            started_at - state['last_full_refresh'] > timedelta(days=FULL_RECONCILE_DAYS):
+        return 'full', {}
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(quote_ident(%s)) IS NOT NULL, to_regclass(quote_ident(%s)) IS NOT NULL",
+                    (dataflow_id, series_key_index_name(dataflow_id)))
+        table_present, index_present = cur.fetchone()
+    if not (table_present and index_present):
+        return 'full', {}
+
+    if INCREMENTAL_STRATEGY == 'startPeriod':
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("SELECT max(left(time_period, 4)) FROM {}").format(sql.Identifier(dataflow_id)))
+            last_year = cur.fetchone()[0]
+        if not last_year or not last_year.isdigit():
+            return 'full', {}
+        return 'incremental', {'startPeriod': str(int(last_year) - INCREMENTAL_LOOKBACK_YEARS)}
+
+    last_refresh = state['last_refresh'].astimezone(timezone.utc)
+    return 'incremental', {'updatedAfter': last_refresh.strftime('%Y-%m-%dT%H:%M:%SZ')}
+
+
+# =============================================================================
+# LAYOUT A DIZIONARIO (fatti codificati + vista con la forma originale)
+# =============================================================================
+
+SMALLINT_MAX = 2 ** 15 - 1
+
 
-    print("Mappatura categorie completata.\n")
-    return categories_db, dataflow_category_map
+def facts_table_name(table_name):
+    """
+    Nome della tabella dei fatti del dataflow nel layout a dizionario.
+    """
+    return f"{table_name}__facts"
 
 
-def create_dataflow_category_view(conn):
+def ensure_dictionary_tables(conn):
     """
-    Crea/aggiorna la view dataflow_category_view per comodità.
+    Crea (se servono) il dizionario condiviso dei codici e i metadati delle tabelle
+    a dizionario. Va chiamata sulla connessione principale prima di avviare i worker.
     """
     with conn.cursor() as cur:
-        query = """
-        CREATE OR REPLACE VIEW dataflow_category_view AS
-        SELECT
-            dc.dataflow_id,
-            df.nome_it AS dataflow_nome_it,
-            dc.category_id,
-            c.name_it AS category_nome_it
-        FROM dataflow_categories dc
-        JOIN dataflow df ON dc.dataflow_id = df.id
-        JOIN categories c ON dc.category_id = c.category_id
-        """
-        cur.execute(query)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS dimension_dictionary (
+            column_name VARCHAR,
+            code_key SMALLINT,
+            code TEXT NOT NULL,
+            PRIMARY KEY (column_name, code_key),
+            UNIQUE (column_name, code)
+        )
+        """)
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS fact_table_metadata (
+            table_name VARCHAR,
+            column_name VARCHAR,
+            position INTEGER,
+            data_type VARCHAR,
+            encoding VARCHAR,
+            value TEXT,
+            PRIMARY KEY (table_name, column_name)
+        )
+        """)
         conn.commit()
-    print("Vista 'dataflow_category_view' creata/aggiornata correttamente.")
-
 
-# ------------------------------------------------------------------------------
-# FUNZIONE select_category(conn) PER SCEGLIERE UNA CATEGORIA CON OPZIONE B
-# ------------------------------------------------------------------------------
 
-def select_category(conn):
+def profile_columns(conn, table_name, column_defs):
     """
-    Mostra l'elenco di (category_id, name_it, name_en) e chiede
-    all'utente di digitare *direttamente* l'ID della categoria (oppure 0 per annullare).
-    Restituisce l'ID categoria scelto o None se l'utente annulla.
+    Una sola scansione di `table_name`: restituisce (righe, [(valori distinti, valori non
+    NULL, un valore)] per colonna).
     """
     with conn.cursor() as cur:
-        cur.execute("SELECT category_id, name_it, name_en FROM categories ORDER BY category_id")
-        rows = cur.fetchall()
+        cur.execute(sql.SQL("SELECT count(*), {} FROM {}").format(
+            sql.SQL(', ').join(
+                sql.SQL("count(DISTINCT {0}), count({0}), min({0}::text)").format(sql.Identifier(c))
+                for c, _ in column_defs
+            ),
+            sql.Identifier(table_name)
+        ))
+        row = cur.fetchone()
+    return row[0], [row[i:i + 3] for i in range(1, len(row), 3)]
 
-    if not rows:
-        print("Nessuna categoria trovata nella tabella 'categories'.")
-        return None
 
-    # Prepara un dizionario per rapida ricerca: { category_id: (name_it, name_en) }
-    cat_dict = {}
-    for (cat_id, name_it, name_en) in rows:
-        cat_dict[cat_id] = (name_it, name_en)
+def plan_column_encodings(total_rows, column_defs, profile):
+    """
+    Codifica di ogni colonna: 'constant' (stesso valore, o NULL, su tutte le righe),
+    'dictionary' (testo con al più DICTIONARY_MAX_CARDINALITY valori, escluso time_period)
+    oppure 'plain'. Restituisce [(colonna, tipo, codifica, valore costante)].
+    """
+    layout = []
+    for (column, column_type), (distinct, non_null, value) in zip(column_defs, profile):
+        if distinct <= 1 and non_null in (0, total_rows):
+            layout.append((column, column_type, 'constant', value))
+        elif column_type == 'TEXT' and column != 'time_period' and distinct <= DICTIONARY_MAX_CARDINALITY:
+            layout.append((column, column_type, 'dictionary', None))
+        else:
+            layout.append((column, column_type, 'plain', None))
+    return layout
 
-    print("\nCategorie disponibili (category_id => Nome):")
-    for cat_id in sorted(cat_dict):
-        name_it, name_en = cat_dict[cat_id]
-        display_name = name_it or name_en or cat_id
-        print(f" - {cat_id} => {display_name}")
 
-    while True:
-        user_input = input("\nDigita l'ID della categoria (0 per annullare): ").strip()
-        if user_input == "0":
-            return None
-        if user_input in cat_dict:
-            print(f"Hai selezionato la categoria con ID: {user_input}")
-            return user_input
+def extend_dimension_dictionary(conn, shadow_name, layout):
+    """
+    Aggiunge a dimension_dictionary i codici nuovi delle colonne 'dictionary' (chiavi
+    progressive per colonna). Una colonna il cui spazio di chiavi SMALLINT sarebbe
+    esaurito resta 'plain'. Restituisce il layout aggiornato.
+    """
+    updated = []
+    with transaction(conn), conn.cursor() as cur:
+        # Un solo writer alla volta assegna le chiavi (caricamenti in parallelo)
+        cur.execute("LOCK TABLE dimension_dictionary IN SHARE ROW EXCLUSIVE MODE")
+        for column, column_type, encoding, value in layout:
+            if encoding == 'dictionary':
+                new_codes = sql.SQL("""
+                    SELECT DISTINCT {col} AS code FROM {shadow} WHERE {col} IS NOT NULL
+                    EXCEPT SELECT code FROM dimension_dictionary WHERE column_name = %(column)s
+                """).format(col=sql.Identifier(column), shadow=sql.Identifier(shadow_name))
+                cur.execute(sql.SQL("""
+                    SELECT (SELECT COALESCE(max(code_key), 0) FROM dimension_dictionary
+                            WHERE column_name = %(column)s),
+                           (SELECT count(*) FROM ({new_codes}) n)
+                """).format(new_codes=new_codes), {'column': column})
+                last_key, added = cur.fetchone()
+                if last_key + added > SMALLINT_MAX:
+                    print(f"Dizionario di {column} pieno, colonna non codificata.")
+                    encoding = 'plain'
+                elif added:
+                    cur.execute(sql.SQL("""
+                        INSERT INTO dimension_dictionary (column_name, code_key, code)
+                        SELECT %(column)s, %(last_key)s + row_number() OVER (ORDER BY code), code
+                        FROM ({new_codes}) n
+                    """).format(new_codes=new_codes), {'column': column, 'last_key': last_key})
+            updated.append((column, column_type, encoding, value))
+    return updated
+
+
+def create_facts_query(facts_name, shadow_name, layout):
+    """
+    CREATE TABLE AS dei fatti: le colonne 'dictionary' diventano le chiavi SMALLINT del
+    dizionario, le 'plain' restano invariate, le 'constant' sono omesse.
+    """
+    columns, joins = [], []
+    for position, (column, _, encoding, _) in enumerate(layout):
+        if encoding == 'dictionary':
+            alias = sql.Identifier(f"d{position}")
+            columns.append(sql.SQL("{}.code_key AS {}").format(alias, sql.Identifier(column)))
+            joins.append(sql.SQL(
+                "LEFT JOIN dimension_dictionary {alias} ON {alias}.column_name = {name} AND {alias}.code = s.{col}"
+            ).format(alias=alias, name=sql.Literal(column), col=sql.Identifier(column)))
+        elif encoding == 'plain':
+            columns.append(sql.SQL("s.{}").format(sql.Identifier(column)))
+    return sql.SQL("CREATE TABLE {} AS SELECT {} FROM {} s {}").format(
+        sql.Identifier(facts_name), sql.SQL(', ').join(columns),
+        sql.Identifier(shadow_name), sql.SQL(' ').join(joins)
+    )
+
+
+def create_compatibility_view_query(view_name, facts_name, layout):
+    """
+    Vista con la forma larga originale sopra i fatti: codici decodificati dal dizionario
+    e colonne costanti come letterali, nell'ordine e con i tipi del CSV caricato.
+    """
+    columns, joins = [], []
+    for position, (column, column_type, encoding, value) in enumerate(layout):
+        target = sql.Identifier(column)
+        if encoding == 'constant':
+            columns.append(sql.SQL("{}::{} AS {}").format(sql.Literal(value), sql.SQL(column_type), target))
+        elif encoding == 'dictionary':
+            alias = sql.Identifier(f"d{position}")
+            columns.append(sql.SQL("{}.code AS {}").format(alias, target))
+            joins.append(sql.SQL(
+                "LEFT JOIN dimension_dictionary {alias} ON {alias}.column_name = {name} AND {alias}.code_key = f.{col}"
+            ).format(alias=alias, name=sql.Literal(column), col=target))
         else:
-            print(f"L'ID '{user_input}' non esiste tra le categorie. Riprova (o digita 0 per annullare).")
+            columns.append(sql.SQL("f.{} AS {}").format(target, target))
+    return sql.SQL("CREATE VIEW {} AS SELECT {} FROM {} f {}").format(
+        sql.Identifier(view_name), sql.SQL(', ').join(columns),
+        sql.Identifier(facts_name), sql.SQL(' ').join(joins)
+    )
+
+
+def save_table_metadata(conn, table_name, layout):
+    """
+    Sostituisce in fact_table_metadata la descrizione delle colonne di `table_name`.
+    """
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM fact_table_metadata WHERE table_name = %s", (table_name,))
+        for position, (column, column_type, encoding, value) in enumerate(layout):
+            cur.execute("""
+                INSERT INTO fact_table_metadata (table_name, column_name, position, data_type, encoding, value)
+                VALUES (%s, %s, %s, %s, %s, %s)
+            """, (table_name, column, position, column_type, encoding, value))
+    conn.commit()
+
+
+def encode_dictionary_layout(conn, table_name, shadow_name, column_defs, key_columns=None):
+    """
+    Porta il CSV caricato (formato largo) nella shadow al layout a dizionario:
+    le colonne costanti vanno in fact_table_metadata, quelle testuali a bassa cardinalità
+    diventano chiavi SMALLINT di dimension_dictionary, i fatti vanno in <df>__facts e
+    <df> diventa una vista con la forma originale. Fatti, vista e metadati sono
+    sostituiti in un'unica transazione con swap_shadow_table (viste dipendenti preservate).
+    """
+    ensure_dictionary_tables(conn)
+    facts_name = facts_table_name(table_name)
+    facts_shadow = shadow_table_name(facts_name)
+
+    total_rows, profile = profile_columns(conn, shadow_name, column_defs)
+    layout = extend_dimension_dictionary(conn, shadow_name,
+                                         plan_column_encodings(total_rows, column_defs, profile))
+
+    with transaction(conn), conn.cursor() as cur:
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(facts_shadow)))
+        cur.execute(create_facts_query(facts_shadow, shadow_name, layout))
+        cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(shadow_name)))
+        # La vista shadow punta alla tabella dei fatti shadow e la segue nella rinomina
+        cur.execute(create_compatibility_view_query(shadow_name, facts_shadow, layout))
+
+    index_renames = build_shadow_indexes(conn, facts_name, facts_shadow)
+    fact_columns = {column for column, _, encoding, _ in layout if encoding != 'constant'}
+    if key_columns and set(key_columns) <= {column for column, _ in column_defs}:
+        index_renames += build_series_key_index(conn, facts_name, facts_shadow,
+                                                [c for c in key_columns if c in fact_columns], index_renames)
+
+    with transaction(conn):
+        swap_shadow_table(conn, table_name, shadow_name)
+        swap_shadow_table(conn, facts_name, facts_shadow, index_renames)
+        save_table_metadata(conn, table_name, layout)
+
+    constants = [column for column, _, encoding, _ in layout if encoding == 'constant']
+    encoded = [column for column, _, encoding, _ in layout if encoding == 'dictionary']
+    print(f"Layout a dizionario per {table_name}: {len(constants)} colonne costanti "
+          f"({', '.join(constants) or '-'}), {len(encoded)} codificate ({', '.join(encoded) or '-'})")
+
+
+def drop_dictionary_layout(conn, table_name):
+    """
+    Elimina fatti e metadati del layout a dizionario di `table_name` rimasti da un
+    caricamento precedente (ad es. dopo il ritorno al layout 'wide').
+    """
+    facts_name = facts_table_name(table_name)
+    if not table_exists(conn, facts_name):
+        return
+    with transaction(conn), conn.cursor() as cur:
+        cur.execute(sql.SQL("DROP TABLE {} CASCADE").format(sql.Identifier(facts_name)))
+        cur.execute("DELETE FROM fact_table_metadata WHERE table_name = %s", (table_name,))
 
 
 # =============================================================================
-# PARTE 2: CSV + Classificazioni
+# MANIFEST DEGLI IMPORT (pipeline_manifest)
 # =============================================================================
 
-def download_content(url, file_name):
+def ensure_manifest_table(conn):
     """
-    Scarica un file generico (CSV/XML) e lo salva in DOWNLOAD_DIR.
-    Se esiste già in versione non-importata, ritorna (None, None).
+    Crea (se serve) il manifest: una riga per ogni file caricato (o saltato perché
+    invariato) con URL, sha256 e dimensione del contenuto, righe, durata e tabella.
+    Va chiamata sulla connessione principale prima di avviare i worker.
     """
-    file_path = os.path.join(DOWNLOAD_DIR, file_name)
-    import_file_path = os.path.join(
-        DOWNLOAD_DIR,
-        f"{os.path.splitext(file_name)[0]}_import{os.path.splitext(file_name)[1]}"
-    )
+    with conn.cursor() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS pipeline_manifest (
+            target_table VARCHAR,
+            imported_at TIMESTAMPTZ,
+            url TEXT,
+            file_path TEXT,
+            sha256 VARCHAR(64),
+            byte_size BIGINT,
+            row_count BIGINT,
+            load_duration INTERVAL,
+            status VARCHAR,
+            PRIMARY KEY (target_table, imported_at)
+        )
+        """)
+        conn.commit()
 
-    # Se il file è già stato importato, nessuna azione
-    if os.path.exists(import_file_path):
-        print(f"File {import_file_path} già importato, nessuna azione necessaria.")
-        return None, None
 
-    # Se esiste (non importato), cancelliamolo
-    if os.path.exists(file_path):
-        print(f"File {file_path} esistente. Lo cancello e riscarico.")
-        os.remove(file_path)
+def content_digest(path):
+    """
+    Restituisce (sha256 esadecimale, byte) del contenuto del file, decompresso se .gz:
+    lo stesso contenuto ha lo stesso checksum comunque sia salvato.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open_raw_file(path) as f:
+        for chunk in iter(lambda: f.read(RAW_IO_BUFFER_SIZE), b''):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
 
-    # Scarica
-    response = requests.get(url, stream=True)
-    if response.status_code != 200:
-        print(f"Errore nel download del file: HTTP {response.status_code}")
-        return None, None
 
-    total_size = int(response.headers.get('content-length', 0))
-    block_size = 1024
+def build_artifact(url, file_path):
+    """
+    Descrizione di un file scaricato per il manifest (URL, percorso, sha256, dimensione).
+    """
+    sha256, byte_size = content_digest(file_path)
+    return {'url': url, 'file_path': file_path, 'sha256': sha256, 'byte_size': byte_size}
 
-    with open(file_path, 'wb') as f:
-        with tqdm(total=total_size, unit='iB', unit_scale=True,
-                  desc=f"Downloading {file_name}") as t:
-            for data in response.iter_content(block_size):
-                t.update(len(data))
-                f.write(data)
 
-    # Determina tipo (csv/xml) dal nome
-    if file_name.endswith('.csv'):
-        return file_path, 'csv'
-    elif file_name.endswith('.xml'):
-        return file_path, 'xml'
-    else:
-        return file_path, None
+def load_last_imports(conn, target_tables, statuses=('loaded',)):
+    """
+    Restituisce { tabella: riga del manifest } con l'ultimo import riuscito di ogni tabella
+    (con `statuses` ('loaded', 'skipped') anche l'ultima verifica di un file invariato).
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT DISTINCT ON (target_table) *
+            FROM pipeline_manifest
+            WHERE target_table = ANY(%s) AND status = ANY(%s)
+            ORDER BY target_table, imported_at DESC
+        """, (list(target_tables), list(statuses)))
+        names = [d[0] for d in cur.description]
+        return {row[0]: dict(zip(names, row)) for row in cur.fetchall()}
 
 
-def extract_data_from_csv(file_path):
+def record_manifest_entry(conn, target_table, artifact, row_count=None, load_duration=None, status='loaded'):
     """
-    Legge un CSV a chunk e rimuove colonne in EXCLUDE_FIELDS.
-    Restituisce un DataFrame concatenato.
+    Registra nel manifest il caricamento (status 'loaded', 'skipped' o 'failed') del file
+    descritto da `artifact`; `load_duration` in secondi.
     """
-    print(f"Lettura CSV: {file_path}")
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO pipeline_manifest (target_table, imported_at, url, file_path, sha256,
+                                           byte_size, row_count, load_duration, status)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (target_table, datetime.now(timezone.utc), artifact.get('url'), artifact.get('file_path'),
+              artifact.get('sha256'), artifact.get('byte_size'), row_count,
+              timedelta(seconds=load_duration) if load_duration is not None else None, status))
+    conn.commit()
+
+
+def parse_codelist_element(codelist_elem):
+    """
+    Estrae da un elemento structure:Codelist il suo id e i Code (code_id, name_it, name_en).
+    """
+    data = []
+    for code in codelist_elem.findall('.//structure:Code', namespaces=NAMESPACES):
+        code_id = code.attrib.get('id')
+        name_it_elem = code.find('.//common:Name[@xml:lang="it"]', namespaces=NAMESPACES)
+        name_en_elem = code.find('.//common:Name[@xml:lang="en"]', namespaces=NAMESPACES)
+        data.append((
+            code_id,
+            name_it_elem.text if name_it_elem is not None else None,
+            name_en_elem.text if name_en_elem is not None else None
+        ))
+    return codelist_elem.attrib.get('id'), data
+
+
+def extract_codes_from_codelist(root):
+    """
+    Estrae i Code (code_id, name_it, name_en) da tutti i Codelist del messaggio XML.
+    """
+    data = []
+    for codelist_elem in root.findall('.//structure:Codelist', namespaces=NAMESPACES):
+        codelist_id, codes = parse_codelist_element(codelist_elem)
+        print(f"  Trovato codelist: {codelist_id}")
+        data.extend(codes)
+    return data
+
+
+def fetch_codelist(enum_id, imported_sha256=None, structure_format=None):
+    """
+    Stadio di fetch (eseguito nei thread): scarica il codelist `enum_id` e ne restituisce
+    (codici, artefatto per il manifest). Se il contenuto ha lo sha256 `imported_sha256`
+    (ultimo import riuscito) il parsing è saltato e i codici sono None; in caso di errore
+    restituisce (None, None).
+    Con il backend JSON il codelist arriva in SDMX-JSON tramite la cache HTTP.
+    """
+    file_name = f"{enum_id}.xml"
+    url = f"{ISTAT_REST_V2}/codelist/IT1/{enum_id}"
+    structure_format = structure_format or STRUCTURE_FORMAT
+    print(f"\nProcesso codelist {enum_id} => {file_name}")
+
     try:
-        chunks = pd.read_csv(file_path, chunksize=10000, delimiter=',')
-        data_parts = []
-        for chunk in tqdm(chunks, desc="Lettura del CSV", unit='chunk'):
-            keep_cols = [c for c in chunk.columns if c.lower() not in EXCLUDE_FIELDS]
-            data_parts.append(chunk[keep_cols])
-        data_combined = pd.concat(data_parts, ignore_index=True)
-        if not data_combined.empty:
-            print(f"Prime righe:\n{data_combined.head()}")
+        if structure_format != 'xml':
+            path = fetch_cached(url, headers={'Accept': STRUCTURE_ACCEPT[structure_format]})
         else:
-            print("Il CSV non contiene dati.")
-        return data_combined
+            path = download_raw_file(url, file_name)
+        if path is None:
+            return None, None
+
+        artifact = build_artifact(url, path)
+        if imported_sha256 and artifact['sha256'] == imported_sha256:
+            print(f"Codelist {enum_id} invariato dall'ultimo import.")
+            return None, artifact
+        document = load_structure_document(path, structure_format)
+        return get_structure_parser(structure_format, 'codelist')(document), artifact
     except Exception as e:
-        print(f"Errore estrazione CSV: {e}")
-        return pd.DataFrame()
+        print(f"Errore elaborazione codelist {enum_id}: {e}")
+        return None, None
 
 
-def create_table_from_data(table_name, data, conn):
+def save_codelist_to_postgresql(conn, enum_id, data):
     """
-    Crea una tabella (nome = `table_name`) con tutte le colonne come TEXT,
-    e copia i dati del DataFrame in blocchi da 10k righe.
+    Crea (se serve) la tabella del codelist e vi carica i codici con un'unica scrittura bulk.
+    Le etichette dei codici già presenti vengono aggiornate se sono cambiate.
     """
-    if data.empty:
-        print(f"Nessun dato trovato per la tabella {table_name}")
-        return False
+    table_name_clean = sanitize_column_name(enum_id)
+    with conn.cursor() as cur:
+        create_table_query = f"""
+        CREATE TABLE IF NOT EXISTS "{table_name_clean}" (
+            code_id VARCHAR PRIMARY KEY,
+            name_it TEXT,
+            name_en TEXT
+        )
+        """
+        cur.execute(create_table_query)
+        conn.commit()
+
+    return bulk_upsert(conn, table_name_clean, ['code_id', 'name_it', 'name_en'], data,
+                       key_columns=['code_id'])
+
+
+def download_and_save_classifications(conn, tables_to_download, workers=None):
+    """
+    Data una lista di dataflow, trova enum_id e scarica codelist (XML) in tabelle separate.
+    Download e parsing avvengono in parallelo (al più `workers` thread, default
+    CODELIST_FETCH_WORKERS); un solo writer sulla connessione `conn` carica i codelist
+    nell'ordine degli enum_id, con lo stesso risultato di un'esecuzione seriale.
+    Ogni codelist viene registrato in pipeline_manifest; quelli identici all'ultimo import
+    (stesso sha256, tabella presente) non vengono riscritti. Con CODELIST_RECHECK_INTERVAL
+    i codelist con tabella presente e verificati nel manifest entro quell'intervallo non
+    vengono richiesti.
+    """
+    workers = workers or CODELIST_FETCH_WORKERS
+    with conn.cursor() as cur:
+        query = """
+        SELECT DISTINCT enum_id
+        FROM datastructure_details
+        WHERE enum_id IS NOT NULL
+          AND datastructure_id IN (SELECT ref_id FROM dataflow WHERE id = ANY(%s))
+          AND type = 'Dimension';
+        """
+        cur.execute(query, (list(tables_to_download),))
+        enum_ids = sorted(row[0] for row in cur.fetchall() if row[0])
+
+    if not enum_ids:
+        print("Nessun enum_id trovato per i dataflow selezionati.")
+        return
+
+    print(f"Scaricamento classificazioni per {len(enum_ids)} enum_id ({workers} in parallelo)...")
 
+    # Le verifiche sul DB restano sul thread principale: ai thread solo rete e parsing
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT table_name FROM information_schema.tables
+            WHERE table_schema = %s AND table_name = ANY(%s)
+        """, (ISTAT_SCHEMA, [sanitize_column_name(e) for e in enum_ids]))
+        existing_tables = {row[0] for row in cur.fetchall()}
+
+    ensure_manifest_table(conn)
+    last_imports = load_last_imports(conn, existing_tables) if MANIFEST_SKIP_UNCHANGED else {}
+    imported_sha256 = {enum_id: last_imports[sanitize_column_name(enum_id)]['sha256']
+                       for enum_id in enum_ids if sanitize_column_name(enum_id) in last_imports}
+
+    # Niente richiesta (neanche condizionale) per i codelist verificati di recente
+    max_age = CODELIST_RECHECK_INTERVAL
+    if max_age is not None:
+        last_checks = load_last_imports(conn, existing_tables, ('loaded', 'skipped'))
+        now = datetime.now(timezone.utc)
+        fresh = [enum_id for enum_id in enum_ids
+                 if sanitize_column_name(enum_id) in last_checks
+                 and (now - last_checks[sanitize_column_name(enum_id)]['imported_at']).total_seconds() < max_age]
+        if fresh:
+            print(f"{len(fresh)} codelist verificati da meno di {max_age}s, nessuna richiesta.")
+            enum_ids = [enum_id for enum_id in enum_ids if enum_id not in fresh]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda enum_id: fetch_codelist(enum_id, imported_sha256.get(enum_id)), enum_ids)
+        for enum_id, (data, artifact) in zip(enum_ids, results):
+            table_name_clean = sanitize_column_name(enum_id)
+            if artifact is None:
+                print(f"ERRORE: Impossibile importare codelist {enum_id}")
+                continue
+            if data is None:
+                record_manifest_entry(conn, table_name_clean, artifact, status='skipped')
+                continue
+
+            start = time.perf_counter()
+            save_codelist_to_postgresql(conn, enum_id, data)
+            record_manifest_entry(conn, table_name_clean, artifact, len(data), time.perf_counter() - start)
+            print(f"Classificazione {enum_id} salvata con successo.")
+
+
+def plan_dataflow_download(conn, df_id, state, filter_spec, full_refresh=False):
+    """
+    Prepara il download di un dataflow: chiave SDMX dal filtro, modalità (completa o
+    incrementale) e parametri. Un filtro diverso da quello dell'ultimo refresh implica
+    un caricamento completo. Restituisce il piano (dizionario) o None se il filtro non è valido.
+    """
     try:
-        with conn.cursor() as cur:
-            # Rimuoviamo la tabella se esiste
-            drop_table_query = f'DROP TABLE IF EXISTS "{table_name}" CASCADE'
-            print(f"Eliminazione tabella con query: {drop_table_query}")
-            cur.execute(drop_table_query)
+        sdmx_key = build_sdmx_key(get_dimension_ids(conn, df_id), filter_spec)
+    except ValueError as e:
+        print(f"Filtro non valido per {df_id}: {e}")
+        return None
+    filter_changed = sdmx_key != (state.get('sdmx_key') or 'ALL')
+
+    started_at = datetime.now(timezone.utc)
+    mode, params = plan_dataflow_refresh(conn, df_id, state, started_at, full_refresh or filter_changed)
+    return {
+        'df_id': df_id,
+        'mode': mode,
+        'params': params,
+        'sdmx_key': sdmx_key,
+        'filter_spec': filter_spec,
+        'started_at': started_at,
+        'key_columns': get_series_key_columns(conn, df_id),
+        'file_path': os.path.join(DOWNLOAD_DIR, raw_file_name(f"{df_id}.csv")),
+    }
+
+
+def dataflow_csv_url(plan):
+    """
+    URL del CSV del piano (con updatedAfter/startPeriod se incrementale).
+    """
+    params = plan['params'] if plan['mode'] == 'incremental' else {}
+    return f"{ISTAT_REST_V2}/data/{plan['df_id']}/{plan['sdmx_key']}?{urlencode({'format': 'csv', **params})}"
 
-            # Sanitizza colonne
-            columns = [sanitize_column_name(col) for col in data.columns]
-            if len(columns) != len(set(columns)):
-                print("Errore: nomi di colonne duplicati dopo sanitizzazione.")
-                return False
 
-            print(f"Nomi colonne CSV: {columns}")
-            columns_str = ', '.join([f'"{col}" TEXT' for col in columns])
+def download_dataflow(plan, consume, max_retries=3):
+    """
+    Scarica il CSV del piano e ne passa il body (stream binario) a consume(plan, raw),
+    ripetendo la richiesta (con attese esponenziali) anche per errori a metà trasferimento.
+    Restituisce (esito, risultato di consume): un refresh incrementale senza variazioni
+    (404) dà (True, 0); errore server 500 o tentativi esauriti danno (False, None).
+    Se consume riporta il piano a 'full' (delta non compatibile) si riscarica tutto.
+    """
+    df_id = plan['df_id']
+    for attempt in range(max_retries):
+        url = dataflow_csv_url(plan)
+        mode = plan['mode']
+        try:
+            print(f"\nTentativo {attempt + 1}/{max_retries} per {df_id}")
+            print(f"Download CSV ({mode}): {url}")
+
+            response = http_get(url, stream=True)
+            if response.status_code == 500:
+                print(f"Errore server (500) per {df_id}. Potrebbe essere necessario scaricare prima altri dataset correlati.")
+                return False, None
+            if mode == 'incremental' and response.status_code == 404:
+                # Nessuna osservazione nella finestra richiesta: la tabella è già aggiornata
+                print(f"{df_id}: nessuna variazione dall'ultimo refresh.")
+                return True, 0
+
+            response.raise_for_status()
+            response.raw.decode_content = True
+            source = TeeStream(response.raw)
+            try:
+                result = consume(plan, source)
+            except psycopg2.Error:
+                if source.read_error is None:
+                    raise
+                # Connessione interrotta durante la COPY: libpq la riporta come errore di COPY,
+                # si rilancia l'errore di rete originale per ripetere la richiesta
+                raise source.read_error
+            if result is None and mode == 'incremental' and plan['mode'] == 'full':
+                continue
+            return True, result
 
-            create_table_query = f'CREATE TABLE IF NOT EXISTS "{table_name}" ({columns_str})'
-            print(f"Creazione tabella: {create_table_query}")
-            cur.execute(create_table_query)
-            conn.commit()
+        except (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) as e:
+            print(f"Errore download per {df_id} (tentativo {attempt + 1}): {str(e)}")
+            if attempt < max_retries - 1:
+                wait_time = download_backoff(attempt)
+                print(f"Attendo {wait_time} secondi prima del prossimo tentativo...")
+                time.sleep(wait_time)
+        except psycopg2.Error as e:
+            print(f"Errore durante il caricamento di {df_id}: {e}")
+            return False, None
 
-            total_rows = len(data)
-            chunk_size = 10000
-            from io import StringIO
-            for i in tqdm(range(0, total_rows, chunk_size),
-                          desc=f"Caricamento dati in {table_name}",
-                          unit='rows'):
-                buffer = StringIO()
-                chunk = data.iloc[i:i + chunk_size]
-                # Scrive CSV senza header/index in buffer
-                chunk.to_csv(buffer, index=False, header=False)
-                buffer.seek(0)
-                copy_sql = f'COPY "{table_name}" FROM STDIN WITH CSV'
-                cur.copy_expert(copy_sql, buffer)
-                conn.commit()
-        return True
-    except Exception as e:
-        print(f"Errore creazione tabella {table_name}: {e}")
-        return False
+    print(f"Non è stato possibile scaricare i dati per {df_id} dopo {max_retries} tentativi.")
+    return False, None
 
 
-def download_and_parse_xml_file(url, file_name, conn):
+def load_dataflow_source(conn, plan, source, tee_path=None, size_hint=None, stream_info=None):
     """
-    Scarica (o riusa se già presente) il file XML per un codelist.
-    - Se la tabella corrispondente esiste e ho *_import.xml, non fa nulla (rest. None).
-    - Se la tabella non esiste ma ho *_import.xml, rileggo il file e restituisco l’albero XML.
-    - Altrimenti, scarica ex novo.
+    Carica lo stream CSV `source` secondo il piano: caricamento completo con swap oppure
+    merge del delta. Se il delta non è compatibile con la tabella il piano passa a 'full'
+    e viene restituito None. `size_hint` (byte del CSV) abilita la COPY parallela;
+    `stream_info` vale per il caricamento completo (vedi stream_csv_to_table).
     """
-    base_name = os.path.splitext(file_name)[0]
-    table_name_clean = sanitize_column_name(base_name)
+    if plan['mode'] == 'incremental':
+        rows = stream_csv_delta_to_table(conn, plan['df_id'], source, plan['key_columns'])
+        if rows is None:
+            plan['mode'] = 'full'
+        return rows
+    return stream_csv_to_table(conn, plan['df_id'], source, tee_path=tee_path,
+                               key_columns=plan['key_columns'], size_hint=size_hint,
+                               stream_info=stream_info)
 
-    file_path = os.path.join(DOWNLOAD_DIR, file_name)
-    import_file_path = os.path.join(DOWNLOAD_DIR,
-                                    f"{base_name}_import{os.path.splitext(file_name)[1]}")
 
-    # 1) Se tabella esiste e file import esiste => nessuna azione
-    if table_exists(conn, table_name_clean) and os.path.exists(import_file_path):
-        print(f"Tabella {table_name_clean} esiste e {import_file_path} presente. Nessuna azione.")
-        return None
+def download_dataflow_file(plan):
+    """
+    Scarica il CSV del piano in DOWNLOAD_DIR con download_resumable (i delta vanno in
+    <df>_delta.csv). Restituisce (esito, percorso): un refresh incrementale senza variazioni
+    (404) dà (True, None); errore server 500 o tentativi esauriti danno (False, None).
+    """
+    df_id = plan['df_id']
+    if plan['mode'] == 'incremental':
+        file_path = os.path.join(DOWNLOAD_DIR, raw_file_name(f"{df_id}_delta.csv"))
+        give_up_statuses = (404, 500)
+    else:
+        file_path = plan['file_path']
+        give_up_statuses = (500,)
+
+    url = dataflow_csv_url(plan)
+    print(f"\nDownload CSV ({plan['mode']}): {url}")
+    status = download_resumable(url, file_path, give_up_statuses, desc=f"Downloading {df_id}")
+    if status == 500:
+        print(f"Errore server (500) per {df_id}. Potrebbe essere necessario scaricare prima altri dataset correlati.")
+        return False, None
+    if status == 404:
+        # Nessuna osservazione nella finestra richiesta: la tabella è già aggiornata
+        print(f"{df_id}: nessuna variazione dall'ultimo refresh.")
+        return True, None
+    if status is None:
+        print(f"Non è stato possibile scaricare i dati per {df_id}.")
+        return False, None
+    return True, file_path
+
+
+def load_dataflow_file(conn, plan, file_path):
+    """
+    Carica il CSV scaricato da download_dataflow_file (None = nessuna variazione) e ne
+    registra l'esito, anche nel manifest; un CSV identico all'ultimo import non viene
+    ricaricato. Se il delta non è compatibile con la tabella si scarica e si carica
+    il dataflow completo. Restituisce True se il dataflow è disponibile per la Parte 3.
+    """
+    if not file_path:
+        return finish_dataflow_load(conn, plan, 0)
 
-    # 2) Tabella non esiste, ma ho file import => rileggo
-    if (not table_exists(conn, table_name_clean)) and os.path.exists(import_file_path):
-        print(f"Tabella {table_name_clean} non esiste, ma c'è {import_file_path}. Lo importo.")
-        with open(import_file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        root = ET.fromstring(content)
-        return root
-
-    # 3) Se ho già file locale .xml non importato => lo uso
-    if os.path.exists(file_path):
-        print(f"File {file_path} già presente, uso file locale.")
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        root = ET.fromstring(content)
-        return root
-
-    # 4) Scarico file
-    print(f"Downloading: {url}")
-    try:
-        response = requests.get(url, stream=True)
-        if response.status_code != 200:
-            print(f"Errore download XML: {response.status_code}")
-            return None
+    artifact = build_artifact(dataflow_csv_url(plan), file_path)
+    if skip_unchanged_dataflow(conn, plan, artifact, file_path):
+        return True
+    start = time.perf_counter()
+    with open_raw_file(file_path) as source:
+        rows = load_dataflow_source(conn, plan, source, size_hint=artifact['byte_size'])
+    if rows is None and plan['mode'] == 'full' and file_path != plan['file_path']:
+        os.remove(file_path)
+        success, file_path = download_dataflow_file(plan)
+        if not success:
+            return False
+        artifact = build_artifact(dataflow_csv_url(plan), file_path)
+        if skip_unchanged_dataflow(conn, plan, artifact, file_path):
+            return True
+        start = time.perf_counter()
+        with open_raw_file(file_path) as source:
+            rows = load_dataflow_source(conn, plan, source, size_hint=artifact['byte_size'])
+    return finish_dataflow_load(conn, plan, rows, file_path, artifact, time.perf_counter() - start)
 
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 1024
 
-        with open(file_path, 'wb') as f:
-            with tqdm(total=total_size, unit='iB', unit_scale=True, desc=f"Downloading {file_name}") as t:
-                for data in response.iter_content(block_size):
-                    t.update(len(data))
-                    f.write(data)
+def finish_dataflow_load(conn, plan, rows, file_path=None, artifact=None, load_duration=None):
+    """
+    Registra l'esito del caricamento (stato del refresh e, con `artifact`, riga del
+    manifest). Il CSV completo resta in DOWNLOAD_DIR come copia grezza (eliminato se
+    CSV_TEE_TO_DISK è disattivato), i delta vengono eliminati; i file dei piani con
+    'keep_file' (ricostruzione offline) restano sempre.
+    Restituisce True se il dataflow è disponibile per la Parte 3.
+    """
+    df_id = plan['df_id']
+    loaded = bool(rows) or (plan['mode'] == 'incremental' and rows == 0)
+    if loaded:
+        save_refresh_state(conn, df_id, plan['started_at'], plan['mode'], rows,
+                           plan['filter_spec'], plan['sdmx_key'])
+        print(f"Dataset {df_id} importato con successo.")
+    else:
+        print(f"Nessun dato trovato nel CSV per {df_id}.")
+    if artifact:
+        record_manifest_entry(conn, df_id, artifact, rows, load_duration, 'loaded' if loaded else 'failed')
+
+    if plan.get('keep_file'):
+        return loaded
+    if file_path and os.path.exists(file_path) and (file_path != plan['file_path'] or not CSV_TEE_TO_DISK):
+        os.remove(file_path)
+    return loaded
 
-        # Parse in XML
-        with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        root = ET.fromstring(content)
-        return root
 
-    except Exception as e:
-        print(f"Errore download XML per {file_name}: {e}")
+def find_comparable_import(conn, plan):
+    """
+    Ultimo import riuscito (con sha256) del dataflow del piano a cui confrontare un nuovo
+    CSV completo, None se non c'è o se STORAGE_LAYOUT è cambiato (serve un caricamento).
+    """
+    if not MANIFEST_SKIP_UNCHANGED or plan['mode'] != 'full':
         return None
+    dictionary_layout = STREAMING_CSV_LOAD and STORAGE_LAYOUT == 'dictionary'
+    if table_exists(conn, facts_table_name(plan['df_id'])) != dictionary_layout:
+        return None
+    last_import = load_last_imports(conn, [plan['df_id']]).get(plan['df_id'])
+    if last_import and last_import['sha256'] and table_exists(conn, plan['df_id']):
+        return last_import
+    return None
 
 
-def download_and_save_classifications(conn, tables_to_download):
+def record_unchanged_dataflow(conn, plan, artifact, last_import, file_path=None):
     """
-    Data una lista di dataflow, trova enum_id e scarica codelist (XML) in tabelle separate.
+    Registra nel manifest ('skipped') e nello stato del refresh un CSV identico
+    all'ultimo import. Restituisce True (il dataflow resta disponibile per la Parte 3).
     """
-    enum_ids = set()
-    with conn.cursor() as cur:
-        for main_table in tables_to_download:
-            query = """
-            SELECT DISTINCT enum_id
-            FROM datastructure_details
-            WHERE enum_id IS NOT NULL 
-              AND datastructure_id = (SELECT ref_id FROM dataflow WHERE id = %s)
-              AND type = 'Dimension';
-            """
-            cur.execute(query, (main_table,))
-            for row in cur.fetchall():
-                if row[0]:
-                    enum_ids.add(row[0])
+    print(f"{plan['df_id']}: contenuto invariato dall'ultimo import "
+          f"(sha256 {artifact['sha256'][:12]}), caricamento saltato.")
+    record_manifest_entry(conn, plan['df_id'], artifact, last_import['row_count'], status='skipped')
+    return finish_dataflow_load(conn, plan, last_import['row_count'], file_path)
 
-    if not enum_ids:
-        print("Nessun enum_id trovato per i dataflow selezionati.")
-        return
 
-    print(f"Scaricamento classificazioni per {len(enum_ids)} enum_id...")
+def skip_unchanged_dataflow(conn, plan, artifact, file_path):
+    """
+    Se il CSV scaricato è identico all'ultimo import riuscito del dataflow (manifest),
+    registra il refresh senza ricaricare la tabella e restituisce True. Un cambio di
+    STORAGE_LAYOUT forza comunque il caricamento.
+    """
+    last_import = find_comparable_import(conn, plan)
+    if last_import is None or last_import['sha256'] != artifact['sha256']:
+        return False
+    return record_unchanged_dataflow(conn, plan, artifact, last_import, file_path)
 
-    for enum_id in enum_ids:
-        file_name = f"{enum_id}.xml"
-        url = f"{ISTAT_REST_V2}/codelist/IT1/{enum_id}"
-        print(f"\nProcesso codelist {enum_id} => {file_name}")
 
-        root = download_and_parse_xml_file(url, file_name, conn)
-        if root is None:
-            print(f"ERRORE: Impossibile importare codelist {enum_id}")
-            continue
+def plan_dataflow_downloads(conn, tables_to_download, full_refresh=False, filters=None):
+    """
+    Piani di download per i dataflow noti tra `tables_to_download`.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT ID FROM dataflow")
+        known_dataflows = {r[0] for r in cur.fetchall()}
+    refresh_state = load_refresh_state(conn, tables_to_download)
+    ensure_manifest_table(conn)
+    if STORAGE_LAYOUT == 'dictionary':
+        ensure_dictionary_tables(conn)
 
-        # Parsing dei Code
-        data = []
-        for codelist_elem in root.findall('.//structure:Codelist', namespaces=NAMESPACES):
-            codelist_id = codelist_elem.attrib.get('id')
-            print(f"  Trovato codelist: {codelist_id}")
-            for code in codelist_elem.findall('.//structure:Code', namespaces=NAMESPACES):
-                code_id = code.attrib.get('id')
-                name_it_elem = code.find('.//common:Name[@xml:lang="it"]', namespaces=NAMESPACES)
-                name_en_elem = code.find('.//common:Name[@xml:lang="en"]', namespaces=NAMESPACES)
-                row = {
-                    'code_id': code_id,
-                    'name_it': name_it_elem.text if name_it_elem is not None else None,
-                    'name_en': name_en_elem.text if name_en_elem is not None else None
-                }
-                data.append(row)
-
-        # Creazione tabella
-        table_name_clean = sanitize_column_name(enum_id)
-        with conn.cursor() as cur:
-            create_table_query = f"""
-            CREATE TABLE IF NOT EXISTS "{table_name_clean}" (
-                code_id VARCHAR PRIMARY KEY,
-                name_it TEXT,
-                name_en TEXT
-            )
-            """
-            cur.execute(create_table_query)
-            conn.commit()
+    plans = []
+    for df_id in tables_to_download:
+        if df_id not in known_dataflows:
+            print(f"Dataflow {df_id} non trovato nei dataflow.")
+            continue
+        state = refresh_state.get(df_id) or {}
+        plan = plan_dataflow_download(conn, df_id, state,
+                                      (filters or {}).get(df_id, state.get('filter_spec')), full_refresh)
+        if plan:
+            plans.append(plan)
+    return plans
 
-            insert_query = f"""
-            INSERT INTO "{table_name_clean}" (code_id, name_it, name_en)
-            VALUES (%s, %s, %s)
-            ON CONFLICT (code_id) DO NOTHING
-            """
-            from tqdm import tqdm
-            with tqdm(total=len(data), desc=f"Inserimento codelist {table_name_clean}") as pbar:
-                for row in data:
-                    cur.execute(insert_query, (row['code_id'], row['name_it'], row['name_en']))
-                    pbar.update(1)
-            conn.commit()
 
-        print(f"Classificazione {enum_id} salvata con successo.")
-        rename_file_after_import(file_name)
+def print_download_summary(successful_downloads, tables_to_download):
+    print("\nRiepilogo:")
+    print(f"Dataset scaricati con successo: {len(successful_downloads)}/{len(tables_to_download)}")
+    if successful_downloads:
+        print("Dataset disponibili per la creazione delle viste:")
+        for df_id in successful_downloads:
+            print(f" - {df_id}")
 
 
-def download_and_save_tables(conn, tables_to_download):
+def download_and_save_tables(conn, tables_to_download, full_refresh=False, filters=None):
     """
-    Scarica in CSV i dataflow selezionati e li carica in tabelle Postgres.
+    Scarica in CSV i dataflow selezionati e li carica in tabelle Postgres, uno alla volta.
     Implementa retry logic e gestione errori migliorata.
+    I dataflow già caricati vengono aggiornati in modo incrementale (vedi
+    plan_dataflow_refresh), salvo `full_refresh`.
+    `filters` = { dataflow_id: filtro per dimensione } limita il download a una fetta
+    (chiave SDMX costruita con build_sdmx_key); per i dataflow non indicati si riusa il
+    filtro salvato nell'ultimo refresh. Un filtro cambiato implica un caricamento completo.
     """
-    import time
-    max_retries = 3
-    retry_delay = 5  # secondi
     successful_downloads = []
 
-    # Verifica dataflow esistenti
-    with conn.cursor() as cur:
-        cur.execute("SELECT ID FROM dataflow")
-        known_dataflows = {r[0] for r in cur.fetchall()}
-
-    for df_id in tables_to_download:
-        if df_id not in known_dataflows:
-            print(f"Dataflow {df_id} non trovato nei dataflow.")
-            continue
+    for plan in plan_dataflow_downloads(conn, tables_to_download, full_refresh, filters):
+        df_id = plan['df_id']
+        file_path = plan['file_path']
 
-        file_name = f"{df_id}.csv"
-        url = f"{ISTAT_REST_V2}/data/{df_id}/ALL?format=csv"
-        file_path = os.path.join(DOWNLOAD_DIR, file_name)
+        if STREAMING_CSV_LOAD and RESUMABLE_DOWNLOADS:
+            success, downloaded_path = download_dataflow_file(plan)
+            if success and load_dataflow_file(conn, plan, downloaded_path):
+                successful_downloads.append(df_id)
+            continue
 
-        # Tentativo di download con retry
-        success = False
-        for attempt in range(max_retries):
-            try:
-                print(f"\nTentativo {attempt + 1}/{max_retries} per {df_id}")
-                print(f"Download CSV: {url}")
-                
-                response = requests.get(url, stream=True)
-                if response.status_code == 500:
-                    print(f"Errore server (500) per {df_id}. Potrebbe essere necessario scaricare prima altri dataset correlati.")
-                    break
-                
-                response.raise_for_status()
-                
-                # Se arriviamo qui, il download è riuscito
-                with open(file_path, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            f.write(chunk)
-                success = True
-                break
-                
-            except requests.exceptions.RequestException as e:
-                print(f"Errore download per {df_id} (tentativo {attempt + 1}): {str(e)}")
-                if attempt < max_retries - 1:
-                    print(f"Attendo {retry_delay} secondi prima del prossimo tentativo...")
-                    time.sleep(retry_delay)
+        if STREAMING_CSV_LOAD:
+            # Body HTTP -> COPY senza passare da file e DataFrame: lo sha256 per il manifest
+            # è calcolato durante lo streaming e, se uguale all'ultimo import, la shadow
+            # caricata viene scartata senza indici, swap né ricostruzione delle viste
+            last_import = find_comparable_import(conn, plan)
+            stream_info = {'unchanged_sha256': last_import['sha256'] if last_import else None}
+            start = time.perf_counter()
+            success, loaded_rows = download_dataflow(
+                plan, lambda p, raw: load_dataflow_source(
+                    conn, p, raw, tee_path=file_path if CSV_TEE_TO_DISK else None, stream_info=stream_info)
+            )
+            if not success:
                 continue
-        
+            load_duration = time.perf_counter() - start
+            artifact = {'url': dataflow_csv_url(plan)}
+            if plan['mode'] == 'full' and 'sha256' in stream_info:
+                tee_path = file_path if CSV_TEE_TO_DISK and os.path.exists(file_path) else None
+                artifact.update(file_path=tee_path, sha256=stream_info['sha256'].hexdigest(),
+                                byte_size=stream_info['byte_size'])
+            if stream_info.get('unchanged'):
+                loaded = record_unchanged_dataflow(conn, plan, artifact, last_import)
+            else:
+                loaded = finish_dataflow_load(conn, plan, loaded_rows, artifact=artifact, load_duration=load_duration)
+            if loaded:
+                successful_downloads.append(df_id)
+            continue
+
+        success, _ = download_dataflow_file(plan)
         if not success:
-            print(f"Non è stato possibile scaricare i dati per {df_id} dopo {max_retries} tentativi.")
             continue
 
         try:
+            artifact = build_artifact(dataflow_csv_url(plan), file_path)
+            if skip_unchanged_dataflow(conn, plan, artifact, file_path):
+                successful_downloads.append(df_id)
+                continue
+            start = time.perf_counter()
             df = extract_data_from_csv(file_path)
             if not df.empty:
                 created = create_table_from_data(df_id, df, conn)
                 if created:
                     successful_downloads.append(df_id)
-                    rename_file_after_import(file_path)
+                    save_refresh_state(conn, df_id, plan['started_at'], 'full', len(df),
+                                       plan['filter_spec'], plan['sdmx_key'])
+                    record_manifest_entry(conn, df_id, artifact, len(df), time.perf_counter() - start)
                     print(f"Dataset {df_id} importato con successo.")
                 else:
                     print(f"Errore durante la creazione della tabella per {df_id}.")
@@ -1050,28 +3965,232 @@ def download_and_save_tables(conn, tables_to_download):
             print(f"Errore durante l'elaborazione del CSV per {df_id}: {str(e)}")
             continue
 
-    print("\nRiepilogo:")
-    print(f"Dataset scaricati con successo: {len(successful_downloads)}/{len(tables_to_download)}")
-    if successful_downloads:
-        print("Dataset disponibili per la creazione delle viste:")
-        for df_id in successful_downloads:
-            print(f" - {df_id}")
-    
+    print_download_summary(successful_downloads, tables_to_download)
+    return successful_downloads
+
+
+def print_pipeline_utilization(stats, wall_time, download_workers, load_workers):
+    """
+    Riepilogo dell'utilizzo degli stadi della pipeline: quota del tempo in cui i worker
+    lavorano e tempo passato in attesa (downloader bloccati dalla coda piena = loader lenti,
+    loader in attesa di file = rete lenta).
+    """
+    wall_time = max(wall_time, 1e-9)
+    print(f"\nUtilizzo pipeline (durata {wall_time:.1f}s, coda massima {stats['max_queue']}/{stats['queue_size']}):")
+    print(f"  download: {download_workers} worker, occupati {stats['download_busy'] / (download_workers * wall_time):.0%}, "
+          f"bloccati su coda piena {stats['download_wait']:.1f}s")
+    print(f"  caricamento: {load_workers} worker, occupati {stats['load_busy'] / (load_workers * wall_time):.0%}, "
+          f"in attesa di file {stats['load_wait']:.1f}s")
+
+
+def download_and_save_tables_pipelined(conn, tables_to_download, full_refresh=False, filters=None,
+                                       download_workers=None, load_workers=None, queue_size=None):
+    """
+    Come download_and_save_tables, ma a pipeline: DOWNLOAD_WORKERS thread scaricano i CSV
+    in DOWNLOAD_DIR e li mettono in una coda limitata (PIPELINE_QUEUE_SIZE) consumata da
+    LOAD_WORKERS loader, ognuno con la propria connessione. Quando i loader restano indietro
+    la coda piena blocca i downloader (backpressure). Stampa l'utilizzo di ogni stadio.
+    """
+    download_workers = download_workers or DOWNLOAD_WORKERS
+    load_workers = load_workers or LOAD_WORKERS
+    queue_size = queue_size or PIPELINE_QUEUE_SIZE
+    plans = plan_dataflow_downloads(conn, tables_to_download, full_refresh, filters)
+
+    work_queue = queue.Queue(maxsize=queue_size)
+    stats = defaultdict(float, max_queue=0, queue_size=queue_size)
+    stats_lock = threading.Lock()
+
+    def record(**values):
+        with stats_lock:
+            for key, value in values.items():
+                stats[key] += value
+            stats['max_queue'] = max(stats['max_queue'], work_queue.qsize())
+
+    def downloader(plan):
+        started = time.perf_counter()
+        try:
+            success, file_path = download_dataflow_file(plan)
+        except Exception as e:
+            # Ogni piano deve arrivare ai loader, anche fallito (es. OSError su disco pieno)
+            print(f"Errore durante il download di {plan['df_id']}: {e}")
+            success, file_path = False, None
+        downloaded = time.perf_counter()
+        work_queue.put((plan, success, file_path))
+        record(download_busy=downloaded - started, download_wait=time.perf_counter() - downloaded)
+
+    def loader():
+        loaded = set()
+        try:
+            loader_conn = connect_to_database()
+        except Exception as e:
+            print(f"Loader senza connessione, i dataflow assegnati non saranno caricati: {e}")
+            loader_conn = None
+
+        while True:
+            waiting = time.perf_counter()
+            item = work_queue.get()
+            started = time.perf_counter()
+            if item is None:
+                record(load_wait=started - waiting)
+                break
+            plan, success, file_path = item
+            try:
+                if success and loader_conn is not None and load_dataflow_file(loader_conn, plan, file_path):
+                    loaded.add(plan['df_id'])
+            except Exception as e:
+                print(f"Errore durante il caricamento di {plan['df_id']}: {e}")
+            record(load_wait=started - waiting, load_busy=time.perf_counter() - started)
+
+        if loader_conn is not None:
+            loader_conn.close()
+        return loaded
+
+    print(f"Pipeline Parte 2: {len(plans)} dataflow, {download_workers} download, "
+          f"{load_workers} caricamenti in parallelo")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=load_workers) as load_pool:
+        loader_futures = [load_pool.submit(loader) for _ in range(load_workers)]
+        try:
+            with ThreadPoolExecutor(max_workers=download_workers) as download_pool:
+                list(download_pool.map(downloader, plans))
+        finally:
+            # Senza i segnali di fine i loader resterebbero bloccati su work_queue.get()
+            for _ in loader_futures:
+                work_queue.put(None)
+        loaded = set().union(*(f.result() for f in loader_futures))
+    print_pipeline_utilization(stats, time.perf_counter() - start, download_workers, load_workers)
+
+    successful_downloads = [plan['df_id'] for plan in plans if plan['df_id'] in loaded]
+    print_download_summary(successful_downloads, tables_to_download)
     return successful_downloads
 
 
-def execute_part2(conn, tables_to_download):
+def execute_part2(conn, tables_to_download, classifications=True, full_refresh=False, filters=None):
     """
     Scarica e salva le codelist per i dataflow, e i CSV per i dataflow scelti.
+    Con classifications=False le codelist non vengono scaricate (già caricate
+    dalla Parte 1 mirata). Con USE_CONTENT_CONSTRAINTS i dataflow il cui vincolo di
+    contenuto è esplicitamente vuoto non vengono scaricati. Con full_refresh i CSV sono ricaricati per intero anche se
+    è possibile un refresh incrementale; `filters` limita i download a una fetta
+    (vedi download_and_save_tables).
     Restituisce la lista dei dataset scaricati con successo.
     """
     print("\nEsecuzione Parte 2: scarico tabelle + codelist")
-    download_and_save_classifications(conn, tables_to_download)
-    successful_downloads = download_and_save_tables(conn, tables_to_download)
+    if USE_CONTENT_CONSTRAINTS:
+        constraints = download_and_save_constraints(conn, tables_to_download)
+        # Solo i vincoli letti ed esplicitamente vuoti escludono un dataflow
+        empty = [df_id for df_id in tables_to_download if is_empty_constraint(constraints.get(df_id))]
+        if empty:
+            print(f"Dataflow senza dati disponibili, non scaricati: {', '.join(empty)}")
+        tables_to_download = [df_id for df_id in tables_to_download if df_id not in empty]
+
+    if classifications:
+        download_and_save_classifications(conn, tables_to_download)
+    if PIPELINED_PART2 and STREAMING_CSV_LOAD and len(tables_to_download) > 1:
+        successful_downloads = download_and_save_tables_pipelined(conn, tables_to_download, full_refresh, filters)
+    else:
+        successful_downloads = download_and_save_tables(conn, tables_to_download, full_refresh, filters)
     print("Parte 2 completata.\n")
     return successful_downloads
 
 
+# =============================================================================
+# PARTE 2-BIS: Vincoli di contenuto (codici effettivamente usati dai dataflow)
+# =============================================================================
+
+def extract_constraint_codes(source):
+    """
+    Legge in streaming un messaggio availableconstraint e restituisce
+    { dimension_id: set(codici) } dai CubeRegion inclusi. Una dimensione con insieme vuoto
+    (KeyValue senza Value) indica un dataflow senza dati; None se il messaggio non contiene
+    nessun KeyValue in un CubeRegion incluso (vincolo sconosciuto).
+    """
+    codes = {}
+    for constraint in iterparse_elements(source, ('ContentConstraint',)):
+        for cube_region in constraint.findall('.//structure:CubeRegion', namespaces=NAMESPACES):
+            if cube_region.attrib.get('include', 'true') == 'false':
+                continue
+            for key_value in cube_region.findall('common:KeyValue', namespaces=NAMESPACES):
+                if not key_value.attrib.get('id'):
+                    continue
+                values = {v.text for v in key_value.findall('common:Value', namespaces=NAMESPACES) if v.text}
+                codes.setdefault(key_value.attrib['id'], set()).update(values)
+    return codes or None
+
+
+def is_empty_constraint(codes):
+    """
+    True se il vincolo (letto con extract_constraint_codes) esclude ogni serie:
+    almeno una dimensione senza codici disponibili.
+    """
+    return bool(codes) and any(not values for values in codes.values())
+
+
+def download_and_save_constraints(conn, dataflow_ids):
+    """
+    Scarica l'actual content constraint (availableconstraint) di ogni dataflow e salva
+    i codici ammessi per dimensione in dataflow_constraints (dimension_id è il nome
+    della colonna nella tabella del dataflow).
+    Restituisce { dataflow_id: { dimension_id: set(codici) } } per i soli vincoli letti
+    (vuoti secondo is_empty_constraint per i dataflow senza dati); un vincolo non
+    scaricabile, malformato o senza CubeRegion nel formato atteso è "sconosciuto": il
+    dataflow viene scaricato senza filtri e i suoi vecchi codici eliminati.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS dataflow_constraints (
+            dataflow_id VARCHAR,
+            dimension_id VARCHAR,
+            code_id VARCHAR,
+            PRIMARY KEY (dataflow_id, dimension_id, code_id)
+        )
+        """)
+        conn.commit()
+
+    constraints = {}
+    for df_id in dataflow_ids:
+        url = f"{ISTAT_REST_V1}/availableconstraint/{df_id}"
+        print(f"Scaricamento vincoli di contenuto per {df_id}...")
+        path = fetch_cached(url)
+        if path is None:
+            print(f"Vincoli non disponibili per {df_id}, nessun filtro applicato.")
+            continue
+
+        try:
+            with open_raw_file(path) as f:
+                codes = extract_constraint_codes(f)
+        except ET.ParseError:
+            codes = None
+        if codes is None:
+            print(f"Vincoli non leggibili per {df_id}, nessun filtro applicato.")
+            delete_missing_rows(conn, 'dataflow_constraints', 'dataflow_id', [df_id],
+                                ['dataflow_id', 'dimension_id', 'code_id'], [])
+            continue
+        codes = {sanitize_column_name(dim): values for dim, values in codes.items()}
+        constraints[df_id] = codes
+
+        rows = [(df_id, dim, code) for dim, values in sorted(codes.items()) for code in sorted(values)]
+        bulk_upsert(conn, 'dataflow_constraints', ['dataflow_id', 'dimension_id', 'code_id'], rows,
+                    key_columns=['dataflow_id', 'dimension_id', 'code_id'], update_columns=())
+        delete_missing_rows(conn, 'dataflow_constraints', 'dataflow_id', [df_id],
+                            ['dataflow_id', 'dimension_id', 'code_id'], rows)
+        print(f"{df_id}: {len(rows)} codici ammessi su {len(codes)} dimensioni.")
+
+    return constraints
+
+
+def get_constrained_dimensions(conn, main_table):
+    """
+    Restituisce l'insieme delle dimensioni del dataflow per cui esiste un vincolo salvato.
+    """
+    if not table_exists(conn, 'dataflow_constraints'):
+        return set()
+    with conn.cursor() as cur:
+        cur.execute("SELECT DISTINCT dimension_id FROM dataflow_constraints WHERE dataflow_id = %s",
+                    (main_table,))
+        return {row[0] for row in cur.fetchall()}
+
+
 # =============================================================================
 # PARTE 3: Creazione Viste personalizzate
 # =============================================================================
@@ -1118,20 +4237,112 @@ def get_enum_cl_mapping(conn, main_table):
             mapping[detail_id.lower()] = sanitize_column_name(enum_id)
     return mapping
 
-def build_joins(main_table, enum_cl_mapping):
+def constrained_codelist_name(main_table, detail_id):
+    """
+    Nome della tabella con il sottoinsieme del codelist ammesso per una dimensione del dataflow.
+    Oltre i 63 byte degli identificatori Postgres il nome viene accorciato con un hash.
+    """
+    name = f"{main_table}__{detail_id}_codes"
+    if len(name.encode()) <= MAX_IDENTIFIER_LENGTH:
+        return name
+    digest = hashlib.sha1(name.encode()).hexdigest()[:10]
+    prefix = name.encode()[:MAX_IDENTIFIER_LENGTH - len(digest) - len('__codes')].decode(errors='ignore')
+    return f"{prefix}_{digest}_codes"
+
+
+def drop_stale_constrained_codelists(conn, main_table, enum_cl_mapping, constrained_codelists):
+    """
+    Elimina le tabelle dei sottoinsiemi di codelist delle dimensioni di `main_table` che non
+    sono più vincolate (vincolo scomparso o diventato sconosciuto). Da chiamare dopo aver
+    ricreato la vista: una tabella ancora usata (es. da una vista materializzata solo
+    aggiornata) resta e viene segnalata.
+    """
+    for detail_id in enum_cl_mapping:
+        if detail_id in constrained_codelists:
+            continue
+        subset_table = constrained_codelist_name(main_table, detail_id)
+        if not table_exists(conn, subset_table):
+            continue
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(subset_table)))
+            print(f"Sottoinsieme di codelist non più vincolato eliminato: {subset_table}")
+        except psycopg2.Error as e:
+            print(f"Sottoinsieme di codelist {subset_table} non eliminato: {e}")
+
+
+def materialize_constrained_codelists(conn, main_table, enum_cl_mapping, constrained_dimensions):
+    """
+    Per ogni dimensione vincolata copia in una tabella dedicata (constrained_codelist_name)
+    le sole righe del codelist ammesse per il dataflow in dataflow_constraints.
+    Le tabelle vengono riallineate a ogni run (DELETE + INSERT in una transazione, così le
+    viste che le usano restano valide). Restituisce { detail_id: tabella }.
+    """
+    subsets = {}
+    for detail_id, codelist_table in enum_cl_mapping.items():
+        if detail_id not in constrained_dimensions or not table_exists(conn, codelist_table):
+            continue
+        subset_table = constrained_codelist_name(main_table, detail_id)
+        with transaction(conn), conn.cursor() as cur:
+            cur.execute(sql.SQL("""
+                CREATE TABLE IF NOT EXISTS {} (
+                    code_id VARCHAR PRIMARY KEY,
+                    name_it TEXT,
+                    name_en TEXT
+                )
+            """).format(sql.Identifier(subset_table)))
+            cur.execute(sql.SQL("DELETE FROM {}").format(sql.Identifier(subset_table)))
+            cur.execute(sql.SQL("""
+                INSERT INTO {subset} (code_id, name_it, name_en)
+                SELECT cl.code_id, cl.name_it, cl.name_en
+                FROM {codelist} cl
+                JOIN dataflow_constraints dc ON dc.code_id = cl.code_id
+                WHERE dc.dataflow_id = %s AND dc.dimension_id = %s
+            """).format(subset=sql.Identifier(subset_table), codelist=sql.Identifier(codelist_table)),
+                (main_table, detail_id))
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(subset_table)))
+        subsets[detail_id] = subset_table
+    return subsets
+
+
+def build_joins(conn, main_table, enum_cl_mapping, constrained_codelists=None):
     """
     Costruisce i LEFT JOIN con le tabelle di codelist.
+    Per le dimensioni in `constrained_codelists` ({ detail_id: tabella }) il join avviene
+    sul sottoinsieme materializzato da materialize_constrained_codelists, con l'alias del
+    codelist completo.
     """
     joins = []
     used = set()
+    constrained_codelists = constrained_codelists or {}
     for detail_id, codelist_table in enum_cl_mapping.items():
         if codelist_table not in used:
             used.add(codelist_table)
-            clause = f'LEFT JOIN "{codelist_table}" ON "{main_table}"."{detail_id}" = "{codelist_table}".code_id'
-            joins.append(clause)
-    return " ".join(joins)
+            source = sql.Identifier(constrained_codelists.get(detail_id, codelist_table))
+            joins.append(sql.SQL("LEFT JOIN {source} AS {alias} ON {main}.{column} = {alias}.code_id").format(
+                source=source,
+                alias=sql.Identifier(codelist_table),
+                main=sql.Identifier(main_table),
+                column=sql.Identifier(detail_id)
+            ))
+    return sql.SQL(" ").join(joins).as_string(conn)
+
+def get_column_type(conn, table_name, column_name):
+    """
+    Tipo (information_schema.data_type) della colonna, None se non esiste.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT data_type FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s AND column_name = %s
+        """, (ISTAT_SCHEMA, table_name, column_name))
+        row = cur.fetchone()
+    return row[0] if row else None
+
 
-def create_view_query(main_table, joins, enum_cl_mapping, view_name=None):
+def create_view_query(main_table, joins, enum_cl_mapping, view_name=None, obs_value_typed=False,
+                      materialized=False):
     if not view_name:
         view_name = f"{main_table}_view"
 
@@ -1145,10 +4356,15 @@ def create_view_query(main_table, joins, enum_cl_mapping, view_name=None):
     if select_dimensions:
         extra_cols = ', ' + ', '.join(select_dimensions)
 
-    obs_value_cast = f'"{main_table}".obs_value::float AS obs_value_converted'
+    # Con tabelle tipizzate obs_value è già DOUBLE PRECISION: niente cast a ogni query
+    if obs_value_typed:
+        obs_value_cast = f'"{main_table}".obs_value AS obs_value_converted'
+    else:
+        obs_value_cast = f'"{main_table}".obs_value::float AS obs_value_converted'
 
+    create = "CREATE MATERIALIZED VIEW" if materialized else "CREATE OR REPLACE VIEW"
     query = f"""
-    CREATE OR REPLACE VIEW "{view_name}" AS
+    {create} "{view_name}" AS
     SELECT
         "{main_table}".*,
         {obs_value_cast}{extra_cols}
@@ -1157,9 +4373,158 @@ def create_view_query(main_table, joins, enum_cl_mapping, view_name=None):
     """
     return query
 
-def execute_part3(conn, successful_downloads):
+def ensure_view_catalog_table(conn):
+    """
+    Crea (se serve) il catalogo delle viste della Parte 3, con l'ultimo refresh
+    delle viste materializzate.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS view_catalog (
+            view_name VARCHAR PRIMARY KEY,
+            dataflow_id VARCHAR,
+            materialized BOOLEAN,
+            created_at TIMESTAMPTZ DEFAULT now(),
+            last_refreshed_at TIMESTAMPTZ
+        )
+        """)
+        conn.commit()
+
+
+def log_view_catalog(conn, view_name, dataflow_id, materialized):
+    """
+    Registra in view_catalog la vista creata o aggiornata; per le viste materializzate
+    last_refreshed_at è l'istante attuale (dati allineati all'ultimo caricamento).
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            INSERT INTO view_catalog (view_name, dataflow_id, materialized, last_refreshed_at)
+            VALUES (%s, %s, %s, CASE WHEN %s THEN now() END)
+            ON CONFLICT (view_name) DO UPDATE
+            SET dataflow_id = EXCLUDED.dataflow_id,
+                materialized = EXCLUDED.materialized,
+                last_refreshed_at = EXCLUDED.last_refreshed_at
+        """, (view_name, dataflow_id, materialized, materialized))
+    conn.commit()
+
+
+def get_relation_kind(conn, name):
+    """
+    relkind della relazione `name` ('r' tabella, 'v' vista, 'm' vista materializzata), None se assente.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(quote_ident(%s))", (name,))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+def get_relation_columns(conn, name):
+    """
+    Colonne di una relazione qualsiasi (anche vista materializzata, assente da
+    information_schema) in ordine di definizione.
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT attname FROM pg_attribute
+            WHERE attrelid = to_regclass(quote_ident(%s)) AND attnum > 0 AND NOT attisdropped
+            ORDER BY attnum
+        """, (name,))
+        return [row[0] for row in cur.fetchall()]
+
+
+def has_refresh_key(conn, view_name):
+    """
+    True se la vista materializzata ha un indice univoco utilizzabile da
+    REFRESH MATERIALIZED VIEW CONCURRENTLY (solo colonne, senza predicato).
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT EXISTS (
+                SELECT FROM pg_index
+                WHERE indrelid = to_regclass(quote_ident(%s)) AND indisunique
+                  AND indexprs IS NULL AND indpred IS NULL
+            )
+        """, (view_name,))
+        return cur.fetchone()[0]
+
+
+def is_populated(conn, view_name):
+    """
+    False se la vista materializzata è stata ricreata WITH NO DATA e non ancora aggiornata.
+    """
+    with conn.cursor() as cur:
+        cur.execute("SELECT relispopulated FROM pg_class WHERE oid = to_regclass(quote_ident(%s))",
+                    (view_name,))
+        row = cur.fetchone()
+    return bool(row and row[0])
+
+
+def create_materialized_view(conn, main_table, view_name, view_query):
+    """
+    (Ri)crea in un'unica transazione la vista materializzata `view_name` e il suo indice
+    univoco su chiave di serie + time_period (se la DSD è nota e la chiave è davvero univoca).
+    """
+    key_columns = get_series_key_columns(conn, main_table) or []
+    table_columns = set(get_relation_columns(conn, main_table))
+    with transaction(conn), conn.cursor() as cur:
+        kind = get_relation_kind(conn, view_name)
+        if kind in ('v', 'm'):
+            cur.execute(sql.SQL("DROP {} {}").format(
+                sql.SQL("MATERIALIZED VIEW" if kind == 'm' else "VIEW"), sql.Identifier(view_name)))
+        cur.execute(view_query)
+        if key_columns and set(key_columns) <= table_columns:
+            cur.execute("SAVEPOINT refresh_key")
+            try:
+                cur.execute(sql.SQL("CREATE UNIQUE INDEX {} ON {} ({})").format(
+                    sql.Identifier(f"{main_table}_mv_key"), sql.Identifier(view_name),
+                    sql.SQL(', ').join(sql.Identifier(c) for c in key_columns)))
+                cur.execute("RELEASE SAVEPOINT refresh_key")
+            except psycopg2.Error as e:
+                cur.execute("ROLLBACK TO SAVEPOINT refresh_key")
+                print(f"Indice univoco non creato su {view_name}, refresh non concorrente: {e}")
+
+
+def refresh_materialized_view(conn, view_name):
+    """
+    Aggiorna la vista materializzata: CONCURRENTLY (i lettori non vengono bloccati)
+    se ha un indice univoco ed è già popolata, altrimenti con un REFRESH normale.
+    """
+    start = time.perf_counter()
+    concurrently = has_refresh_key(conn, view_name) and is_populated(conn, view_name)
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("REFRESH MATERIALIZED VIEW {}{}").format(
+            sql.SQL("CONCURRENTLY " if concurrently else ""), sql.Identifier(view_name)))
+    print(f"Vista materializzata \"{view_name}\" aggiornata{' (concurrently)' if concurrently else ''} "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+def publish_materialized_view(conn, main_table, view_name, view_query, expected_columns):
+    """
+    Porta la vista materializzata di `main_table` allo stato dell'ultimo caricamento:
+    dopo un caricamento incrementale basta REFRESH; dopo uno completo lo swap l'ha già
+    ricreata e aggiornata, e viene ricreata solo se le colonne non corrispondono più
+    (o se manca; se è rimasta vuota viene aggiornata).
+    """
+    if get_relation_kind(conn, view_name) == 'm':
+        state = load_refresh_state(conn, [main_table]).get(main_table, {})
+        if state.get('last_mode') == 'incremental':
+            if state.get('last_rows'):
+                refresh_materialized_view(conn, view_name)
+            return
+        if get_relation_columns(conn, view_name) == expected_columns:
+            if is_populated(conn, view_name):
+                print(f"Vista materializzata \"{view_name}\" già aggiornata.")
+            else:
+                refresh_materialized_view(conn, view_name)
+            return
+    create_materialized_view(conn, main_table, view_name, view_query)
+
+
+def execute_part3(conn, successful_downloads, use_constraints=USE_CONTENT_CONSTRAINTS):
     """
     Crea viste personalizzate solo per i dataset scaricati con successo.
+    Con use_constraints le join usano i codelist ridotti ai codici del dataflow.
+    Con VIEW_MODE 'materialized' le viste sono materializzate (publish_materialized_view).
     """
     if not successful_downloads:
         print("\nNessun dataset disponibile per la creazione delle viste.")
@@ -1167,17 +4532,13 @@ def execute_part3(conn, successful_downloads):
 
     print("\nEsecuzione Parte 3: creazione viste personalizzate.")
     created_views = []
+    materialized = VIEW_MODE == 'materialized'
+    ensure_view_catalog_table(conn)
 
     with conn.cursor() as cur:
         for main_table in successful_downloads:
-            # Verifica che la tabella esista
-            cur.execute("""
-                SELECT EXISTS (
-                    SELECT FROM information_schema.tables 
-                    WHERE table_schema = 'public' 
-                    AND table_name = %s
-                )""", (main_table,))
-            if not cur.fetchone()[0]:
+            # Verifica che la tabella (o la vista del layout a dizionario) esista
+            if not table_exists(conn, main_table):
                 print(f"Tabella {main_table} non trovata, salto la creazione della vista.")
                 continue
 
@@ -1190,17 +4551,47 @@ def execute_part3(conn, successful_downloads):
                 print(f"Nessuna codelist per {main_table}.")
                 continue
 
-            joins = build_joins(main_table, enum_cl_map)
-            view_query = create_view_query(main_table, joins, enum_cl_map, view_name=view_name)
+            constrained = get_constrained_dimensions(conn, main_table) if use_constraints else set()
+            subsets = materialize_constrained_codelists(conn, main_table, enum_cl_map, constrained)
+            joins = build_joins(conn, main_table, enum_cl_map, subsets)
+            obs_value_typed = get_column_type(conn, main_table, 'obs_value') == 'double precision'
+            view_query = create_view_query(main_table, joins, enum_cl_map, view_name=view_name,
+                                           obs_value_typed=obs_value_typed, materialized=materialized)
+
+            if materialized:
+                expected_columns = (get_relation_columns(conn, main_table) + ['obs_value_converted']
+                                    + [f"{detail_id}_desc" for detail_id in enum_cl_map])
+                try:
+                    publish_materialized_view(conn, main_table, view_name, view_query, expected_columns)
+                except psycopg2.Error as e:
+                    print(f"Errore creazione vista materializzata per {main_table}: {e}")
+                    continue
+                log_view_catalog(conn, view_name, main_table, True)
+                drop_stale_constrained_codelists(conn, main_table, enum_cl_map, subsets)
+                created_views.append((main_table, view_name))
+                print(f"Vista materializzata pronta: \"{view_name}\" (da {main_table})")
+                continue
 
+            if get_relation_kind(conn, view_name) == 'm':
+                # Passaggio da VIEW_MODE 'materialized' a 'view'
+                cur.execute(sql.SQL("DROP MATERIALIZED VIEW {}").format(sql.Identifier(view_name)))
             try:
                 cur.execute(view_query)
                 conn.commit()
-                created_views.append((main_table, view_name))
-                print(f"Vista creata: \"{view_name}\" (da {main_table})")
-            except psycopg2.Error as e:
-                print(f"Errore creazione vista per {main_table}: {e}")
-                continue
+            except psycopg2.Error:
+                # La vista preservata dallo swap non è compatibile con le nuove colonne
+                # (es. tipo cambiato o colonna rimossa): la si sostituisce in un'unica transazione
+                try:
+                    with transaction(conn), conn.cursor() as replace_cur:
+                        replace_cur.execute(sql.SQL("DROP VIEW IF EXISTS {}").format(sql.Identifier(view_name)))
+                        replace_cur.execute(view_query)
+                except psycopg2.Error as e:
+                    print(f"Errore creazione vista per {main_table}: {e}")
+                    continue
+            log_view_catalog(conn, view_name, main_table, False)
+            drop_stale_constrained_codelists(conn, main_table, enum_cl_map, subsets)
+            created_views.append((main_table, view_name))
+            print(f"Vista creata: \"{view_name}\" (da {main_table})")
 
     print("\nRiepilogo viste create:")
     if created_views:
@@ -1209,7 +4600,345 @@ def execute_part3(conn, successful_downloads):
     else:
         print("Nessuna vista creata.")
 
+    if AUTO_INDEXES and created_views:
+        execute_index_advisor(conn, created_views)
     print("Parte 3 completata.\n")
+    return created_views
+
+
+# =============================================================================
+# INDICI AUTOMATICI (dimensioni e tempo delle tabelle dei fatti, dopo la Parte 3)
+# =============================================================================
+
+def get_leading_index_columns(conn, relation):
+    """
+    Prima colonna di ogni indice esistente su `relation` (un indice che inizia con
+    una colonna serve già i filtri su quella colonna).
+    """
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT a.attname FROM pg_index i
+            JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = i.indkey[0]
+            WHERE i.indrelid = to_regclass(quote_ident(%s))
+        """, (relation,))
+        return {row[0] for row in cur.fetchall()}
+
+
+def summarize_plan(plan):
+    """
+    Riassume un piano EXPLAIN (FORMAT JSON): nodi in pre-ordine con relazione o indice.
+    """
+    label = plan['Node Type']
+    if plan.get('Index Name'):
+        label += f" using {plan['Index Name']}"
+    elif plan.get('Relation Name'):
+        label += f" on {plan['Relation Name']}"
+    return [label] + [node for child in plan.get('Plans', ()) for node in summarize_plan(child)]
+
+
+def explain_view_filter(conn, view_name, column):
+    """
+    Piano di una query tipica della dashboard sulla vista: filtro per un codice di
+    `column`. Restituisce (costo totale, nodi del piano) oppure None se la vista è vuota.
+    """
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT {col} FROM {view} WHERE {col} IS NOT NULL LIMIT 1").format(
+            col=sql.Identifier(column), view=sql.Identifier(view_name)))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        cur.execute(sql.SQL("EXPLAIN (FORMAT JSON) SELECT * FROM {} WHERE {} = %s").format(
+            sql.Identifier(view_name), sql.Identifier(column)), (row[0],))
+        plan = cur.fetchone()[0][0]['Plan']
+    return plan['Total Cost'], summarize_plan(plan)
+
+
+def plan_indexes(conn, main_table, view_name):
+    """
+    Indici da creare per la vista di `main_table`: relazione su cui crearli (la vista
+    materializzata, la tabella dei fatti del layout a dizionario o la tabella del
+    dataflow) e lista di (nome indice, colonna, metodo). Le dimensioni sono quelle della
+    DSD presenti nella relazione e non già prima colonna di un indice.
+    """
+    if get_relation_kind(conn, view_name) == 'm':
+        target, prefix = view_name, f"{main_table}_mv"
+    elif get_relation_kind(conn, facts_table_name(main_table)) == 'r':
+        target = prefix = facts_table_name(main_table)
+    else:
+        target = prefix = main_table
+    columns = get_relation_columns(conn, target)
+    indexed = get_leading_index_columns(conn, target)
+
+    dimensions = [d.lower() for d in get_dimension_ids(conn, main_table)]
+    indexes = [(f"{prefix}_{d}_idx", d, 'btree') for d in dimensions if d in columns and d not in indexed]
+    time_column = 'time_period_date' if 'time_period_date' in columns else 'time_period'
+    if time_column in columns and time_column not in indexed:
+        indexes.append((f"{prefix}_{time_column}_idx", time_column, TIME_INDEX_METHOD))
+    return target, indexes
+
+
+def build_view_indexes(conn, main_table, view_name):
+    """
+    Crea gli indici di plan_indexes e aggiorna le statistiche (ANALYZE) della relazione
+    indicizzata e dei codelist in join, stampando tempo impiegato e piano di una query
+    filtrata sulla vista prima e dopo.
+    """
+    target, indexes = plan_indexes(conn, main_table, view_name)
+    enum_cl_map = get_enum_cl_mapping(conn, main_table)
+    probe = next((c for c in enum_cl_map if c in get_relation_columns(conn, view_name)), None)
+    before = explain_view_filter(conn, view_name, probe) if probe else None
+
+    start = time.perf_counter()
+    created = []
+    for index_name, column, method in indexes:
+        try:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("CREATE INDEX IF NOT EXISTS {} ON {} USING {} ({})").format(
+                    sql.Identifier(index_name), sql.Identifier(target), sql.SQL(method), sql.Identifier(column)))
+            created.append(f"{column} ({method})")
+        except psycopg2.Error as e:
+            print(f"Indice {index_name} non creato: {e}")
+    with conn.cursor() as cur:
+        analyzed = [target] + sorted(set(enum_cl_map.values()))
+        if target == facts_table_name(main_table):
+            analyzed.append('dimension_dictionary')
+        for relation in analyzed:
+            if get_relation_kind(conn, relation) in ('r', 'm'):
+                cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(relation)))
+    elapsed = time.perf_counter() - start
+
+    print(f"Indici su {target}: {', '.join(created) or 'nessuno nuovo'} in {elapsed:.1f}s "
+          f"(ANALYZE di {len(analyzed)} relazioni)")
+    after = explain_view_filter(conn, view_name, probe) if probe else None
+    if before and after:
+        print(f"  piano di \"{view_name}\" filtrata su {probe}: costo {before[0]:,.0f} -> {after[0]:,.0f}")
+        print(f"    prima: {' > '.join(before[1])}")
+        print(f"    dopo:  {' > '.join(after[1])}")
+
+
+def execute_index_advisor(conn, created_views):
+    """
+    Fase di indicizzazione dopo la Parte 3 per le viste `created_views` [(dataflow, vista)].
+    Gli indici creati sulla tabella vengono poi riprodotti a ogni ricaricamento
+    (build_shadow_indexes) e quelli delle viste materializzate dallo swap.
+    """
+    print("\nIndicizzazione delle tabelle dei fatti:")
+    for main_table, view_name in created_views:
+        try:
+            build_view_indexes(conn, main_table, view_name)
+        except psycopg2.Error as e:
+            print(f"Errore indicizzazione di {main_table}: {e}")
+
+
+# =============================================================================
+# RICOSTRUZIONE OFFLINE (dai file grezzi in DOWNLOAD_DIR e dalla cache HTTP)
+# =============================================================================
+
+RAW_SOURCE_RE = re.compile(r'^(?P<name>.+?)(?:_import)?\.(?P<ext>csv|xml)(?:\.gz)?$')
+
+
+def sniff_structure_format(path):
+    """
+    Formato di un messaggio di struttura salvato ('xml' o 'json') dal primo carattere utile.
+    """
+    with open_raw_file(path) as f:
+        head = f.read(256).lstrip(b'\xef\xbb\xbf \t\r\n')
+    return 'json' if head.startswith((b'{', b'[')) else 'xml'
+
+
+def add_offline_source(sources, name, path, url, mtime):
+    """
+    Registra `path` come sorgente di `name` se più recente di quella già nota.
+    """
+    if name not in sources or mtime > sources[name]['mtime']:
+        sources[name] = {'path': path, 'url': url, 'mtime': mtime}
+
+
+def collect_offline_sources():
+    """
+    Inventario dei file grezzi riutilizzabili: CSV dei dataflow e codelist in DOWNLOAD_DIR
+    (anche *_import delle versioni precedenti, compressi o no) e codelist / CSV completi
+    presenti nella cache HTTP. Per ogni oggetto vale il file più recente.
+    Restituisce (sorgenti dei dataflow, sorgenti dei codelist) indicizzate per ID.
+    """
+    dataflows, codelists = {}, {}
+    for entry in os.scandir(DOWNLOAD_DIR):
+        match = RAW_SOURCE_RE.match(entry.name)
+        if not entry.is_file() or not match or match.group('name').endswith('_delta'):
+            continue
+        name = match.group('name')
+        if match.group('ext') == 'csv':
+            add_offline_source(dataflows, name, entry.path,
+                               f"{ISTAT_REST_V2}/data/{name}/ALL?format=csv", entry.stat().st_mtime)
+        else:
+            add_offline_source(codelists, name, entry.path,
+                               f"{ISTAT_REST_V2}/codelist/IT1/{name}", entry.stat().st_mtime)
+
+    index_dir = os.path.join(HTTP_CACHE_DIR, 'index')
+    for name in sorted(os.listdir(index_dir)) if os.path.isdir(index_dir) else []:
+        with open(os.path.join(index_dir, name), 'r', encoding='utf-8') as f:
+            entry = json.load(f)
+        object_path = cache_object_path(entry['digest'])
+        if not os.path.exists(object_path):
+            continue
+        url = entry['url']
+        if '/codelist/IT1/' in url and '?' not in url:
+            add_offline_source(codelists, url.rstrip('/').rsplit('/', 1)[-1], object_path, url, entry['fetched_at'])
+        elif '/data/' in url and url.endswith('/ALL?format=csv'):
+            add_offline_source(dataflows, url.split('/data/', 1)[1].split('/', 1)[0], object_path, url,
+                               entry['fetched_at'])
+    return dataflows, codelists
+
+
+def find_cached_structure(url):
+    """
+    Formato ('xml' o 'json') in cui il messaggio di struttura `url` è in cache,
+    preferendo STRUCTURE_FORMAT; None se non è disponibile offline.
+    """
+    other = 'json' if STRUCTURE_FORMAT == 'xml' else 'xml'
+    for structure_format in (STRUCTURE_FORMAT, other):
+        headers = None if structure_format == 'xml' else {'Accept': STRUCTURE_ACCEPT[structure_format]}
+        if load_cache_entry(url, headers) is not None:
+            return structure_format
+    return None
+
+
+def parse_offline_codelist(source, imported_sha256=None):
+    """
+    Stadio di parsing (eseguito nei thread) di un codelist salvato: restituisce
+    (codici, artefatto), con codici None se identico all'ultimo import o illeggibile.
+    """
+    try:
+        artifact = build_artifact(source['url'], source['path'])
+        if imported_sha256 and artifact['sha256'] == imported_sha256:
+            return None, artifact
+        structure_format = sniff_structure_format(source['path'])
+        document = load_structure_document(source['path'], structure_format)
+        return get_structure_parser(structure_format, 'codelist')(document), artifact
+    except Exception as e:
+        print(f"Errore lettura codelist {source['path']}: {e}")
+        return None, None
+
+
+def rebuild_codelists(conn, sources, workers=None):
+    """
+    Carica tutti i codelist trovati offline: parsing in parallelo, un solo writer su `conn`.
+    Restituisce il numero di codelist caricati o invariati.
+    """
+    workers = workers or CODELIST_FETCH_WORKERS
+    enum_ids = sorted(sources)
+    tables = [sanitize_column_name(enum_id) for enum_id in enum_ids]
+    existing_tables = {t for t in tables if table_exists(conn, t)}
+    last_imports = load_last_imports(conn, existing_tables) if MANIFEST_SKIP_UNCHANGED else {}
+
+    done = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(
+            lambda enum_id: parse_offline_codelist(
+                sources[enum_id], last_imports.get(sanitize_column_name(enum_id), {}).get('sha256')),
+            enum_ids)
+        for enum_id, table_name_clean, (data, artifact) in zip(enum_ids, tables, results):
+            if artifact is None:
+                continue
+            if data is None:
+                record_manifest_entry(conn, table_name_clean, artifact, status='skipped')
+            elif data:
+                start = time.perf_counter()
+                save_codelist_to_postgresql(conn, enum_id, data)
+                record_manifest_entry(conn, table_name_clean, artifact, len(data), time.perf_counter() - start)
+            else:
+                print(f"Nessun codice in {sources[enum_id]['path']}, file ignorato.")
+                continue
+            done += 1
+    print(f"Codelist ricostruiti: {done}/{len(enum_ids)}")
+    return done
+
+
+def rebuild_dataflow_tables(conn, sources, workers=None):
+    """
+    Carica in parallelo (`workers` loader, default REBUILD_LOAD_WORKERS, ognuno con la
+    propria connessione) i CSV dei dataflow trovati offline con lo stesso percorso della
+    Parte 2 (COPY in shadow + swap, manifest), partendo dai file più grandi. I file
+    sorgente restano in DOWNLOAD_DIR. Restituisce i dataflow caricati.
+    """
+    workers = workers or REBUILD_LOAD_WORKERS
+    ensure_manifest_table(conn)
+    ensure_refresh_state_table(conn)
+    if STORAGE_LAYOUT == 'dictionary':
+        ensure_dictionary_tables(conn)
+
+    work_queue = queue.Queue()
+    for df_id in sorted(sources, key=lambda d: os.path.getsize(sources[d]['path']), reverse=True):
+        plan = plan_dataflow_download(conn, df_id, {}, {}, full_refresh=True)
+        plan.update(file_path=sources[df_id]['path'], keep_file=True)
+        work_queue.put(plan)
+
+    def loader():
+        loaded = set()
+        loader_conn = connect_to_database()
+        try:
+            while True:
+                try:
+                    plan = work_queue.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    if load_dataflow_file(loader_conn, plan, plan['file_path']):
+                        loaded.add(plan['df_id'])
+                except Exception as e:
+                    print(f"Errore durante il caricamento di {plan['df_id']}: {e}")
+        finally:
+            loader_conn.close()
+        return loaded
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(loader) for _ in range(min(workers, work_queue.qsize()))]
+        loaded = set().union(*(f.result() for f in futures))
+    print(f"Dataflow ricostruiti: {len(loaded)}/{len(sources)} in {time.perf_counter() - start:.1f}s "
+          f"({workers} caricamenti in parallelo)")
+    return sorted(loaded)
+
+
+def execute_offline_rebuild(conn, load_workers=None):
+    """
+    Ricostruisce il database senza accesso alla rete: Parte 1 e categorie dai messaggi di
+    struttura in cache, codelist e tabelle dei dataflow dai file grezzi (vedi
+    collect_offline_sources), mappatura delle categorie e viste della Parte 3.
+    Le parti di cui mancano i file locali vengono saltate. Restituisce i dataflow caricati.
+    """
+    global OFFLINE_MODE
+    print("\nRicostruzione offline da", DOWNLOAD_DIR)
+    OFFLINE_MODE = True
+    try:
+        dataflow_format = find_cached_structure(DATAFLOW_ALL_URL)
+        if dataflow_format and find_cached_structure(DATASTRUCTURE_ALL_URL) == dataflow_format:
+            execute_part1(conn, structure_format=dataflow_format, force=True)
+        else:
+            print("Dataflow/Datastructure non presenti in cache: Parte 1 saltata.")
+
+        dataflow_sources, codelist_sources = collect_offline_sources()
+        print(f"File locali: {len(dataflow_sources)} dataflow, {len(codelist_sources)} codelist")
+        ensure_manifest_table(conn)
+        rebuild_codelists(conn, codelist_sources)
+        loaded = rebuild_dataflow_tables(conn, dataflow_sources, load_workers)
+
+        category_format = find_cached_structure(CATEGORYSCHEME_ALL_URL)
+        if category_format and table_exists(conn, 'dataflow'):
+            populate_categories(conn, category_format)
+            execute_category_mapping(conn)
+            create_dataflow_category_view(conn)
+        else:
+            print("Schema categorie o dataflow non disponibili: mappatura categorie saltata.")
+
+        if table_exists(conn, 'datastructure_details'):
+            execute_part3(conn, loaded)
+        else:
+            print("Strutture non disponibili: viste della Parte 3 non create.")
+    finally:
+        OFFLINE_MODE = False
+    print("Ricostruzione offline completata.")
+    return loaded
 
 
 # =============================================================================
@@ -1223,6 +4952,12 @@ def main():
     # Connessione + creazione schema se mancante
     conn = connect_to_database()
 
+    # Ricostruzione completa dai file locali, senza rete
+    if OFFLINE_REBUILD_FLAG in sys.argv[1:]:
+        execute_offline_rebuild(conn)
+        conn.close()
+        return
+
     # Aggiornamento dataflow?
     choice = input("Eseguire update dataflow/datastructure? (si/no): ").strip().lower()
     if choice == 'si':
@@ -1268,8 +5003,24 @@ def main():
         conn.close()
         return
 
+    # Struttura e codelist dei soli dataflow scelti con una query mirata
+    choice = input("Aggiornare struttura e codelist dei dataflow scelti con query mirata? (si/no): ").strip().lower()
+    targeted = choice == 'si'
+    if targeted:
+        execute_part1_targeted(conn, df_to_dl)
+
+    # Filtri opzionali per dimensione (vuoto = si riusa il filtro dell'ultimo refresh)
+    filters = {}
+    for df_id in df_to_dl:
+        text = input(f"Filtro per {df_id} (es. FREQ=A;ITTER107=IT+ITC, '-' = nessun filtro, "
+                     f"invio = ultimo usato): ").strip()
+        if text == '-':
+            filters[df_id] = {}
+        elif text:
+            filters[df_id] = parse_filter_spec(text)
+
     # Parte 2: Download dati e classificazioni
-    successful_downloads = execute_part2(conn, df_to_dl)
+    successful_downloads = execute_part2(conn, df_to_dl, classifications=not targeted, filters=filters)
 
     # Parte 3: Creazione viste per i dataset scaricati con successo
     if successful_downloads:
@@ -1282,5 +5033,6 @@ def main():
 
 
 if __name__ == "__main__":
+    http_fixtures.install_from_env()  # HTTP_FIXTURES_MODE=record|replay
     main()
 
@@ -0,0 +1,15 @@
+import os
+import sys
+
+import pytest
+
+# I moduli sono script nella radice del repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+@pytest.fixture
+def fixture_path():
+    """Percorso di un file in tests/fixtures."""
+    return lambda name: os.path.join(FIXTURES_DIR, name)
@@ -0,0 +1,24 @@
+import istat_supabase as istat
+
+CATEGORIES = {'22', '22_289', '22_289_1', '101', '101_1015'}
+
+
+def test_longest_prefix_wins():
+    assert istat.match_category(CATEGORIES, '22_289_DF_DCIS_POPRES1_1') == '22_289'
+    assert istat.match_category(CATEGORIES, '22_289_1_DF_X') == '22_289_1'
+    assert istat.match_category(CATEGORIES, '101_1015_DF_DCSP_COLTIVAZIONI_1') == '101_1015'
+
+
+def test_prefix_must_end_before_an_underscore():
+    # '2' non è un prefisso valido di '22_...', né '22_28' di '22_289_...'
+    assert istat.match_category({'2', '22_28'}, '22_289_DF') is None
+    assert istat.match_category(CATEGORIES, '22') is None
+    assert istat.match_category(CATEGORIES, '999_DF') is None
+
+
+def test_build_dataflow_category_lookup():
+    dataflows = ['22_289_DF_A', '101_DF_B', '999_DF_C']
+    assert istat.build_dataflow_category_lookup(dataflows, list(CATEGORIES)) == {
+        '22_289_DF_A': '22_289',
+        '101_DF_B': '101',
+    }
@@ -0,0 +1,46 @@
+import io
+import xml.etree.ElementTree as ET
+
+import pytest
+
+import istat_supabase as istat
+
+
+def read_constraint(fixture_path, name):
+    with open(fixture_path(name), 'rb') as source:
+        return istat.extract_constraint_codes(source)
+
+
+def test_included_cube_regions_are_merged(fixture_path):
+    codes = read_constraint(fixture_path, 'constraint_codes.xml')
+    # Il CubeRegion escluso (include="false") non aggiunge codici
+    assert codes == {'FREQ': {'A', 'Q'}, 'ITTER107': {'IT', 'ITC'}}
+    assert not istat.is_empty_constraint(codes)
+
+
+def test_dimension_without_values_is_an_empty_constraint(fixture_path):
+    codes = read_constraint(fixture_path, 'constraint_empty.xml')
+    assert codes == {'FREQ': {'A'}, 'ITTER107': set()}
+    assert istat.is_empty_constraint(codes)
+
+
+def test_constraint_without_cube_region_is_unknown(fixture_path):
+    codes = read_constraint(fixture_path, 'constraint_no_cuberegion.xml')
+    assert codes is None
+    assert not istat.is_empty_constraint(codes)
+
+
+def test_malformed_constraint_raises_parse_error():
+    with pytest.raises(ET.ParseError):
+        istat.extract_constraint_codes(io.BytesIO(b'<broken><xml'))
+
+
+def test_constrained_codelist_name_fits_postgres_identifiers():
+    assert istat.constrained_codelist_name('0_0', 'dim1') == '0_0__dim1_codes'
+
+    long_name = istat.constrained_codelist_name('150_915_DF_DCSC_INDXPRODIND_1_BASE2021', 'tipo_dato_ind')
+    assert len(long_name.encode()) <= istat.MAX_IDENTIFIER_LENGTH
+    assert long_name.endswith('_codes')
+    # Deterministico e distinto per dimensione
+    assert long_name == istat.constrained_codelist_name('150_915_DF_DCSC_INDXPRODIND_1_BASE2021', 'tipo_dato_ind')
+    assert long_name != istat.constrained_codelist_name('150_915_DF_DCSC_INDXPRODIND_1_BASE2021', 'tipo_dato_inx')
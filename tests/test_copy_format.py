@@ -0,0 +1,107 @@
+import csv
+import hashlib
+import io
+from datetime import date
+
+import pytest
+
+import istat_supabase as istat
+
+
+@pytest.mark.parametrize('value, expected', [
+    (None, '\\N'),
+    ('', ''),
+    ('plain', 'plain'),
+    (42, '42'),
+    ('a\tb', 'a\\tb'),
+    ('riga1\nriga2\r', 'riga1\\nriga2\\r'),
+    ('C:\\dati', 'C:\\\\dati'),
+    ('\\N', '\\\\N'),
+])
+def test_copy_text_value(value, expected):
+    assert istat.copy_text_value(value) == expected
+
+
+def test_copy_text_value_round_trips_through_copy_text_format():
+    # Ogni campo serializzato non contiene separatori di campo o di riga non escapati
+    for value in ['a\tb\nc', '\\', 'x\\ty']:
+        encoded = istat.copy_text_value(value)
+        assert '\t' not in encoded and '\n' not in encoded
+        decoded = (encoded.replace('\\\\', '\0').replace('\\t', '\t')
+                   .replace('\\n', '\n').replace('\\r', '\r').replace('\0', '\\'))
+        assert decoded == value
+
+
+def test_batched_handles_generators():
+    assert list(istat.batched((i for i in range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(istat.batched([], 3)) == []
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2020', date(2020, 1, 1)),
+    ('2020-03', date(2020, 3, 1)),
+    ('2020-03-15', date(2020, 3, 15)),
+    ('2020-Q2', date(2020, 4, 1)),
+    ('2020-S2', date(2020, 7, 1)),
+    ('2020-H1', date(2020, 1, 1)),
+    ('2020-M11', date(2020, 11, 1)),
+    ('2020-W01', date(2019, 12, 30)),
+    ('2020-Q5', None),
+    ('2020-13', None),
+    ('anno 2020', None),
+])
+def test_parse_time_period(value, expected):
+    assert istat.parse_time_period(value) == expected
+
+
+def test_derive_column_types_only_types_the_measure():
+    components = {'freq': 'Dimension', 'unit': 'Attribute', 'valore': 'Measure'}
+    columns = ['freq', 'time_period', 'unit', 'obs_value', 'valore', 'extra']
+    assert istat.derive_column_types(columns, components) == [
+        'TEXT', 'TEXT', 'TEXT', 'DOUBLE PRECISION', 'DOUBLE PRECISION', 'TEXT']
+
+
+def test_iter_projected_csv_projects_checks_and_adds_period_start():
+    rows = [
+        ['IT1:DF(1.0)', 'A', '2020', '1.5', 'x'],
+        ['IT1:DF(1.0)', 'A', '2021-Q3', 'n.d.', 'y'],
+        ['IT1:DF(1.0)', 'A', 'boh', '', 'z'],
+    ]
+    columns = ['freq', 'time_period', 'obs_value']
+    types = istat.derive_column_types(columns, {})
+    counter = {}
+    chunks = list(istat.iter_projected_csv(iter(rows), [1, 2, 3], counter,
+                                           istat.build_value_checks(columns, types),
+                                           time_position=1, rows_per_chunk=2))
+
+    assert len(chunks) == 2
+    assert list(csv.reader(io.StringIO(''.join(chunks)))) == [
+        ['A', '2020', '1.5', '2020-01-01'],
+        ['A', '2021-Q3', '', '2021-07-01'],
+        ['A', 'boh', '', ''],
+    ]
+    assert counter['rows'] == 3
+    assert dict(counter['failures']) == {'obs_value': 1, 'time_period_date': 1}
+
+
+def test_read_csv_projection_drops_excluded_fields():
+    body = b'DATAFLOW,FREQ,TIME_PERIOD,OBS_VALUE,OBS_STATUS\nIT1:DF(1.0),A,2020,1,p\nIT1:DF(1.0),A,2021,2,\n'
+    reader, keep_indexes, columns, sample_rows = istat.read_csv_projection(io.BytesIO(body))
+
+    assert columns == ['dataflow', 'freq', 'time_period', 'obs_value']
+    assert keep_indexes == [0, 1, 2, 3]
+    assert sample_rows == [['IT1:DF(1.0)', 'A', '2020', '1', 'p']]
+    assert list(reader) == [['IT1:DF(1.0)', 'A', '2021', '2', '']]
+    assert istat.read_csv_projection(io.BytesIO(b'A,B\n')) is None
+
+
+def test_tee_stream_hashes_and_copies_bytes():
+    body = b'x' * 100000
+    sink = io.BytesIO()
+    info = {'sha256': hashlib.sha256(), 'byte_size': 0}
+    stream = istat.TeeStream(io.BytesIO(body), sink, info)
+    assert io.BufferedReader(stream).read() == body
+    assert sink.getvalue() == body
+    assert info['byte_size'] == len(body)
+    assert info['sha256'].hexdigest() == hashlib.sha256(body).hexdigest()
+    assert stream.read_error is None
@@ -0,0 +1,127 @@
+import gzip
+import http.server
+import threading
+
+import pytest
+import requests
+
+import http_fixtures
+
+BODY = b'DATAFLOW,FREQ,OBS_VALUE\nIT1:DF(1.0),A,1.5\n' * 100
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = BODY
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('ETag', '"v1"')
+        if self.path.startswith('/gzip'):
+            body = gzip.compress(BODY)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server:
+    """Server HTTP locale in un thread, fermabile prima della fine del test."""
+
+    def __init__(self):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.running = False
+
+
+@pytest.fixture
+def server():
+    server = Server()
+    yield server
+    server.stop()
+
+
+@pytest.fixture(autouse=True)
+def restore_send():
+    yield
+    http_fixtures.uninstall()
+
+
+def test_record_then_replay_without_network(server, tmp_path):
+    urls = [f"{server.url}/data/DF/ALL?format=csv", f"{server.url}/gzip/data/DF/ALL"]
+
+    http_fixtures.install('record', directory=str(tmp_path))
+    recorded = [requests.get(url, headers={'Accept': 'text/csv'}) for url in urls]
+    assert [r.content for r in recorded] == [BODY, BODY]
+    assert len(http_fixtures.list_fixtures(str(tmp_path))) == 2
+    http_fixtures.uninstall()
+
+    # Server fermato: le risposte arrivano solo dall'archivio
+    server.stop()
+    with pytest.raises(requests.exceptions.ConnectionError):
+        requests.get(urls[0])
+    http_fixtures.install('replay', directory=str(tmp_path), latency=0, error_rate=0)
+    for url in urls:
+        response = requests.get(url, headers={'Accept': 'text/csv'})
+        assert response.status_code == 200
+        assert response.content == BODY
+        assert response.headers['ETag'] == '"v1"'
+
+
+def test_replay_gzip_body_is_stored_as_transferred(server, tmp_path):
+    url = f"{server.url}/gzip/codelist"
+    http_fixtures.install('record', directory=str(tmp_path))
+    requests.get(url)
+    http_fixtures.uninstall()
+
+    meta = http_fixtures.list_fixtures(str(tmp_path))[0]
+    with open(tmp_path / meta['body'], 'rb') as f:
+        assert gzip.decompress(f.read()) == BODY
+
+    http_fixtures.install('replay', directory=str(tmp_path), latency=0, error_rate=0)
+    response = requests.get(url, stream=True)
+    response.raw.decode_content = False
+    assert gzip.decompress(response.raw.read()) == BODY
+
+
+def test_replay_answers_conditional_requests_with_304(server, tmp_path):
+    url = f"{server.url}/codelist/IT1/CL_FREQ"
+    http_fixtures.install('record', directory=str(tmp_path))
+    # In record la richiesta condizionale diventa completa, così l'archivio ha il corpo
+    assert requests.get(url, headers={'If-None-Match': '"v1"'}).status_code == 200
+    http_fixtures.uninstall()
+
+    http_fixtures.install('replay', directory=str(tmp_path), latency=0, error_rate=0)
+    assert requests.get(url, headers={'If-None-Match': '"v1"'}).status_code == 304
+    assert requests.get(url, headers={'If-None-Match': '"v0"'}).content == BODY
+
+
+def test_replay_missing_fixture_and_injected_errors(tmp_path):
+    http_fixtures.install('replay', directory=str(tmp_path), latency=0, error_rate=0)
+    with pytest.raises(requests.exceptions.ConnectionError):
+        requests.get('http://127.0.0.1:9/non-registrato')
+
+    http_fixtures.install('replay', directory=str(tmp_path), latency=0, error_rate=1)
+    with pytest.raises(requests.exceptions.ConnectionError, match='iniettato'):
+        requests.get('http://127.0.0.1:9/qualsiasi')
+
+
+def test_fixture_key_depends_on_accept_only():
+    key = http_fixtures.fixture_key('GET', 'http://x/a', {'Accept': 'application/xml'})
+    assert key == http_fixtures.fixture_key('get', 'http://x/a', {'Accept': 'application/xml',
+                                                                  'User-Agent': 'altro'})
+    assert key != http_fixtures.fixture_key('GET', 'http://x/a', {'Accept': 'application/json'})
+
+
+def test_invalid_mode():
+    with pytest.raises(ValueError):
+        http_fixtures.install('rewind')
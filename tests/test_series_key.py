@@ -0,0 +1,40 @@
+import pytest
+
+import istat_supabase as istat
+
+DIMENSIONS = ['FREQ', 'ITTER107', 'TIPO_DATO', 'SEXISTAT1']
+
+
+def test_no_filter_is_all():
+    assert istat.build_sdmx_key(DIMENSIONS, None) == 'ALL'
+    assert istat.build_sdmx_key(DIMENSIONS, {}) == 'ALL'
+
+
+def test_key_follows_dimension_positions():
+    spec = {'SEXISTAT1': '9', 'FREQ': 'A', 'ITTER107': ['IT', 'ITC']}
+    assert istat.build_sdmx_key(DIMENSIONS, spec) == 'A.IT+ITC..9'
+
+
+def test_dimension_names_are_case_insensitive():
+    assert istat.build_sdmx_key(['freq', 'itter107'], {'FREQ': 'Q'}) == 'Q.'
+
+
+@pytest.mark.parametrize('spec', [
+    {'ETA': '15-64'},
+    {'FREQ': 'A.Q'},
+    {'FREQ': ['A+Q']},
+    {'FREQ': ''},
+])
+def test_invalid_filters_are_rejected(spec):
+    with pytest.raises(ValueError):
+        istat.build_sdmx_key(DIMENSIONS, spec)
+
+
+def test_parse_filter_spec():
+    assert istat.parse_filter_spec('freq=A; ITTER107=IT+ITC ;') == {'FREQ': ['A'], 'ITTER107': ['IT', 'ITC']}
+    assert istat.parse_filter_spec('   ') is None
+
+
+def test_parsed_filter_builds_the_same_key():
+    spec = istat.parse_filter_spec('ITTER107=IT+ITC;FREQ=A')
+    assert istat.build_sdmx_key(DIMENSIONS, spec) == 'A.IT+ITC..'
@@ -0,0 +1,106 @@
+import xml.etree.ElementTree as ET
+
+import istat_supabase as istat
+
+
+def test_datastructure_with_attribute_relationships_has_no_null_keys(fixture_path):
+    # I <Ref/> dentro AttributeRelationship non devono diventare Dimension/Group senza id
+    with open(fixture_path('dsd_attribute_relationships.xml'), 'rb') as source:
+        records = list(istat.iter_datastructure_records(source))
+
+    assert len(records) == 1
+    row, details, groups = records[0]
+    assert row['ID'] == 'DSD_X'
+    assert [(d['type'], d['detail_id']) for d in details] == [
+        ('Dimension', 'FREQ'), ('Dimension', 'REF_AREA'),
+        ('Attribute', 'UNIT'), ('Attribute', 'NOTE'),
+        ('Measure', 'OBS_VALUE'),
+    ]
+    assert groups == [{'datastructure_id': 'DSD_X', 'group_id': 'SIBLING'}]
+
+
+def test_datastructure_detail_fields(fixture_path):
+    with open(fixture_path('dsd_attribute_relationships.xml'), 'rb') as source:
+        _, details, _ = next(istat.iter_datastructure_records(source))
+
+    freq = details[0]
+    assert freq['position'] == '1'
+    assert freq['concept_id'] == 'FREQ'
+    assert freq['maintainableParentID'] == 'CS'
+    assert (freq['enum_id'], freq['enum_version'], freq['enum_agencyID']) == ('CL_FREQ', '1.0', 'IT1')
+    assert details[1]['enum_id'] is None
+
+
+def test_extract_data_from_datastructure_matches_streaming_parser(fixture_path):
+    root = ET.parse(fixture_path('dsd_attribute_relationships.xml')).getroot()
+    data, details, groups = istat.extract_data_from_datastructure(root)
+
+    with open(fixture_path('dsd_attribute_relationships.xml'), 'rb') as source:
+        row, streamed_details, streamed_groups = next(istat.iter_datastructure_records(source))
+    assert data == [row]
+    assert details == streamed_details
+    assert groups == streamed_groups
+
+
+def test_json_datastructure_matches_xml_backend(fixture_path):
+    root = ET.parse(fixture_path('dsd_attribute_relationships.xml')).getroot()
+    xml_data, xml_details, xml_groups = istat.extract_data_from_datastructure(root)
+    doc = istat.load_json_file(fixture_path('dsd_attribute_relationships.json'))
+    json_data, json_details, json_groups = istat.extract_data_from_datastructure_json(doc)
+
+    assert json_data == xml_data
+
+    def key_fields(details):
+        return [(d['type'], d['detail_id'], d['position'], d['enum_id'], d['enum_version'])
+                for d in details]
+
+    assert key_fields(json_details) == key_fields(xml_details)
+    assert json_groups == xml_groups
+    assert json_details[0]['concept_id'] == 'FREQ'
+    assert json_details[0]['maintainableParentID'] == 'CS'
+
+
+def test_dataflows_xml(fixture_path):
+    with open(fixture_path('dataflows.xml'), 'rb') as source:
+        records = list(istat.iter_dataflow_records(source))
+
+    assert records == [
+        {'ID': '101_1015_DF_DCSP_COLTIVAZIONI_1', 'Nome_it': 'Coltivazioni', 'Nome_en': 'Crops',
+         'ref_id': 'DCSP_COLTIVAZIONI', 'version': '1.0', 'agencyID': 'IT1', 'package': 'datastructure'},
+        {'ID': '22_289_DF_DCIS_POPRES1_1', 'Nome_it': 'Popolazione residente', 'Nome_en': None,
+         'ref_id': 'DCIS_POPRES1', 'version': '1.2', 'agencyID': 'IT1', 'package': 'datastructure'},
+    ]
+    root = ET.parse(fixture_path('dataflows.xml')).getroot()
+    assert istat.extract_data_from_dataflow(root) == records
+
+
+def test_nested_categories_xml_and_json(fixture_path):
+    categories = istat.extract_categories(ET.parse(fixture_path('categoryscheme.xml')).getroot())
+    assert categories == {
+        '101': {'name_it': 'Agricoltura', 'name_en': 'Agriculture'},
+        '101_1015': {'name_it': 'Coltivazioni', 'name_en': None},
+    }
+
+    doc = {'data': {'categorySchemes': [{'id': 'Z1000AGR', 'categories': [
+        {'id': '101', 'names': {'it': 'Agricoltura', 'en': 'Agriculture'}, 'categories': [
+            {'id': '101_1015', 'names': {'it': 'Coltivazioni'}}]}]}]}}
+    assert istat.extract_categories_json(doc) == categories
+
+
+def test_codelist_json():
+    doc = {'data': {'codelists': [{'id': 'CL_FREQ', 'codes': [
+        {'id': 'A', 'names': {'it': 'annuale', 'en': 'annual'}},
+        {'id': 'Q', 'names': {'it': 'trimestrale'}},
+    ]}]}}
+    assert istat.extract_codes_from_codelist_json(doc) == [
+        ('A', 'annuale', 'annual'), ('Q', 'trimestrale', None)]
+
+
+def test_parse_sdmx_urn():
+    assert istat.parse_sdmx_urn('urn:sdmx:org.sdmx.infomodel.codelist.Codelist=IT1:CL_FREQ(1.0)') == {
+        'package': 'codelist', 'class': 'Codelist', 'agencyID': 'IT1',
+        'id': 'CL_FREQ', 'version': '1.0', 'item': None}
+    concept = istat.parse_sdmx_urn('urn:sdmx:org.sdmx.infomodel.conceptscheme.Concept=IT1:CS_X(1.0).FREQ')
+    assert (concept['id'], concept['item']) == ('CS_X', 'FREQ')
+    assert istat.parse_sdmx_urn(None) == {}
+    assert istat.parse_sdmx_urn('not-an-urn') == {}